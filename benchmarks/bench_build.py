@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+"""
+Benchmark ``charm build`` on a synthetic charm.
+
+A stack of layers and interfaces of the given shape is generated in a work
+directory and built over and over, timing each phase of the build as well
+as a rebuild with nothing changed, ``delta_signatures``, ``charm inspect``
+and ``charm proof`` on the result.  Everything is served locally: layers
+and interfaces are found on ``LAYER_PATH`` and ``INTERFACE_PATH``, apart
+from ``--remote`` layers, which are cloned from local git repos listed in
+a layer index served over HTTP on localhost.
+
+The results are written as JSON, which a later run can be compared to::
+
+    python benchmarks/bench_build.py -o before.json
+    git checkout my-branch
+    python benchmarks/bench_build.py --compare before.json
+
+``--compare`` exits with 1 if any timing got slower by more than
+``--threshold``.
+"""
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from path import Path as path
+from ruamel import yaml
+
+from charmtools import proof, utils
+from charmtools.build import builder, inspector
+from charmtools.build.fetchers import InterfaceFetcher, LayerFetcher
+from charmtools.build.index import LayerIndex
+from charmtools.build.profiler import Profiler
+
+log = logging.getLogger('bench')
+
+FORMAT_VERSION = 1
+# timings faster than this (in seconds) are too noisy to compare
+NOISE_FLOOR = 0.005
+
+
+def content(seed, size):
+    """size bytes of text which are the same for the same seed."""
+    data = []
+    block = hashlib.sha256(seed).hexdigest()
+    while len(data) * 65 < size:
+        block = hashlib.sha256(block).hexdigest()
+        data.append(block)
+    return ('\n'.join(data) + '\n')[:size]
+
+
+def write_yaml(filename, data):
+    filename.parent.makedirs_p()
+    filename.write_text(yaml.safe_dump(data, default_flow_style=False))
+
+
+def layer_levels(options):
+    """The names of the layers at each level of the include graph."""
+    levels = [[] for _ in range(options.depth)]
+    for i in range(max(options.layers, options.depth)):
+        levels[i % options.depth].append('bench-{}'.format(i))
+    return levels
+
+
+def generate_layer(directory, name, includes, options):
+    """Generate a layer of the given options' shape."""
+    config = {'includes': includes,
+              'repo': 'https://example.com/{}.git'.format(name)}
+    if options.ignores:
+        config['ignore'] = ['ignored-{}*'.format(i)
+                            for i in range(options.ignores)]
+    write_yaml(directory / 'layer.yaml', config)
+    write_yaml(directory / 'config.yaml', {'options': {
+        '{}-{}'.format(name, i): {
+            'type': 'string',
+            'default': content('{} {}'.format(name, i), 20),
+            'description': 'Option {} of {}'.format(i, name),
+        } for i in range(options.yaml_keys)}})
+    (directory / 'README.md').write_text('# {}\n'.format(name))
+    if not includes:
+        # a base layer, like layer:basic
+        (directory / 'hooks').makedirs_p()
+        (directory / 'hooks' / 'hook.template').write_text(
+            '#!/usr/bin/env python3\n# {}\n')
+    (directory / 'reactive').makedirs_p()
+    (directory / 'reactive' / name.replace('-', '_') + '.py').write_text(
+        'from charms.reactive import when  # noqa\n')
+    for i in range(options.files):
+        if i % 3 == 0:
+            # the same files in every layer, which replace each other
+            relname = path('templates') / 'shared-{}.tmpl'.format(i)
+        elif i % 3 == 1:
+            relname = path('lib') / name / 'module_{}.py'.format(i)
+        else:
+            relname = path('files') / name / 'file-{}.txt'.format(i)
+        (directory / relname).parent.makedirs_p()
+        (directory / relname).write_text(
+            content('{} {}'.format(name, i), options.file_size))
+    for i in range(options.ignores):
+        (directory / 'ignored-{}.txt'.format(i)).write_text(name)
+
+
+def generate_interface(directory, name):
+    write_yaml(directory / 'interface.yaml', {'name': name})
+    for role in ('provides', 'requires'):
+        (directory / role + '.py').write_text(
+            'from charms.reactive import RelationBase  # noqa\n')
+
+
+def git_repo(directory):
+    """Commit directory to a git repo and return its url."""
+    def git(*args):
+        subprocess.check_call(('git',) + args, cwd=directory,
+                              stdout=open(os.devnull, 'w'))
+    git('init', '-q')
+    git('add', '-A')
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+        'commit', '-q', '-m', 'bench')
+    return 'file://{}/.git'.format(directory)
+
+
+def generate(root, options):
+    """
+    Generate the charm, its layers and interfaces under root, and return
+    the path of the charm and the layer index entries of remote layers.
+    """
+    levels = layer_levels(options)
+    names = [name for level in levels for name in level]
+    remote = set(names[len(names) - options.remote:]) \
+        if options.remote else set()
+    index = {}
+    for depth, level in enumerate(levels):
+        includes = ['layer:{}'.format(name)
+                    for name in (levels[depth + 1]
+                                 if depth + 1 < len(levels) else [])]
+        for name in level:
+            parent = root / ('remote' if name in remote else 'layers')
+            generate_layer(parent / name, name, includes, options)
+            if name in remote:
+                index['/layers/{}.json'.format(name)] = {
+                    'repo': git_repo(parent / name)}
+    interfaces = ['bench-iface-{}'.format(i)
+                  for i in range(options.interfaces)]
+    for name in interfaces:
+        generate_interface(root / 'interfaces' / name, name)
+    charm = root / 'layers' / 'bench-charm'
+    generate_layer(charm, 'bench-charm',
+                   ['layer:{}'.format(name) for name in levels[0]] +
+                   ['interface:{}'.format(name) for name in interfaces],
+                   options)
+    write_yaml(charm / 'metadata.yaml', {
+        'name': 'bench-charm',
+        'summary': 'A generated charm to benchmark charm build with',
+        'maintainer': 'Bench <bench@example.com>',
+        'description': 'A generated charm to benchmark charm build with',
+        'series': ['xenial'],
+        'requires': {name: {'interface': name} for name in interfaces},
+    })
+    return charm, index
+
+
+class IndexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the layer index entries of the server's ``entries``."""
+    def do_GET(self):
+        entry = self.server.entries.get(self.path)
+        if entry is None:
+            self.send_error(404)
+            return
+        body = json.dumps(entry)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve_index(entries):
+    """Serve a layer index of entries on localhost, yielding its url."""
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), IndexHandler)
+    server.entries = entries
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def timed(results, name, fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    results[name] = time.time() - start
+    return result
+
+
+def new_builder(charm, output_dir, jobs):
+    bu = builder.Builder()
+    bu.log_level = 'WARNING'
+    bu.output_dir = output_dir
+    bu.series = 'xenial'
+    bu.charm = charm
+    bu.hide_metrics = True
+    bu.report = False
+    bu.jobs = jobs
+    return bu
+
+
+def run_once(charm, work_dir, options):
+    """Build the charm into a new output dir and time everything."""
+    results = OrderedDict()
+    output_dir = path(tempfile.mkdtemp(dir=work_dir))
+    bu = new_builder(charm, output_dir, options.jobs)
+    utils.PROFILER = profiler = Profiler()
+    try:
+        timed(results, 'build', bu)
+    finally:
+        utils.PROFILER = None
+    for event in profiler.events:
+        if event['cat'] == 'phase':
+            results['build.' + event['name']] = event['dur'] / 1e6
+
+    layers = bu.fetch_deps(bu.top_layer)
+    timed(results, 'plan_layers', bu.plan_layers, layers, OrderedDict())
+
+    rebuild = new_builder(charm, output_dir, options.jobs)
+    timed(results, 'rebuild', rebuild)
+
+    timed(results, 'delta_signatures', utils.delta_signatures, bu.manifest)
+    timed(results, 'delta_signatures.paranoid', utils.delta_signatures,
+          bu.manifest, True)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        timed(results, 'inspect', inspector.inspect, bu.target_dir)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    timed(results, 'proof', proof.proof, bu.target_dir, False, False)
+    output_dir.rmtree_p()
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(options):
+    if options.work_dir:
+        path(options.work_dir).makedirs_p()
+    work_dir = path(tempfile.mkdtemp(prefix='charm-build-bench-',
+                                     dir=options.work_dir))
+    try:
+        charm, index = generate(work_dir, options)
+        os.environ['LAYER_PATH'] = work_dir / 'layers'
+        os.environ['INTERFACE_PATH'] = work_dir / 'interfaces'
+        with serve_index(index) as domain:
+            InterfaceFetcher.INTERFACE_DOMAIN = domain
+            LayerFetcher.INTERFACE_DOMAIN = domain
+            InterfaceFetcher.INDEX = LayerIndex(domain)
+            runs = []
+            for i in range(options.warmup + options.repeat):
+                results = run_once(charm, work_dir, options)
+                if i >= options.warmup:
+                    runs.append(results)
+                log.info('run %d: build %.3fs, rebuild %.3fs', i + 1,
+                         results['build'], results['rebuild'])
+    finally:
+        if not options.keep:
+            work_dir.rmtree_p()
+    timings = OrderedDict()
+    for name in runs[0]:
+        values = [timing[name] for timing in runs if name in timing]
+        timings[name] = OrderedDict([
+            ('min', min(values)),
+            ('median', median(values)),
+            ('max', max(values)),
+            ('runs', values),
+        ])
+    return OrderedDict([
+        ('version', FORMAT_VERSION),
+        ('commit', git_commit()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', OrderedDict((name, getattr(options, name))
+                               for name in SHAPE)),
+        ('repeat', options.repeat),
+        ('jobs', options.jobs),
+        ('timings', timings),
+    ])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, threshold):
+    """
+    Log the change of each median timing from baseline to results, and
+    return the names of those that got slower by more than threshold.
+    """
+    if (baseline.get('params'), baseline.get('jobs')) != \
+            (results['params'], results['jobs']):
+        log.warn('The baseline was run with different parameters: %s, '
+                 '%s jobs', baseline.get('params'), baseline.get('jobs'))
+    slower = []
+    log.info('%-32s %10s %10s %8s', 'timing', 'baseline', 'now', 'ratio')
+    for name, timing in results['timings'].items():
+        old = baseline['timings'].get(name)
+        if old is None:
+            log.info('%-32s %10s %9.3fs', name, '-', timing['median'])
+            continue
+        ratio = timing['median'] / old['median'] if old['median'] else 0
+        flag = ''
+        if max(timing['median'], old['median']) >= NOISE_FLOOR and \
+                ratio > threshold:
+            slower.append(name)
+            flag = ' slower'
+        log.info('%-32s %9.3fs %9.3fs %7.2fx%s', name, old['median'],
+                 timing['median'], ratio, flag)
+    return slower
+
+
+# the options which determine the shape of the generated charm
+SHAPE = ('depth', 'layers', 'files', 'file_size', 'yaml_keys',
+         'interfaces', 'ignores', 'remote')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=4,
+                        help="Levels of layers including each other "
+                             "(default: %(default)s)")
+    parser.add_argument('--layers', type=int, default=8,
+                        help="Layers in total, spread over the levels; "
+                             "each includes every layer of the next level "
+                             "(default: %(default)s)")
+    parser.add_argument('--files', type=int, default=50,
+                        help="Files per layer (default: %(default)s)")
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help="Bytes per file (default: %(default)s)")
+    parser.add_argument('--yaml-keys', type=int, default=50,
+                        help="Options in each layer's config.yaml "
+                             "(default: %(default)s)")
+    parser.add_argument('--interfaces', type=int, default=4,
+                        help="Interfaces the charm requires "
+                             "(default: %(default)s)")
+    parser.add_argument('--ignores', type=int, default=5,
+                        help="Ignore rules per layer (default: %(default)s)")
+    parser.add_argument('--remote', type=int, default=0,
+                        help="Layers to clone from local git repos through "
+                             "a local layer index, rather than find on "
+                             "LAYER_PATH (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Parallel jobs of the builds "
+                             "(default: %(default)s)")
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help="Timed runs (default: %(default)s)")
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="Untimed runs before them "
+                             "(default: %(default)s)")
+    parser.add_argument('--work-dir', type=path,
+                        help="Directory to generate and build the charm in "
+                             "(default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the generated charm and layers")
+    parser.add_argument('-o', '--output', type=path,
+                        help="Write the results to this JSON file")
+    parser.add_argument('--compare', type=path, metavar='BASELINE',
+                        help="Compare the results to those of an earlier "
+                             "run, and fail if any got slower")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Ratio to the baseline beyond which a timing "
+                             "counts as slower (default: %(default)s)")
+    options = parser.parse_args(args)
+    if options.depth < 1 or options.repeat < 1:
+        parser.error('--depth and --repeat must be at least 1')
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+    logging.getLogger('build').setLevel(logging.WARNING)
+    logging.getLogger('charmtools').setLevel(logging.WARNING)
+    logging.getLogger('requests').setLevel(logging.WARNING)
+
+    results = run(options)
+    if options.output:
+        options.output.write_text(
+            json.dumps(results, indent=2).decode('utf-8') + '\n')
+        log.info('Wrote results to %s', options.output)
+    else:
+        print(json.dumps(results, indent=2))
+    if options.compare:
+        baseline = json.loads(options.compare.text())
+        slower = compare(baseline, results, options.threshold)
+        if slower:
+            log.error('Slower than %s: %s', options.compare,
+                      ', '.join(slower))
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
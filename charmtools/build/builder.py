@@ -2,29 +2,44 @@
 # -*- coding: utf-8 -*-
 import argparse
 import blessings
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import requests
 import sys
+import tempfile
+import threading
+import time
+import urllib
 import uuid
 import yaml
 
+import charmtools.build.index
 import charmtools.build.tactics
 
 from path import Path as path
 from collections import OrderedDict
-from charmtools import (utils, repofinder, proof)
-from charmtools.build import inspector
+from charmtools import (buildclient, utils, repofinder, proof)
+from charmtools.build import inspector, server
+from charmtools.build.profiler import Profiler
+from charmtools.build.cache import LayerCache, default_cache_dir
 from charmtools.build.errors import BuildError
+from charmtools.build.index import LayerIndex
 from charmtools.build.config import BuildConfig
-from charmtools.build.tactics import Tactic, WheelhouseTactic
+from charmtools.build.tactics import (
+    Tactic,
+    InstallerTactic,
+    WheelhouseTactic,
+)
 from charmtools.build.fetchers import (
     InterfaceFetcher,
     LayerFetcher,
     get_fetcher,
     FetchError,
 )
+from charmtools.fetchers import CharmstoreDownloader, LocalFetcher
 from charmtools.version import charm_tools_version
 
 log = logging.getLogger("build")
@@ -55,13 +70,25 @@ class Configable(object):
 
 
 class Fetched(Configable):
-    def __init__(self, url, target_repo, name=None):
+    # LayerCache to materialize remote repos from, if any
+    CACHE = None
+    # locks on the directories fetched into, as includes of different urls
+    # can be fetched into the same one in parallel
+    _dir_locks = {}
+    _dir_locks_lock = threading.Lock()
+
+    def __init__(self, url, target_repo, name=None, lock=None):
         super(Fetched, self).__init__()
         self.url = url
         self.target_repo = target_repo / self.NAMESPACE
         self.directory = None
         self._name = name
         self.fetched = False
+        # build.lock entry giving the repo and commit to fetch, if any
+        self.lock = lock
+        # where a remote layer or interface was fetched from, for build.lock
+        self.repo = None
+        self.revision = None
 
     @property
     def name(self):
@@ -78,9 +105,21 @@ class Fetched(Configable):
     def __div__(self, other):
         return self.directory / other
 
+    def get_fetcher(self):
+        if self.lock and self.lock.get('repo'):
+            # fetch exactly what was locked, without asking the layer index
+            return self.FETCHER('{}:{}'.format(self.NAMESPACE, self.name),
+                                repo=self.lock['repo'],
+                                revision=self.lock.get('commit') or '')
+        return get_fetcher(self.url)
+
     def fetch(self):
+        with utils.profiled(self.url, 'fetch'):
+            return self._fetch()
+
+    def _fetch(self):
         try:
-            fetcher = get_fetcher(self.url)
+            fetcher = self.get_fetcher()
         except FetchError:
             # We might be passing a local dir path directly
             # which fetchers don't currently  support
@@ -91,8 +130,17 @@ class Fetched(Configable):
             else:
                 if not self.target_repo.exists():
                     self.target_repo.makedirs_p()
-                self.directory = path(fetcher.fetch(self.target_repo))
-                self.fetched = True
+                directory = None
+                with self.dir_lock(fetcher), \
+                        utils.profiled(self.url, 'clone'):
+                    if self.CACHE:
+                        directory = self.CACHE.fetch(fetcher,
+                                                     self.target_repo)
+                    if directory is None:
+                        directory = fetcher.fetch(self.target_repo)
+                    self.directory = path(directory)
+                    self.fetched = True
+                    self.pin(fetcher)
 
         if not self.directory.exists():
             raise BuildError(
@@ -107,11 +155,38 @@ class Fetched(Configable):
         self._name = self.config.name
         return self
 
+    def dir_lock(self, fetcher):
+        """
+        The lock on the directory fetcher fetches into.  Fetchers of a repo
+        url, rather than of a name in the layer index, only know what that
+        directory is called once they have fetched it, so they lock all of
+        target_repo.
+        """
+        target = getattr(fetcher, 'target', None)
+        key = path((target and target(self.target_repo)) or self.target_repo)
+        with self._dir_locks_lock:
+            return self._dir_locks.setdefault(key, threading.Lock())
+
+    def pin(self, fetcher):
+        """
+        Record the repo and revision fetched, for build.lock.  Charm store
+        downloads are not pinned, as they can not be fetched from a repo.
+        """
+        if isinstance(fetcher, CharmstoreDownloader):
+            return
+        if isinstance(fetcher, InterfaceFetcher):
+            self.repo = fetcher.repo
+        else:
+            self.repo = fetcher.url
+        revision = fetcher.get_revision(self.directory)
+        self.revision = str(revision).strip() if revision else None
+
 
 class Interface(Fetched):
     CONFIG_FILE = "interface.yaml"
     NAMESPACE = "interface"
     ENVIRON = "INTERFACE_PATH"
+    FETCHER = InterfaceFetcher
 
 
 class Layer(Fetched):
@@ -119,6 +194,30 @@ class Layer(Fetched):
     OLD_CONFIG_FILE = "composer.yaml"
     NAMESPACE = "layer"
     ENVIRON = "LAYER_PATH"
+    FETCHER = LayerFetcher
+
+
+_metrics_info = {}
+
+
+def metrics_info():
+    """
+    Return the client id and charm-tools version reported with metrics.
+
+    These are computed once per process, since finding the version can
+    mean shelling out to git.
+    """
+    if not _metrics_info:
+        conf_file = path('~/.config/charm-build.conf').expanduser()
+        if conf_file.exists():
+            conf = yaml.safe_load(conf_file.text())
+            cid = conf['cid']
+        else:
+            conf_file.parent.makedirs_p()
+            cid = str(uuid.uuid4())
+            conf_file.write_text(yaml.dump({'cid': cid}))
+        _metrics_info.update(cid=cid, av=charm_tools_version('long'))
+    return _metrics_info
 
 
 class Builder(object):
@@ -128,8 +227,18 @@ class Builder(object):
     PHASES = ['lint', 'read', 'call', 'sign', 'build']
     HOOK_TEMPLATE_FILE = path('hooks/hook.template')
     DEFAULT_SERIES = 'trusty'
-    METRICS_URL = 'https://www.google-analytics.com/collect'
+    LOCK_FILE = 'build.lock'
+    # layer files whose changes can change the whole plan
+    STRUCTURAL_FILES = ('layer.yaml', 'composer.yaml', 'interface.yaml',
+                        'wheelhouse.txt')
+    WATCH_INTERVAL = 0.25  # seconds
+    WATCH_SKIP = ('.git', '.bzr', '.hg', '.tox', '__pycache__')
+    # layers and interfaces shared by every build, set by the build server
+    SHARED_DEPS = None
+    METRICS_BATCH_URL = 'https://www.google-analytics.com/batch'
+    METRICS_BATCH_SIZE = 20  # hits per batch request allowed by the API
     METRICS_ID = 'UA-96529618-2'
+    METRICS_TIMEOUT = 2  # seconds
 
     def __init__(self):
         self.config = BuildConfig()
@@ -139,6 +248,22 @@ class Builder(object):
         self._top_layer = None
         self.hide_metrics = False
         self.wheelhouse_overrides = None
+        self.jobs = 1
+        self.locked = False
+        self.paranoid = False
+        self.watch = False
+        self.profile = None
+        self.archive = None
+        self.archive_only = False
+        self.lock = {}
+        self.metrics = []
+        self._metrics_threads = []
+        self._inputs = {}
+        # {"url lock": Layer or Interface} fetched by any of the builders
+        # of a batch build or by the build server, which they share
+        self.shared_deps = self.SHARED_DEPS
+        # output files modified since the last build
+        self.modified = set()
 
     @property
     def top_layer(self):
@@ -162,7 +287,7 @@ class Builder(object):
             try:
                 setattr(
                     self, '_charm_metadata',
-                    yaml.safe_load(md.open()) if md.exists() else None)
+                    utils.load_yaml(md) if md.exists() else None)
             except yaml.YAMLError as e:
                 log.debug(e)
                 raise BuildError("Failed to process {0}. "
@@ -273,34 +398,83 @@ class Builder(object):
         return results
 
     def fetch_dep(self, layer, results):
-        # Recursively fetch and scan layers
-        # This returns a plan for each file in the result
+        # Fetch the include graph one level at a time, fetching every layer
+        # and interface on a level in parallel.  Once the whole graph is
+        # available it is walked depth first to produce the bottom up
+        # ordering of results.
+        # Layers and interfaces already fetched for another charm in a
+        # batch build (see shared_deps) are reused rather than fetched again.
+        fetched = {}
+        level = [layer]
+        while level:
+            pending = OrderedDict()
+            shared = OrderedDict()
+            for parent in level:
+                for base in self._includes(parent):
+                    if base in fetched or base in pending or base in shared:
+                        continue
+                    if base.startswith("interface:"):
+                        lock = self.lock.get('interfaces', {}).get(base)
+                        dep = Interface(base, self.deps, lock=lock)
+                    else:
+                        lock = self.lock.get('layers', {}).get(base)
+                        dep = Layer(base, self.deps, lock=lock)
+                    key = self._shared_key(base, lock)
+                    if self.shared_deps is not None and \
+                            key in self.shared_deps:
+                        shared[base] = self.shared_deps[key]
+                    else:
+                        pending[base] = dep
+            utils.parallel_map(lambda dep: dep.fetch(),
+                               pending.values(), self.jobs)
+            if self.locked:
+                for dep in pending.values():
+                    if dep.fetched and not dep.lock:
+                        raise BuildError(
+                            '{} is not in {}; build without --locked to '
+                            'update it'.format(dep.url, self.LOCK_FILE))
+            if self.shared_deps is not None:
+                for base, dep in pending.items():
+                    self.shared_deps[self._shared_key(base, dep.lock)] = dep
+            fetched.update(pending)
+            fetched.update(shared)
+            level = [dep for dep in pending.values() + shared.values()
+                     if isinstance(dep, Layer)]
+        self.order_deps(layer, results, fetched)
+
+    @staticmethod
+    def _shared_key(url, lock):
+        return '{} {}'.format(url, json.dumps(lock, sort_keys=True))
+
+    def order_deps(self, layer, results, fetched):
+        # Recursively order the fetched layers and interfaces so that
+        # each layer comes after everything it includes
+        for base in self._includes(layer):
+            # The order of these commands is important. We only want to
+            # include something if we haven't already included it.
+            dep = fetched[base]
+            if isinstance(dep, Interface):
+                if dep.name in [i.name for i in results['interfaces']]:
+                    continue
+                results["interfaces"].append(dep)
+                self.post_metrics('interface', dep.name, dep.fetched)
+            else:
+                if dep.name in [i.name for i in results['layers']]:
+                    continue
+                self.order_deps(dep, results, fetched)
+                results["layers"].append(dep)
+                self.post_metrics('layer', dep.name, dep.fetched)
+
+    def _includes(self, layer):
         baselayers = layer.config.get('includes', [])
         if not baselayers:
             # no deps, this is possible for any base
             # but questionable for the target
-            return
+            return []
 
         if isinstance(baselayers, str):
             baselayers = [baselayers]
-
-        for base in baselayers:
-            # The order of these commands is important. We only want to
-            # fetch something if we haven't already fetched it.
-            if base.startswith("interface:"):
-                iface = Interface(base, self.deps)
-                if iface.name in [i.name for i in results['interfaces']]:
-                    continue
-                results["interfaces"].append(iface.fetch())
-                self.post_metrics('interface', iface.name, iface.fetched)
-            else:
-                base_layer = Layer(base, self.deps)
-                if base_layer.name in [i.name for i in results['layers']]:
-                    continue
-                base_layer.fetch()
-                self.fetch_dep(base_layer, results)
-                results["layers"].append(base_layer)
-                self.post_metrics('layer', base_layer.name, base_layer.fetched)
+        return baselayers
 
     def build_tactics(self, entry, layer, next_config, output_files):
         relname = entry.relpath(layer.directory)
@@ -313,6 +487,22 @@ class Builder(object):
             existing_tactic,
         )
         output_files[relname] = tactic
+        self._inputs.setdefault(relname, []).append(entry)
+
+    def prunable(self, directory, next_config, output_files):
+        """
+        Can the contents of a layer's directory be skipped when planning?
+
+        They can if the next layer ignores all of them, unless there are
+        layer tactics which might claim them first, or a lower layer has
+        provided something in there that they would need to replace.
+        """
+        if next_config.tactics:
+            return False
+        if not utils.ignore_matcher(next_config.ignores).prunes(directory):
+            return False
+        prefix = directory + '/'
+        return not any(f.startswith(prefix) for f in output_files)
 
     def plan_layers(self, layers, output_files):
         next_config = BuildConfig()
@@ -335,6 +525,8 @@ class Builder(object):
                 next_config = next_config.add_config({})
             list(e for e in utils.walk(layer.directory,
                                        self.build_tactics,
+                                       prune=lambda d: self.prunable(
+                                           d, next_config, output_files),
                                        layer=layer,
                                        next_config=next_config,
                                        output_files=output_files))
@@ -435,82 +627,402 @@ class Builder(object):
         """Build out a plan for each file in the various
         layers, taking into account config at each layer"""
         output_files = OrderedDict()
+        # the layer files each output was planned from, for --watch
+        self._inputs = {}
         self.plan = self.plan_layers(layers, output_files)
         self.plan_interfaces(layers, output_files, self.plan)
         self.plan_storage(layers, output_files, self.plan)
         return self.plan
 
     def post_metrics(self, kind, layer_name, fetched):
+        """
+        Record a metrics event, to be sent along with the rest of the build's
+        events by :meth:`flush_metrics`.
+        """
         if self.hide_metrics:
             return
-        conf_file = path('~/.config/charm-build.conf').expanduser()
-        if conf_file.exists():
-            conf = yaml.safe_load(conf_file.text())
-            cid = conf['cid']
-        else:
-            conf_file.parent.makedirs_p()
-            cid = str(uuid.uuid4())
-            conf_file.write_text(yaml.dump({'cid': cid}))
+        self.metrics.append({
+            'ec': kind,
+            'ea': 'fetch' if fetched else 'local',
+            'el': layer_name,
+            'cd1': self.series,
+        })
+
+    def flush_metrics(self):
+        """
+        Send the recorded metrics events in a background thread, so that the
+        build never waits on them.  Use :meth:`wait_for_metrics` to give the
+        thread a chance to finish before exiting.
+        """
+        events, self.metrics = self.metrics, []
+        if self.hide_metrics or not events:
+            return None
+        # bind requests.post now, rather than whenever the thread gets to it
+        thread = threading.Thread(target=self._send_metrics,
+                                  args=(requests.post, events))
+        thread.daemon = True
+        thread.start()
+        self._metrics_threads.append(thread)
+        return thread
+
+    def wait_for_metrics(self, timeout=None):
+        """Wait, at most timeout seconds in total, for metrics to be sent."""
+        if timeout is None:
+            timeout = self.METRICS_TIMEOUT
+        deadline = time.time() + timeout
+        for thread in self._metrics_threads:
+            thread.join(max(0, deadline - time.time()))
+        self._metrics_threads = [t for t in self._metrics_threads
+                                 if t.is_alive()]
+
+    def _send_metrics(self, post, events):
         try:
-            requests.post(self.METRICS_URL, timeout=10, data={
-                'tid': self.METRICS_ID,
-                'v': 1,
-                'aip': 1,
-                't': 'event',
-                'ds': 'app',
-                'cid': cid,
-                'av': charm_tools_version('long'),
-                'an': "charm-build",
-                'ec': kind,
-                'ea': 'fetch' if fetched else 'local',
-                'el': layer_name,
-                'cd1': self.series,
-            })
-        except requests.exceptions.RequestException:
-            pass
+            info = metrics_info()
+            hits = []
+            for event in events:
+                hit = {
+                    'tid': self.METRICS_ID,
+                    'v': 1,
+                    'aip': 1,
+                    't': 'event',
+                    'ds': 'app',
+                    'cid': info['cid'],
+                    'av': info['av'],
+                    'an': "charm-build",
+                }
+                hit.update(event)
+                hits.append(urllib.urlencode(sorted(hit.items())))
+            for i in range(0, len(hits), self.METRICS_BATCH_SIZE):
+                post(self.METRICS_BATCH_URL, timeout=self.METRICS_TIMEOUT,
+                     data='\n'.join(hits[i:i + self.METRICS_BATCH_SIZE]))
+        except Exception as e:
+            log.debug('Unable to send metrics: %s', e)
 
     def exec_plan(self, plan=None, layers=None):
+        previous = self.read_manifest()
+        Tactic.INPUTS = self.input_signatures(previous)
+        if self.jobs > 1:
+            signatures, fingerprints = self.exec_graph(plan, previous)
+        else:
+            signatures, fingerprints = self.exec_phases(plan, previous)
+        with utils.profiled('write', 'phase'):
+            if "sign" in self.PHASES:
+                signatures.update(self.write_lock(plan))
+            new_repo = not self.manifest.exists()
+            if new_repo:
+                added, changed, removed = set(), set(), set()
+            else:
+                added, changed, _ = utils.delta_signatures(
+                    self.manifest, self.paranoid,
+                    {k: v[2] for k, v in signatures.items()})
+                removed = self.clean_removed(signatures)
+            # write out the sigs
+            if "sign" in self.PHASES:
+                self.write_signatures(signatures, layers, fingerprints,
+                                      Tactic.INPUTS.used)
+                if self.archive:
+                    self.write_archive()
+        if self.report:
+            self.write_report(new_repo, added, changed, removed)
+
+    def prepare_installers(self, plan):
+        """
+        Run the pip installs of the plan's InstallerTactics on a pool of
+        self.jobs threads once it has been linted, as they are independent
+        of each other.  Each tactic then only has to put its results in
+        place when called.
+        """
+        installers = [tactic for tactic in plan
+                      if isinstance(tactic, InstallerTactic)]
+        with utils.profiled('prepare', 'phase'):
+            if self.jobs > 1 and len(installers) > 1:
+                utils.parallel_map(self.prepare_installer, installers,
+                                   self.jobs)
+
+    def prepare_installer(self, tactic):
+        with utils.profiled(tactic.__class__.__name__, 'tactic',
+                            phase='prepare', tactic=str(tactic),
+                            layer=self.tactic_source(tactic)):
+            tactic.prepare()
+
+    def exec_phases(self, plan, previous):
+        """
+        Run each phase of the plan in turn, one tactic at a time.
+        """
         signatures = {}
+        fingerprints = {}
+        current = set()
         cont = True
         for phase in self.PHASES:
-            for tactic in plan:
-                if phase == "lint":
-                    cont &= tactic.lint()
+            if phase == "call":
+                self.prepare_installers(plan)
+            with utils.profiled(phase, 'phase'):
+                for tactic in plan:
+                    result = self.exec_phase(phase, tactic, previous,
+                                             current, fingerprints)
+                    if phase == "lint":
+                        cont &= result
+                        if cont is False and self.force is not True:
+                            # no message, reason will already have been
+                            # logged
+                            raise BuildError()
+                    elif phase == "sign" and result:
+                        signatures.update(result)
+        return signatures, fingerprints
+
+    def exec_graph(self, plan, previous):
+        """
+        Lint the whole plan, then run the remaining phases for each tactic
+        on a pool of self.jobs threads, as soon as the tactics it depends on
+        (see plan_dependencies) are done.  The results are the same as
+        those of exec_phases.
+        """
+        signatures = {}
+        fingerprints = {}
+        current = set()
+        if "lint" in self.PHASES:
+            # lint everything up front so nothing is written for a bad plan
+            cont = True
+            with utils.profiled('lint', 'phase'):
+                for tactic in plan:
+                    cont &= self.exec_phase("lint", tactic, previous,
+                                            current, fingerprints)
                     if cont is False and self.force is not True:
-                        # no message, reason will already have been logged
                         raise BuildError()
-                elif phase == "read":
-                    # We use a read (into memory phase to make layer comps
-                    # simpler)
-                    tactic.read()
-                elif phase == "call":
-                    tactic()
-                elif phase == "sign":
-                    sig = tactic.sign()
-                    if sig:
-                        signatures.update(sig)
-        new_repo = not self.manifest.exists()
-        if new_repo:
-            added, changed, removed = set(), set(), set()
-        else:
-            added, changed, _ = utils.delta_signatures(self.manifest)
-            removed = self.clean_removed(signatures)
-        # write out the sigs
-        if "sign" in self.PHASES:
-            self.write_signatures(signatures, layers)
-        if self.report:
-            self.write_report(new_repo, added, changed, removed)
+        phases = [phase for phase in self.PHASES if phase != "lint"]
+        if "call" in phases:
+            self.prepare_installers(plan)
+
+        def run(tactic):
+            sig = None
+            for phase in phases:
+                result = self.exec_phase(phase, tactic, previous,
+                                         current, fingerprints)
+                if phase == "sign":
+                    sig = result
+            return sig
+
+        with utils.profiled('+'.join(phases), 'phase'):
+            results = utils.parallel_graph(
+                run, plan, self.plan_dependencies(plan), self.jobs)
+        # merge in plan order, so later tactics win as they do serially
+        for sig in results:
+            if sig:
+                signatures.update(sig)
+        return signatures, fingerprints
+
+    def exec_phase(self, phase, tactic, previous, current, fingerprints):
+        with utils.profiled(tactic.__class__.__name__, 'tactic',
+                            phase=phase, tactic=str(tactic),
+                            layer=self.tactic_source(tactic)):
+            return self._exec_phase(phase, tactic, previous, current,
+                                    fingerprints)
+
+    def tactic_source(self, tactic):
+        """The layer or interface a tactic comes from, for --profile."""
+        source = getattr(tactic, '_layer', None) or \
+            getattr(tactic, 'interface', None)
+        return source.url if source is not None else self.name
+
+    def _exec_phase(self, phase, tactic, previous, current, fingerprints):
+        if phase == "lint":
+            return tactic.lint()
+        elif phase == "read":
+            # We use a read (into memory phase to make layer comps
+            # simpler)
+            tactic.read()
+            fingerprint = tactic.fingerprint()
+            if fingerprint:
+                fingerprints[tactic.output] = fingerprint
+                if self.is_current(tactic, fingerprint, previous):
+                    current.add(tactic)
+        elif phase == "call":
+            if tactic in current:
+                log.debug("Unchanged, skipping %s", tactic)
+                return
+            tactic()
+        elif phase == "sign":
+            if tactic in current and self.unchanged_output(tactic, previous):
+                return {tactic.output: previous['signatures'][tactic.output]}
+            return tactic.sign()
+
+    def plan_dependencies(self, plan):
+        """
+        Map each tactic in the plan to the tactics that must be run before
+        it when the plan is run in parallel.
+
+        The built-in tactics are independent of each other, except that the
+        hook binds need the hook template and metadata.yaml to be written,
+        and that tactics writing the same file, or a file in a directory
+        another writes, run in plan order.  Any other
+        tactic, such as those provided by layers, is a barrier: it runs
+        after everything before it, and everything after it waits for it.
+        """
+        concurrent = tuple(charmtools.build.tactics.CONCURRENT_TACTICS)
+        hook_inputs = [
+            tactic for tactic in plan
+            if isinstance(tactic, charmtools.build.tactics.MetadataYAML) or
+            (type(tactic) in concurrent and
+             tactic.output == self.HOOK_TEMPLATE_FILE)]
+        requires = {}
+        barrier = None
+        since_barrier = []
+        # the last tactic to write each output, and every tactic to write
+        # something below each directory
+        writers = {}
+        below = {}
+        for tactic in plan:
+            if type(tactic) not in concurrent:
+                reqs = set(since_barrier)
+                if barrier:
+                    reqs.add(barrier)
+                barrier = tactic
+                since_barrier = []
+            else:
+                reqs = set([barrier]) if barrier else set()
+                if isinstance(tactic,
+                              charmtools.build.tactics.DynamicHookBind):
+                    reqs.update(hook_inputs)
+                for output in tactic.outputs:
+                    parents = _parents(output)
+                    reqs.update(writers[p] for p in [output] + parents
+                                if p in writers)
+                    reqs.update(below.get(output, []))
+                for output in tactic.outputs:
+                    writers[output] = tactic
+                    for parent in _parents(output):
+                        below.setdefault(parent, []).append(tactic)
+                reqs.discard(tactic)
+                since_barrier.append(tactic)
+            requires[tactic] = reqs
+        return requires
+
+    def read_manifest(self):
+        if not self.manifest.exists():
+            return {}
+        return json.loads(self.manifest.text())
 
-    def write_signatures(self, signatures, layers):
+    def input_signatures(self, previous):
+        """
+        Return the signatures of the input files recorded in the previous
+        build's manifest, for the tactics to reuse while fingerprinting
+        those that haven't changed since, unless paranoid.
+        """
+        if self.paranoid or not previous:
+            return utils.SignatureCache()
+        return utils.SignatureCache(previous.get('inputs'),
+                                    utils.file_stat(self.manifest)[1])
+
+    def is_current(self, tactic, fingerprint, previous):
+        """
+        Check if the output of a tactic from the previous build can be kept
+        as is, because none of its inputs have changed and it hasn't been
+        modified since.
+        """
+        output = tactic.output
+        return bool(
+            previous.get('fingerprints', {}).get(output) == fingerprint and
+            output in previous.get('signatures', {}) and
+            output not in self.modified and
+            (self.target_dir / output).isfile())
+
+    def unchanged_output(self, tactic, previous):
+        """
+        Check that the output of a skipped tactic is still as the previous
+        build left it, as a later tactic may have replaced or removed it.
+        """
+        output = tactic.output
+        target = self.target_dir / output
+        stat = previous.get('stats', {}).get(output)
+        return bool(stat and target.isfile() and
+                    utils.file_stat(target) == stat)
+
+    def write_signatures(self, signatures, layers, fingerprints=None,
+                         inputs=None):
         signatures['.build.manifest'] = ["build", 'dynamic', 'unchecked']
+        # so the next build can tell which files may have changed cheaply
+        stats = {}
+        for relpath in signatures:
+            target = self.target_dir / relpath
+            if relpath != '.build.manifest' and target.isfile():
+                stats[relpath] = utils.file_stat(target)
         self.manifest.write_text(json.dumps(dict(
             signatures=signatures,
+            fingerprints=fingerprints or {},
+            inputs=inputs or {},
+            stats=stats,
             layers=layers,
         ), indent=2, sort_keys=True))
 
+    def write_archive(self):
+        """
+        Write the files of the built charm listed in its manifest to the
+        zip archive self.archive, which is reproducible (see
+        :func:`charmtools.utils.write_zip`).
+
+        The manifest is included without the stats and fingerprints of the
+        output files, nor the signatures of the input files, which only
+        describe this build's directories.
+        """
+        manifest = json.loads(self.manifest.text())
+        manifest.pop('stats', None)
+        manifest.pop('fingerprints', None)
+        manifest.pop('inputs', None)
+        with utils.profiled('archive', 'phase'):
+            utils.write_zip(self.archive, self.target_dir,
+                            manifest['signatures'], {
+                                '.build.manifest': json.dumps(
+                                    manifest, indent=2, sort_keys=True),
+                            })
+        log.info("Wrote archive: %s", self.archive)
+
+    def read_lock(self):
+        """
+        Load build.lock from the top layer or, failing that, from the
+        previously built charm.
+        """
+        for lock_file in (self.top_layer.directory / self.LOCK_FILE,
+                          self.target_dir / self.LOCK_FILE):
+            if lock_file.exists():
+                log.debug('Using %s', lock_file)
+                return json.loads(lock_file.text())
+        raise BuildError('No {} found in {} or {}'.format(
+            self.LOCK_FILE, self.top_layer.directory, self.target_dir))
+
+    def write_lock(self, plan):
+        """
+        Write out build.lock, pinning every remote layer and interface to the
+        commit that was fetched and every package in the wheelhouse to the
+        version that was downloaded, and return its signature.
+        """
+        lock = {'layers': {}, 'interfaces': {}, 'python_packages': {}}
+        for kind, deps in (('layers', self._layers),
+                           ('interfaces', self._interfaces)):
+            for dep in deps:
+                if dep.repo:
+                    lock[kind][dep.url] = {
+                        'repo': dep.repo,
+                        'commit': dep.revision,
+                    }
+        for tactic in plan:
+            if isinstance(tactic, WheelhouseTactic):
+                lock['python_packages'].update(tactic.pins())
+        data = json.dumps(lock, indent=2, sort_keys=True) + '\n'
+        (self.target_dir / self.LOCK_FILE).write_bytes(data)
+        return {self.LOCK_FILE: ("build", "dynamic",
+                                 hashlib.sha256(data).hexdigest())}
+
     def generate(self):
-        layers = self.fetch()
-        self.formulate_plan(layers)
+        if self.locked:
+            self.lock = self.read_lock()
+        with utils.profiled('fetch', 'phase'):
+            layers = self.fetch()
+        with utils.profiled('plan', 'phase'):
+            self.formulate_plan(layers)
+        if self.locked:
+            for tactic in self.plan:
+                if isinstance(tactic, WheelhouseTactic):
+                    tactic.constraints = self.lock.get('python_packages', {})
         self.exec_plan(self.plan, self.layers)
 
     def validate(self):
@@ -518,7 +1030,8 @@ class Builder(object):
 
         if not self.manifest.exists():
             return [], [], []
-        a, c, d = utils.delta_signatures(self.manifest)
+        a, c, d = utils.delta_signatures(self.manifest, self.paranoid)
+        self.modified = a | c
 
         for f in a:
             log.warn("Conflict: File in destination directory "
@@ -552,20 +1065,177 @@ class Builder(object):
                 msg += ', with a url from which your layer can be cloned.'
             log.warn(msg)
 
+    def prefetch(self):
+        """
+        Fetch the layers and interfaces the charm includes without building
+        it, so that they can be shared with the other charms of a batch.
+        """
+        self.find_or_create_repo()
+        if self.locked:
+            self.lock = self.read_lock()
+        self.fetch_deps(self.top_layer)
+        # metrics are posted when the charm is built
+        self.metrics = []
+
     def __call__(self):
         self.find_or_create_repo()
 
         log.debug(json.dumps(
             self.status(), indent=2, sort_keys=True, default=str))
         self.validate()
-        self.generate()
+        try:
+            self.generate()
+        finally:
+            self.flush_metrics()
+
+    def watched_dirs(self):
+        """
+        The directories of the local layers and interfaces the charm is
+        built from, which --watch looks for changes in.
+        """
+        dirs = []
+        for dep in [self.top_layer] + self._layers + self._interfaces:
+            if not dep.fetched and dep.directory not in dirs:
+                dirs.append(dep.directory)
+        return dirs
+
+    def snapshot(self):
+        """
+        Return {filename: (mtime, size)} of every file in the watched
+        directories, and of any wheelhouse overrides.
+        """
+        files = {}
+        output = self.target_dir.abspath()
+        for directory in self.watched_dirs():
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [d for d in dirnames
+                               if d not in self.WATCH_SKIP and
+                               (path(dirpath) / d).abspath() != output]
+                for name in filenames:
+                    filename = path(dirpath) / name
+                    try:
+                        st = os.lstat(filename)
+                    except OSError:
+                        continue
+                    files[filename] = (st.st_mtime, st.st_size)
+        if self.wheelhouse_overrides and self.wheelhouse_overrides.exists():
+            st = os.stat(self.wheelhouse_overrides)
+            files[self.wheelhouse_overrides] = (st.st_mtime, st.st_size)
+        return files
+
+    def affected_tactics(self, changed):
+        """
+        Return the tactics of the plan that need to be run again for the
+        changed layer files, in plan order, or None if the plan itself may
+        have changed and everything needs to be checked.
+        """
+        if any(f.basename() in self.STRUCTURAL_FILES or
+               f == self.wheelhouse_overrides for f in changed):
+            return None
+        tactics = charmtools.build.tactics
+        affected = set()
+        for tactic in self.plan:
+            inputs = list(self._inputs.get(tactic.output, []))
+            if getattr(tactic, 'entity', None):
+                inputs.append(path(tactic.entity))
+            if isinstance(tactic, tactics.InterfaceCopy):
+                inputs.append(tactic.interface.directory)
+            for f in changed:
+                if any(f == i or f.startswith(i + '/') for i in inputs):
+                    affected.add(tactic)
+                    break
+        # tactics generated from metadata.yaml or the hook template
+        if any(isinstance(t, tactics.MetadataYAML) for t in affected):
+            affected.update(t for t in self.plan if isinstance(
+                t, (tactics.InterfaceBind, tactics.StorageBind)))
+        if any(isinstance(t, tactics.MetadataYAML) or
+               t.output == self.HOOK_TEMPLATE_FILE for t in affected):
+            affected.update(t for t in self.plan if isinstance(
+                t, tactics.DynamicHookBind))
+        return [t for t in self.plan if t in affected]
+
+    def rebuild(self, changed, structural=False):
+        """
+        Rebuild the charm after changes to the files of its local layers,
+        without fetching its layers and interfaces again.
+
+        Only the tactics affected by the changes are run, and their
+        signatures merged into the manifest, unless files were added or
+        removed (``structural``) or the layer configuration changed, in
+        which case the plan is run like a normal, incremental build.
+        """
+        layers = {"layers": self._layers, "interfaces": self._interfaces}
+        for dep in self._layers + self._interfaces:
+            if not dep.fetched:
+                # read layer.yaml and interface.yaml again, in case they
+                # changed; the file cache makes this cheap when they didn't
+                dep._config = BuildConfig()
+        self.formulate_plan(layers)
+        affected = None if structural else self.affected_tactics(changed)
+        if affected is None:
+            log.info("Layers changed, rebuilding")
+            self.exec_plan(self.plan, self.layers)
+            return
+        log.info("Rebuilding %d of %d tactics", len(affected), len(self.plan))
+        for tactic in affected:
+            log.debug("Rebuilding: %s", tactic)
+        previous = self.read_manifest()
+        Tactic.INPUTS = self.input_signatures(previous)
+        signatures, fingerprints = self.exec_phases(affected, previous)
+        if "sign" in self.PHASES:
+            inputs = Tactic.INPUTS.used
+            for key, values in (('signatures', signatures),
+                                ('fingerprints', fingerprints),
+                                ('inputs', inputs)):
+                merged = previous.get(key, {})
+                merged.update(values)
+                values.update(merged)
+            self.write_signatures(signatures, self.layers, fingerprints,
+                                  inputs)
+            if self.archive:
+                self.write_archive()
+
+    def watch_layers(self, interval=None):
+        """
+        Watch the charm's local layers and interfaces after building it,
+        rebuilding it whenever any of their files change, until
+        interrupted.
+
+        Files are polled every ``interval`` seconds, which is cheap for the
+        size of a layer and needs no extra dependencies.
+        """
+        interval = interval or self.WATCH_INTERVAL
+        log.info("Watching %s for changes; press Ctrl-C to stop",
+                 ", ".join(self.watched_dirs()))
+        before = self.snapshot()
+        while True:
+            time.sleep(interval)
+            after = self.snapshot()
+            if after == before:
+                continue
+            added = set(after) - set(before)
+            removed = set(before) - set(after)
+            changed = set(f for f in set(after) & set(before)
+                          if after[f] != before[f])
+            start = time.time()
+            try:
+                self.rebuild(added | removed | changed,
+                             structural=bool(added or removed))
+            except (BuildError, FetchError) as e:
+                if e.args:
+                    log.error(*e.args)
+            else:
+                log.info("Rebuilt in %.2fs", time.time() - start)
+            # pick up our own writes, when building in place
+            before = self.snapshot()
 
     def inspect(self):
         self.charm = path(self.charm).abspath()
         if not self._check_path(self.charm):
             raise BuildError('For security reasons, only paths under '
                              'your home directory can be accessed')
-        inspector.inspect(self.charm, force_styling=self.force_raw)
+        inspector.inspect(self.charm, force_styling=self.force_raw,
+                          paranoid=self.paranoid)
 
     def normalize_outputdir(self):
         od = path(self.charm).abspath()
@@ -579,6 +1249,8 @@ class Builder(object):
         self.output_dir = od
 
     def _check_path(self, path_to_check, need_write=False):
+        if not path_to_check:
+            return
         home_dir = utils.get_home()
         home_msg = ('For security reasons, only paths under your '
                     'home directory can be accessed, including '
@@ -599,6 +1271,8 @@ class Builder(object):
 
     def check_paths(self):
         self._check_path(self.output_dir, need_write=True)
+        if self.archive:
+            self._check_path(self.archive.abspath().parent, need_write=True)
         self._check_path(self.wheelhouse_overrides)
         self._check_path(os.environ.get('JUJU_REPOSITORY'))
         self._check_path(os.environ.get('LAYER_PATH'))
@@ -668,6 +1342,9 @@ def inspect(args=None):
         description='inspect the layers of a built charm')
     parser.add_argument('-r', '--force-raw', action="store_true",
                         help="Force raw output (color)")
+    parser.add_argument('--paranoid', action="store_true",
+                        help="Hash every file to find changes, rather than "
+                             "only those whose size or mtime changed")
     parser.add_argument('-l', '--log-level', default=logging.INFO)
     parser.add_argument('charm', nargs="?", default=".", type=path)
     utils.add_plugin_description(parser)
@@ -715,6 +1392,14 @@ def main(args=None):
         formatter_class=argparse.RawDescriptionHelpFormatter,)
     parser.add_argument('-l', '--log-level', default=logging.INFO)
     parser.add_argument('-f', '--force', action="store_true")
+    parser.add_argument('--paranoid', action="store_true",
+                        help="Hash every file in the output directory to "
+                             "find changes made since the last build, rather "
+                             "than only those whose size or mtime changed")
+    parser.add_argument('--locked', action="store_true",
+                        help="Fetch exactly the layers, interfaces and "
+                             "wheelhouse packages pinned in build.lock, "
+                             "without using the layer index")
     parser.add_argument('-o', '--output-dir', type=path)
     parser.add_argument('-s', '--series', default=None)
     parser.add_argument('--hide-metrics', dest="hide_metrics",
@@ -725,6 +1410,25 @@ def main(args=None):
                         help="Don't use local layers when building. "
                         "Forces included layers to be downloaded "
                         "from the interface service.")
+    parser.add_argument('--cache-dir', type=path,
+                        default=default_cache_dir(),
+                        help="Directory to cache fetched layers, "
+                             "interfaces, layer index lookups, wheelhouse "
+                             "downloads, the wheelhouse build venv and "
+                             ".pypi installs in across builds "
+                             "(default: %(default)s)")
+    parser.add_argument('--no-cache', action="store_true",
+                        help="Don't use or update the cache; always fetch "
+                             "included layers and interfaces, look them "
+                             "up in the layer index, download the "
+                             "wheelhouse and install .pypi packages")
+    parser.add_argument('--link-mode', choices=utils.LINK_MODES,
+                        default='copy',
+                        help="How to put files from layers into the built "
+                             "charm: copy them, hardlink them if they are "
+                             "read-only, reflink them where the filesystem "
+                             "allows, or 'auto' to do both (default: "
+                             "%(default)s)")
     parser.add_argument('-n', '--name',
                         help="Build a charm of 'name' from 'charm'")
     parser.add_argument('-r', '--report', action="store_true",
@@ -732,15 +1436,86 @@ def main(args=None):
     parser.add_argument('-w', '--wheelhouse-overrides', type=path,
                         help="Provide a wheelhouse.txt file with overrides "
                              "for the built wheelhouse")
+    parser.add_argument('--index-url',
+                        help="Base URL of the Python package index to "
+                             "build the wheelhouse from")
+    parser.add_argument('--find-links', action='append', default=[],
+                        help="Extra URL or directory to look for wheelhouse "
+                             "packages in; may be given more than once")
+    parser.add_argument('--binary-wheels', action='store_true',
+                        help="Build binary wheels for the wheelhouse, so "
+                             "units don't have to build them when "
+                             "installing; packages which can't be built "
+                             "are shipped as source")
+    parser.add_argument('--wheel-python', default='python3',
+                        help="Python to build the wheelhouse with, which "
+                             "must match the Python of the charm's target "
+                             "series when using --binary-wheels "
+                             "(default: %(default)s)")
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="Increase output (same as -l DEBUG)")
-    parser.add_argument('charm', nargs="?", default=".", type=path)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of parallel jobs to use when fetching "
+                             "layers, interfaces and wheelhouse packages "
+                             "and when building (default: %(default)s)")
+    parser.add_argument('--watch', action="store_true",
+                        help="After building, watch the charm's local "
+                             "layers and interfaces and rebuild whatever "
+                             "their changes affect, until interrupted")
+    parser.add_argument('--server', action="store_true",
+                        help="Run a build server, which keeps what builds "
+                             "have loaded and fetched in memory; while it "
+                             "runs, charm build hands builds to it")
+    parser.add_argument('--no-server', action="store_true",
+                        help="Build in this process, even if a build "
+                             "server is running")
+    parser.add_argument('--server-socket', type=path,
+                        default=buildclient.default_socket(),
+                        help="Socket of the build server "
+                             "(default: %(default)s)")
+    parser.add_argument('--profile', type=path, metavar='FILE',
+                        help="Record the time, CPU time and I/O of each "
+                             "phase, tactic, fetch and subprocess of the "
+                             "build in FILE, in Chrome's trace event "
+                             "format, and log a summary of the costliest")
+    parser.add_argument('--archive', type=path, metavar='FILE',
+                        help="Also write the built charm to FILE as a zip "
+                             "archive, which is the same, byte for byte, "
+                             "for the same layers and interfaces")
+    parser.add_argument('--archive-only', action="store_true",
+                        help="Only write the --archive, building the charm "
+                             "in a temporary directory")
+    parser.add_argument('--batch', type=path,
+                        help="Build every charm listed in this file, one "
+                             "per line relative to the file, as well as "
+                             "any given as arguments")
+    parser.add_argument('charms', nargs="*", type=path, metavar='charm',
+                        help="Charm to build (default: .); given more than "
+                             "one, their layers and interfaces are fetched "
+                             "once and the charms built in parallel")
     utils.add_plugin_description(parser)
     # Namespace will set the options as attrs of build
     parser.parse_args(args, namespace=build)
+    build.charm = build.charms[0] if build.charms else "."
     if build.charm == "help":
         parser.print_help()
         raise SystemExit(0)
+    charms = list(build.charms)
+    if build.batch:
+        charms.extend(read_batch(build.batch))
+    if len(charms) > 1 and build._name:
+        parser.error("--name can only be used when building one charm")
+    if (len(charms) > 1 or build.batch) and build.watch:
+        parser.error("--watch can only be used when building one charm")
+    if (len(charms) > 1 or build.batch) and build.profile:
+        parser.error("--profile can only be used when building one charm")
+    if (len(charms) > 1 or build.batch) and build.archive:
+        parser.error("--archive can only be used when building one charm")
+    if build.archive_only and not build.archive:
+        parser.error("--archive-only needs --archive")
+    if build.archive_only and (build.watch or build.output_dir):
+        parser.error("--archive-only can't be used with --watch or "
+                     "--output-dir")
 
     if build.verbose:
         build.log_level = logging.DEBUG
@@ -750,10 +1525,54 @@ def main(args=None):
     LayerFetcher.INTERFACE_DOMAIN = build.interface_service
 
     InterfaceFetcher.NO_LOCAL_LAYERS = build.no_local_layers
+    Tactic.LINK_MODE = build.link_mode
+    LocalFetcher.LINK_MODE = build.link_mode
+    index_dir = None if build.no_cache else build.cache_dir / 'layer-index'
+    index = InterfaceFetcher.INDEX
+    if index is None or (index.domain, index.cache_dir) != (
+            build.interface_service, index_dir):
+        # otherwise keep the lookups made by earlier builds in this process
+        InterfaceFetcher.INDEX = LayerIndex(build.interface_service,
+                                            cache_dir=index_dir)
+    if build.no_cache:
+        build.shared_deps = None
+
+    if not build.no_cache:
+        Fetched.CACHE = LayerCache(build.cache_dir / 'layers',
+                                   link_mode=build.link_mode)
+        WheelhouseTactic.CACHE_DIR = build.cache_dir / 'wheelhouse'
+        InstallerTactic.CACHE_DIR = build.cache_dir / 'installer'
+    else:
+        # don't use the caches of an earlier build in this process
+        Fetched.CACHE = None
+        WheelhouseTactic.CACHE_DIR = None
+        InstallerTactic.CACHE_DIR = None
+    WheelhouseTactic.INDEX_URL = build.index_url
+    WheelhouseTactic.JOBS = build.jobs
+    WheelhouseTactic.BINARY_WHEELS = build.binary_wheels
+    WheelhouseTactic.PYTHON = build.wheel_python
+    WheelhouseTactic.FIND_LINKS = build.find_links
 
     configLogging(build)
 
+    if build.server:
+        try:
+            server.serve(build.server_socket)
+        except BuildError as e:
+            log.error(*e.args)
+            raise SystemExit(1)
+        return
+
+    if len(charms) > 1 or build.batch:
+        raise SystemExit(build_batch(parser.parse_args(args), charms))
+
+    if build.profile:
+        utils.PROFILER = Profiler()
     try:
+        if build.archive_only:
+            build.cache_dir.makedirs_p()
+            build.output_dir = path(tempfile.mkdtemp(prefix='build-',
+                                                     dir=build.cache_dir))
         if not build.output_dir:
             build.normalize_outputdir()
         build.check_paths()
@@ -761,24 +1580,174 @@ def main(args=None):
             build.check_series()
 
         build()
-
-        lint, exit_code = proof.proof(build.target_dir, False, False)
-        llog = logging.getLogger("proof")
-
-        if not lint:
-            llog.info('OK!')
-
-        for line in lint:
-            if line[0] == "I":
-                llog.info(line)
-            elif line[0] == "W":
-                llog.warn(line)
-            elif line[0] == "E":
-                llog.error(line)
+        with utils.profiled('proof', 'phase'):
+            report_proof(build.target_dir)
+        if build.watch:
+            build.watch_layers()
     except (BuildError, FetchError) as e:
         if e.args:
             log.error(*e.args)
         raise SystemExit(1)
+    except KeyboardInterrupt:
+        if not build.watch:
+            raise
+    finally:
+        build.wait_for_metrics()
+        if build.archive_only and build.output_dir:
+            build.output_dir.rmtree_p()
+        if build.profile:
+            profiler, utils.PROFILER = utils.PROFILER, None
+            profiler.write(build.profile)
+            log.info('Wrote profile to %s', build.profile)
+            profiler.log_summary()
+
+
+def report_proof(target_dir):
+    lint, exit_code = proof.proof(target_dir, False, False)
+    llog = logging.getLogger("proof")
+
+    if not lint:
+        llog.info('OK!')
+
+    for line in lint:
+        if line[0] == "I":
+            llog.info(line)
+        elif line[0] == "W":
+            llog.warn(line)
+        elif line[0] == "E":
+            llog.error(line)
+
+
+def read_batch(filename):
+    """
+    Return the charms listed in a batch file, one per line relative to the
+    file.  Blank lines and comments starting with # are ignored.
+    """
+    filename = path(filename)
+    charms = []
+    for line in filename.lines(retain=False):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            charms.append(filename.abspath().dirname() / line)
+    return charms
+
+
+# the builders of the current batch, inherited by the pool processes
+_batch = []
+
+
+def _batch_init():
+    # connections to the layer index can't be shared with the parent
+    charmtools.build.index._session = None
+
+
+def _batch_build(i):
+    """
+    Build the i'th charm of the batch, returning the error if it failed
+    (or None), and how long it took.
+    """
+    build = _batch[i]
+    start = time.time()
+    error = None
+    try:
+        build()
+        report_proof(build.target_dir)
+    except (BuildError, FetchError) as e:
+        error = _error_message(e)
+    except SystemExit as e:
+        # e.g. from a failed pip command, which has already been logged
+        error = 'exited with status {}'.format(e.code)
+    except Exception as e:
+        log.exception('Unable to build %s', build.charm)
+        error = _error_message(e)
+    finally:
+        build.wait_for_metrics()
+    return error, time.time() - start
+
+
+def _error_message(e):
+    if not e.args:
+        return e.__class__.__name__
+    try:
+        return e.args[0] % e.args[1:] if len(e.args) > 1 else str(e.args[0])
+    except TypeError:
+        return ' '.join(str(arg) for arg in e.args)
+
+
+def _parents(relpath):
+    """The directories containing relpath, innermost first."""
+    parents = []
+    relpath = os.path.dirname(relpath)
+    while relpath:
+        parents.append(relpath)
+        relpath = os.path.dirname(relpath)
+    return parents
+
+
+def build_batch(options, charms):
+    """
+    Build several charms with the same options, and return the exit code.
+
+    The layers and interfaces included by all of the charms are fetched
+    once up front, and shared by each charm's Builder.  The charms are then
+    built by a pool of up to ``options.jobs`` processes, forked so that they
+    inherit the fetched layers, and which share the jobs between them.  A
+    summary of which charms were built is logged at the end, and the exit
+    code is 1 if any of them failed.
+    """
+    shared_deps = Builder.SHARED_DEPS if Builder.SHARED_DEPS is not None \
+        else {}
+    results = OrderedDict((charm, None) for charm in charms)
+    del _batch[:]
+    for charm in charms:
+        build = Builder()
+        for key, value in vars(options).items():
+            setattr(build, key, value)
+        build.charm = charm
+        build.shared_deps = shared_deps
+        try:
+            if not build.output_dir:
+                build.normalize_outputdir()
+            build.check_paths()
+            if not build.series:
+                build.check_series()
+            build.prefetch()
+        except (BuildError, FetchError) as e:
+            log.error('Unable to fetch the layers of %s: %s',
+                      charm, _error_message(e))
+            results[charm] = (_error_message(e), 0)
+        else:
+            _batch.append(build)
+
+    processes = min(options.jobs, len(_batch))
+    if processes > 1:
+        # rather than each of them running jobs threads of its own
+        jobs = max(1, options.jobs // processes)
+        WheelhouseTactic.JOBS = jobs
+        for build in _batch:
+            build.jobs = jobs
+        pool = multiprocessing.Pool(processes, initializer=_batch_init)
+        try:
+            built = pool.map(_batch_build, range(len(_batch)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        built = [_batch_build(i) for i in range(len(_batch))]
+    for build, result in zip(_batch, built):
+        results[build.charm] = result
+    del _batch[:]
+
+    failed = [charm for charm, (error, _) in results.items() if error]
+    log.info('')
+    log.info('Built %d of %d charms:',
+             len(results) - len(failed), len(results))
+    for charm, (error, elapsed) in results.items():
+        if error:
+            log.error('  FAILED %s: %s', charm, error)
+        else:
+            log.info('  OK     %s (%.1fs)', charm, elapsed)
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,290 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+
+from path import Path as path
+from charmtools import utils
+from charmtools.build.fetchers import InterfaceFetcher
+from charmtools.build.index import LayerIndex
+from charmtools.fetchers import (
+    check_output,
+    FetchError,
+)
+
+log = logging.getLogger(__name__)
+
+COMMIT_RE = re.compile(r'^[0-9a-f]{40}$')
+SHORT_COMMIT_RE = re.compile(r'^[0-9a-f]{7,39}$')
+
+
+def default_cache_dir():
+    """
+    Return the user level cache directory for charm-tools, honoring
+    ``XDG_CACHE_HOME``.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or '~/.cache'
+    return path(base).expanduser() / 'charm-tools'
+
+
+class LayerCache(object):
+    """
+    Persistent, content addressed cache of fetched layer and interface repos
+    that is shared across builds.
+
+    Entries are keyed by the canonical git url of the repo plus the commit
+    that was fetched, so an entry never goes stale; a repo is only cloned
+    again when its remote moves on.  Each entry has a small JSON sidecar
+    recording its url, revision, size and when it was last used, which is
+    used to evict entries that are too old, or the least recently used ones
+    when the cache grows too large.  Builds sharing the cache take a lock on
+    it, shared while they copy entries out and exclusive while they add or
+    evict them.
+
+    The commits that branches and tags point to are remembered for ``ttl``
+    seconds, as long as layer index lookups are, so that builds with a warm
+    cache don't need the network.
+    """
+    MAX_SIZE = 2 * 1024 ** 3  # bytes
+    MAX_AGE = 30 * 24 * 60 * 60  # seconds
+    TTL = LayerIndex.TTL
+
+    def __init__(self, directory, max_size=MAX_SIZE, max_age=MAX_AGE,
+                 link_mode='copy', ttl=TTL):
+        self.directory = path(directory)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.link_mode = link_mode
+        self.ttl = ttl
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.directory)
+
+    @staticmethod
+    def key(url, revision):
+        return hashlib.sha256('{}@{}'.format(url, revision)).hexdigest()
+
+    def entry(self, key):
+        return self.directory / key
+
+    def _sidecar(self, key):
+        return self.directory / key + '.json'
+
+    @contextmanager
+    def _lock(self, shared=False):
+        self.directory.makedirs_p()
+        with open(self.directory / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    def _read_sidecar(self, key):
+        """Return the sidecar data of key, or None if it is missing."""
+        try:
+            return json.loads(self._sidecar(key).text())
+        except (IOError, OSError, ValueError):
+            # missing, or corrupt from an interrupted write
+            return None
+
+    def _entries(self):
+        if not self.directory.exists():
+            return []
+        entries = []
+        for sidecar in self.directory.files('*.json'):
+            data = self._read_sidecar(sidecar.namebase)
+            if data is not None:
+                entries.append(data)
+        return entries
+
+    def _write_json(self, filename, data):
+        # write a whole new file, so readers never see a partial one
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.sidecar-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.rename(tmp, filename)
+
+    def _touch(self, key, **info):
+        data = self._read_sidecar(key) or {'key': key}
+        data.update(info)
+        data['last_used'] = time.time()
+        self._write_json(self._sidecar(key), data)
+
+    def _resolved(self):
+        """Return the {'url revision': [commit, when]} resolved so far."""
+        try:
+            return json.loads((self.directory / '.resolved').text())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def resolve(self, url, revision=None):
+        """
+        Return the commit that ``revision`` (or HEAD) of the repo at ``url``
+        currently points to, without cloning it.  Annotated tags are peeled
+        to the commit they tag.
+        """
+        if revision and COMMIT_RE.match(revision):
+            return revision
+        revision = revision or 'HEAD'
+        name = '{} {}'.format(url, revision)
+        now = time.time()
+        recent = self._resolved().get(name)
+        if recent and 0 <= now - recent[1] < self.ttl:
+            return recent[0]
+        # ask for the peeled tag as well, which ls-remote only lists for
+        # some protocols when it isn't named
+        out = check_output('git ls-remote {0} {1} {1}^{{}}'.format(
+            url, revision))
+        commit = None
+        for line in out.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and COMMIT_RE.match(parts[0]):
+                if parts[1].endswith('^{}'):
+                    return parts[0]
+                commit = commit or parts[0]
+        if not commit:
+            # a short commit hash, or something ls-remote doesn't know
+            return revision if revision != 'HEAD' else None
+        self.directory.makedirs_p()
+        resolved = dict((k, v) for k, v in self._resolved().items()
+                        if 0 <= now - v[1] < self.ttl)
+        resolved[name] = [commit, now]
+        self._write_json(self.directory / '.resolved', resolved)
+        return commit
+
+    def lookup(self, url, revision):
+        """
+        Return the cached entry for url at the commit revision, which may
+        be abbreviated, if there is one.
+        """
+        if not revision:
+            return None
+        if COMMIT_RE.match(revision):
+            keys = [self.key(url, revision)]
+        elif SHORT_COMMIT_RE.match(revision):
+            keys = [e['key'] for e in self._entries()
+                    if e.get('url') == url and
+                    e.get('revision', '').startswith(revision)]
+        else:
+            return None
+        for key in keys:
+            if self.entry(key).isdir() and \
+                    self._read_sidecar(key) is not None:
+                return key
+        return None
+
+    def latest(self, url):
+        """Return the most recently used cached entry for url, if any."""
+        entries = [e for e in self._entries()
+                   if e.get('url') == url and self.entry(e['key']).isdir()]
+        if not entries:
+            return None
+        return max(entries, key=lambda e: e.get('last_used', 0))['key']
+
+    def add(self, fetcher, url):
+        """
+        Clone the repo for ``fetcher`` into the cache and return its key.
+        """
+        self.directory.makedirs_p()
+        # fetch next to the entries so the final rename is atomic
+        tmp = path(tempfile.mkdtemp(dir=self.directory, prefix='.fetch-'))
+        try:
+            fetched = path(fetcher.fetch(tmp))
+            # the commit fetched, whatever the fetcher was asked for
+            revision = fetcher.get_revision(fetched).strip()
+            key = self.key(url, revision)
+            entry = self.entry(key)
+            with self._lock():
+                if not entry.exists() or self._read_sidecar(key) is None:
+                    entry.rmtree_p()
+                    fetched.rename(entry)
+                    size = sum(f.size for f in entry.walkfiles())
+                    self._touch(key, url=url, revision=revision, size=size)
+            log.debug('Cached %s@%s as %s', url, revision, key)
+        finally:
+            tmp.rmtree_p()
+        self.prune(keep=key)
+        return key
+
+    def fetch(self, fetcher, dir_):
+        """
+        Materialize the repo that an index fetcher (see
+        :class:`charmtools.build.fetchers.InterfaceFetcher`) points at into
+        ``dir_``, cloning it into the cache only if it isn't there yet.
+
+        Returns the directory the repo was placed in, or None if the repo
+        can't be cached and should be fetched directly, as with layers
+        included by the url of their repo.
+        """
+        if not isinstance(fetcher, InterfaceFetcher) or \
+                not getattr(fetcher, 'repo', None):
+            return None
+        repo_fetcher, target = fetcher._get_repo_fetcher_and_target(
+            fetcher.repo, dir_)
+        url = repo_fetcher.git_url
+        if not url:
+            return None
+        if repo_fetcher.revision:
+            # pinned, maybe to an abbreviated commit, which ls-remote
+            # can't resolve anyway
+            with self._lock(shared=True):
+                key = self.lookup(url, repo_fetcher.revision)
+                if key is not None:
+                    log.debug('Using cached %s@%s', url,
+                              repo_fetcher.revision)
+                    return self._copy(key, target)
+        try:
+            revision = self.resolve(url, repo_fetcher.revision)
+        except FetchError as e:
+            log.debug(e)
+            with self._lock(shared=True):
+                key = self.latest(url)
+                if key is None:
+                    raise
+                log.warn('Unable to reach %s, using cached copy', url)
+                return self._copy(key, target)
+        with self._lock(shared=True):
+            key = self.lookup(url, revision)
+            if key is not None:
+                log.debug('Using cached %s@%s', url, revision)
+                return self._copy(key, target)
+        key = self.add(repo_fetcher, url)
+        with self._lock(shared=True):
+            return self._copy(key, target)
+
+    def _copy(self, key, target):
+        self._touch(key)
+        target.rmtree_p()
+        # never hardlink from an entry, which a change to the charm built
+        # from the layer would then corrupt for later builds
+        mode = 'reflink' if self.link_mode in ('reflink', 'auto') else 'copy'
+        utils.copy_tree(self.entry(key), target, mode)
+        return target
+
+    def prune(self, keep=None):
+        """
+        Evict entries not used within max_age, then the least recently used
+        entries until the cache fits within max_size.
+        """
+        with self._lock():
+            self._prune(keep)
+
+    def _prune(self, keep):
+        now = time.time()
+        entries = sorted(self._entries(),
+                         key=lambda e: e.get('last_used', 0))
+        total = sum(e.get('size', 0) for e in entries)
+        for e in entries:
+            if e['key'] == keep:
+                continue
+            expired = now - e.get('last_used', 0) > self.max_age
+            if not expired and total <= self.max_size:
+                continue
+            log.debug('Evicting %s@%s from the layer cache',
+                      e.get('url'), e.get('revision'))
+            self.entry(e['key']).rmtree_p()
+            self._sidecar(e['key']).remove_p()
+            total -= e.get('size', 0)
@@ -1,11 +1,13 @@
 from .tactics import load_tactic
 
 
-from ruamel import yaml
 import logging
+import yaml
 from path import Path as path
 from otherstuf import chainstuf
 
+from charmtools import utils
+
 DEFAULT_IGNORES = [
     ".bzr",
     ".git",
@@ -50,9 +52,11 @@ class BuildConfig(chainstuf):
         if not config_file.exists() and not allow_missing:
             raise OSError("Missing Config File {}".format(config_file))
         try:
-            if config_file.exists() and config_file.text('utf-8').strip() != "":
-                data = yaml.safe_load(config_file.open(encoding='utf-8'))
-                self.configured = True
+            if config_file.exists():
+                text = config_file.bytes()
+                if text.strip():
+                    data = utils.load_yaml(config_file, text)
+                    self.configured = True
         except yaml.parser.ParserError:
             logging.critical("Malformed Config file: {}".format(config_file))
             raise
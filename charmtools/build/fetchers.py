@@ -1,8 +1,8 @@
 import os
 import logging
 
-import requests
 from charmtools import fetchers
+from charmtools.build.index import LayerIndex
 from charmtools.fetchers import (git,  # noqa
                                  Fetcher,
                                  get_fetcher,
@@ -37,6 +37,14 @@ class InterfaceFetcher(fetchers.LocalFetcher):
     OPTIONAL_PREFIX = "juju-relation-"
     ENDPOINT = "interfaces"
     NO_LOCAL_LAYERS = False
+    INDEX = None
+
+    @classmethod
+    def index(cls):
+        """Return the :class:`LayerIndex` to look names up in."""
+        if cls.INDEX is None or cls.INDEX.domain != cls.INTERFACE_DOMAIN:
+            return LayerIndex(cls.INTERFACE_DOMAIN)
+        return cls.INDEX
 
     @classmethod
     def can_fetch(cls, url):
@@ -60,19 +68,12 @@ class InterfaceFetcher(fetchers.LocalFetcher):
             choices = [name]
             if name.startswith(cls.OPTIONAL_PREFIX):
                 choices.append(name[len(cls.OPTIONAL_PREFIX):])
+            index = cls.index()
             for choice in choices:
-                uri = "%s%s/%s.json" % (
-                    cls.INTERFACE_DOMAIN, cls.ENDPOINT, choice)
-                log.debug('Checking layer index: {}'.format(uri))
-                try:
-                    result = requests.get(uri)
-                except:
-                    result = None
-                if result and result.ok:
-                    result = result.json()
-                    if result.get("repo"):
-                        log.debug('Found repo: {}'.format(result['repo']))
-                        return result
+                result = index.get(cls.ENDPOINT, choice)
+                if result and result.get("repo"):
+                    log.debug('Found repo: {}'.format(result['repo']))
+                    return result
             return {}
 
     def target(self, dir_):
@@ -100,6 +101,9 @@ class InterfaceFetcher(fetchers.LocalFetcher):
         """
         u = self.url[len(self.NAMESPACE) + 1:]
         f = get_fetcher(repo)
+        if self.revision:
+            # pinned, e.g. by build.lock
+            f.revision = self.revision
         return f, path(dir_) / u
 
     def fetch(self, dir_):
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+import requests
+from path import Path as path
+
+from charmtools import utils
+
+log = logging.getLogger(__name__)
+
+_session = None
+
+
+def session():
+    """
+    Return the :class:`requests.Session` shared by all index lookups, so
+    that connections to the index are kept alive between requests.
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+class LayerIndex(object):
+    """
+    Client for the layer index web service, which maps ``layer:`` and
+    ``interface:`` names to the repos they can be fetched from.
+
+    Responses are remembered by the client for ``ttl`` seconds and, if a
+    ``cache_dir`` is given, stored on disk for as long.  Names that the
+    index doesn't know about are cached as well, since a lookup is usually
+    repeated with and without an optional prefix.  Once an entry is
+    stale it is revalidated with a conditional GET, and if the index can't
+    be reached at all the stale entry is used instead.
+    """
+    TTL = 60 * 60  # seconds
+    TIMEOUT = 10  # seconds
+
+    def __init__(self, domain, cache_dir=None, ttl=TTL, timeout=TIMEOUT):
+        self.domain = domain
+        self.cache_dir = path(cache_dir) if cache_dir else None
+        self.ttl = ttl
+        self.timeout = timeout
+        self._results = {}
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.domain)
+
+    def url(self, endpoint, name):
+        return "%s%s/%s.json" % (self.domain, endpoint, name)
+
+    def _cache_file(self, endpoint, name):
+        if not self.cache_dir:
+            return None
+        domain = re.sub(r'[^\w.-]+', '_', self.domain).strip('_')
+        return self.cache_dir / domain / endpoint / name + '.json'
+
+    def _read(self, cache_file):
+        if not cache_file or not cache_file.exists():
+            return None
+        try:
+            return json.loads(cache_file.text())
+        except ValueError:
+            return None
+
+    def _write(self, cache_file, entry):
+        if not cache_file:
+            return
+        cache_file.parent.makedirs_p()
+        # write then rename, so that parallel builds never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=cache_file.parent, prefix='.')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+        path(tmp).rename(cache_file)
+
+    def get(self, endpoint, name):
+        """
+        Return the index entry for ``name`` in ``endpoint`` (``layers`` or
+        ``interfaces``) as a dict, or None if there isn't one.
+        """
+        key = (endpoint, name)
+        result = self._results.get(key)
+        # a long lived client, like the build server, checks again after ttl
+        if result is None or time.time() - result[0] >= self.ttl:
+            with utils.profiled(name, 'index', endpoint=endpoint):
+                result = self._results[key] = (time.time(),
+                                               self._get(endpoint, name))
+        return result[1]
+
+    def _get(self, endpoint, name):
+        uri = self.url(endpoint, name)
+        cache_file = self._cache_file(endpoint, name)
+        cached = self._read(cache_file)
+        if cached and time.time() - cached.get('fetched', 0) < self.ttl:
+            log.debug('Using cached layer index entry: {}'.format(uri))
+            return cached.get('data')
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        log.debug('Checking layer index: {}'.format(uri))
+        try:
+            result = session().get(uri, headers=headers,
+                                   timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            log.debug('Unable to reach layer index: {}'.format(e))
+            return cached.get('data') if cached else None
+        if result.status_code == 304 and cached:
+            entry = cached
+        elif result.ok:
+            try:
+                data = result.json()
+            except ValueError:
+                data = None
+            entry = {
+                'data': data,
+                'etag': result.headers.get('ETag'),
+                'last_modified': result.headers.get('Last-Modified'),
+            }
+        elif result.status_code == 404:
+            entry = {'data': None}
+        else:
+            # a server error says nothing about the entry, so keep what we had
+            return cached.get('data') if cached else None
+        entry['fetched'] = time.time()
+        self._write(cache_file, entry)
+        return entry['data']
@@ -1,6 +1,5 @@
 # coding=utf-8
 import json
-from ruamel import yaml
 from charmtools.build import config
 from charmtools import utils
 
@@ -37,15 +36,15 @@ def get_prefix(walk, cur, depth, next_depth):
     return "{}{}".format("".join(guide), prefix)
 
 
-def inspect(charm, force_styling=False):
+def inspect(charm, force_styling=False, paranoid=False):
     tw = utils.TermWriter(force_styling=force_styling)
     manp = charm / ".build.manifest"
     comp = charm / "layer.yaml"
     if not manp.exists() or not comp.exists():
         return
     manifest = json.loads(manp.text())
-    composer = yaml.safe_load(comp.open())
-    a, c, d = utils.delta_signatures(manp)
+    composer = utils.load_yaml(comp)
+    a, c, d = utils.delta_signatures(manp, paranoid)
 
     # ordered list of layers used for legend
     layers = list(manifest['layers'])
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger("build")
+
+# resource.RUSAGE_THREAD is only defined from Python 3.2, but Linux has
+# supported it for longer
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                        1 if sys.platform.startswith('linux')
+                        else resource.RUSAGE_SELF)
+
+
+class Profiler(object):
+    """
+    Records the spans of time spent in each part of a build, for
+    ``charm build --profile``.
+
+    Each span has its wall time, CPU time and the bytes read and written
+    in it.  CPU time and bytes are those of the thread the span ran in, so
+    they are not muddled by the other jobs of a parallel build; the CPU
+    time of subprocesses which finished during the span is added to it,
+    which is only exact for serial builds (``-j 1``).
+
+    The spans can be written out in Chrome's trace event format, to be
+    loaded in chrome://tracing or https://ui.perfetto.dev, and summarized
+    as a table of where the time went.
+    """
+    def __init__(self):
+        self.events = []
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """
+        Record the time spent in the with block as the span name, in the
+        category cat, with args as its details.
+        """
+        start = self._sample()
+        try:
+            yield
+        finally:
+            end = self._sample()
+            args['cpu'] = end[1] - start[1]
+            if start[2] is not None and end[2] is not None:
+                # reading the start sample is counted in the end sample
+                args['read'] = end[2] - start[2] - start[4]
+                args['written'] = end[3] - start[3]
+            with self._lock:
+                tid = self._threads.setdefault(
+                    threading.current_thread().name, len(self._threads) + 1)
+                self.events.append({
+                    'name': name,
+                    'cat': cat,
+                    'ph': 'X',
+                    'ts': int((start[0] - self._start) * 1e6),
+                    'dur': int((end[0] - start[0]) * 1e6),
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': args,
+                })
+
+    @staticmethod
+    def _sample():
+        """
+        Return the current (wall time, CPU time, bytes read, bytes written,
+        bytes read to find out).
+        """
+        wall = time.time()
+        thread = resource.getrusage(RUSAGE_THREAD)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = thread.ru_utime + thread.ru_stime + \
+            children.ru_utime + children.ru_stime
+        try:
+            with open('/proc/thread-self/io') as fp:
+                data = fp.read()
+        except IOError:
+            return wall, cpu, None, None, 0
+        io = dict(line.split(': ', 1) for line in data.splitlines())
+        return wall, cpu, int(io['rchar']), int(io['wchar']), len(data)
+
+    def trace(self):
+        """The recorded spans as a Chrome trace."""
+        metadata = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': {'name': name},
+        } for name, tid in self._threads.items()]
+        return {
+            'traceEvents': metadata + sorted(self.events,
+                                             key=lambda e: e['ts']),
+            'displayTimeUnit': 'ms',
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.trace(), fp, indent=1, sort_keys=True)
+
+    def summary(self):
+        """
+        Total up the spans by category and name, and the tactics also by
+        the layer they came from, as a list of (category, name, count,
+        wall, cpu, read, written) rows, most costly first.
+        """
+        totals = {}
+        for event in self.events:
+            keys = [(event['cat'], event['name'])]
+            if event['cat'] == 'tactic':
+                keys.append(('layer', event['args'].get('layer')))
+            for key in keys:
+                row = totals.setdefault(key, [0, 0.0, 0.0, 0, 0])
+                row[0] += 1
+                row[1] += event['dur'] / 1e6
+                row[2] += event['args']['cpu']
+                row[3] += event['args'].get('read', 0)
+                row[4] += event['args'].get('written', 0)
+        rows = [key + tuple(total) for key, total in totals.items()]
+        return sorted(rows, key=lambda row: (-row[3], row[0], row[1]))
+
+    def log_summary(self, limit=40):
+        """Log the most costly rows of the summary as a table."""
+        rows = self.summary()
+        log.info('%-8s %-40s %6s %9s %9s %9s %9s', 'what', 'name', 'count',
+                 'wall', 'cpu', 'read', 'written')
+        for cat, name, count, wall, cpu, read, written in rows[:limit]:
+            log.info('%-8s %-40s %6d %8.3fs %8.3fs %9s %9s', cat,
+                     _truncate(name, 40), count, wall, cpu,
+                     _size(read), _size(written))
+        if len(rows) > limit:
+            log.info('... and %d more, see the trace', len(rows) - limit)
+
+
+def _truncate(text, width):
+    text = u'{}'.format(text)
+    if len(text) <= width:
+        return text
+    return u'...' + text[-(width - 3):]
+
+
+def _size(n):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return '{:.0f}{}'.format(n, unit) if unit == 'B' \
+                else '{:.1f}{}'.format(n, unit)
+        n /= 1024.0
+    return '{:.1f}GiB'.format(n)
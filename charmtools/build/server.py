@@ -0,0 +1,238 @@
+import codecs
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import SocketServer
+from contextlib import contextmanager
+
+from path import Path as path
+
+from charmtools import buildclient, utils
+from charmtools.build.errors import BuildError
+from charmtools.build.index import LayerIndex
+
+log = logging.getLogger("build")
+
+
+class ClientOutput(object):
+    """
+    File-like object which sends everything written to it to the client
+    of a build request.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        self.wfile.write(json.dumps({'out': data}) + '\n')
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+class FDOutput(object):
+    """
+    File-like object which writes straight to a file descriptor, so that
+    what is written to it stays in order with what subprocesses write.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _pump(fd, output):
+    """Copy everything read from fd to output, until it is closed."""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    while True:
+        data = os.read(fd, 65536)
+        text = decoder.decode(data, final=not data)
+        try:
+            if text:
+                output.write(text)
+                output.flush()
+        except socket.error:
+            # keep reading once the client has gone, so writers don't block
+            pass
+        if not data:
+            break
+
+
+@contextmanager
+def redirected_output(output):
+    """
+    Send everything written to stdout and stderr, by this process or the
+    subprocesses it runs, such as pip and git, to output.
+    """
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+    read_fd, write_fd = os.pipe()
+    saved = [os.dup(fd) for fd in (1, 2)]
+    pump = threading.Thread(target=_pump, args=(read_fd, output))
+    pump.daemon = True
+    pump.start()
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        sys.stdout = sys.stderr = FDOutput(1)
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        for fd, copy in zip((1, 2), saved):
+            os.dup2(copy, fd)
+            os.close(copy)
+        os.close(write_fd)
+        pump.join()
+        os.close(read_fd)
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handle a request from :func:`charmtools.buildclient.forward`: a line of
+    JSON with the ``args``, ``cwd`` and ``env`` to build with, answered by
+    lines of JSON with the ``out``-put and finally the ``exit`` code.
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        exit_code = self.server.build(request, ClientOutput(self.wfile))
+        try:
+            self.wfile.write(json.dumps({'exit': exit_code}) + '\n')
+        except socket.error:
+            log.debug('Client went away before the build finished')
+
+
+class BuildServer(SocketServer.UnixStreamServer):
+    """
+    Server for ``charm build`` requests, which runs them one at a time in
+    its own process.
+
+    Much of what one build caches in memory is then still there for the
+    next: the imported modules, layer index lookups and the remote layers
+    and interfaces already fetched, which are reused until the layer index
+    would be checked again.  The parsed YAML files, ignore matchers and
+    tactics of the layers are only kept for the one build.
+    """
+    def __init__(self, socket_path):
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               BuildRequestHandler)
+        self.shared_deps = {}
+        self._deps_since = time.time()
+
+    def prune_deps(self):
+        """
+        Forget the layers and interfaces fetched by earlier builds once
+        they are as old as a layer index lookup can be, as well as any
+        local ones, which are cheap to find and may have changed.
+        """
+        if time.time() - self._deps_since >= LayerIndex.TTL:
+            self.shared_deps.clear()
+            self._deps_since = time.time()
+        for key, dep in list(self.shared_deps.items()):
+            if not dep.fetched or not dep.directory.exists():
+                del self.shared_deps[key]
+
+    def build(self, request, output):
+        """
+        Run ``charm build`` with the request's arguments, working directory
+        and environment, sending its output to the client, and return its
+        exit code.
+        """
+        with redirected_output(output):
+            return self._build(request)
+
+    def _build(self, request):
+        from charmtools.build import builder, tactics
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        root_logger = logging.getLogger()
+        handlers, level = list(root_logger.handlers), root_logger.level
+        self.prune_deps()
+        # forget the files and ignore lists of earlier builds, which may
+        # have been of other charms, so the caches don't grow with each one
+        utils._parsed_yaml.clear()
+        utils._ignore_matchers.clear()
+        builder.Builder.SHARED_DEPS = self.shared_deps
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            builder.main(request['args'])
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            sys.stderr.write('{}\n'.format(e.code))
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            builder.Builder.SHARED_DEPS = None
+            tactics.TacticIndex.clear()
+            root_logger.handlers[:] = handlers
+            root_logger.setLevel(level)
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+
+
+def serve(socket_path=None):
+    """
+    Run a build server on socket_path until interrupted.  The socket is
+    only accessible to the current user.
+    """
+    socket_path = path(socket_path or buildclient.default_socket())
+    socket_path.parent.makedirs_p()
+    if socket_path.exists():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            # left behind by a server that didn't shut down
+            socket_path.remove()
+        else:
+            raise BuildError('A build server is already running on '
+                             '{}'.format(socket_path))
+        finally:
+            sock.close()
+    umask = os.umask(0o077)
+    try:
+        server = BuildServer(socket_path)
+    finally:
+        os.umask(umask)
+    log.info('Build server listening on %s; press Ctrl-C to stop',
+             socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        socket_path.remove_p()
@@ -1,9 +1,13 @@
+import fcntl
+import hashlib
 import json
 import jsonschema
 import logging
 import os
+import re
 import tempfile
-from inspect import getargspec
+from collections import OrderedDict
+from inspect import getargspec, getsourcefile
 
 from path import Path as path
 from ruamel import yaml
@@ -27,6 +31,9 @@ class Tactic(object):
     """
     kind = "static"  # used in signatures
     _warnings = {}  # deprecation warnings we've shown
+    LINK_MODE = 'copy'  # how files are materialized; see utils.copy_file
+    # signatures of the input files fingerprinted by this build
+    INPUTS = utils.SignatureCache()
 
     @classmethod
     def get(cls, entity, target, layer, next_config, existing_tactic):
@@ -34,16 +41,16 @@ class Tactic(object):
         Factory method to get an instance of the correct Tactic to handle the
         given entity.
         """
-        for candidate in next_config.tactics + DEFAULT_TACTICS:
-            argspec = getargspec(candidate.trigger)
-            if len(argspec.args) == 2:
-                # old calling convention
+        relpath = entity.relpath(layer.directory)
+        index = TacticIndex.get(next_config.tactics + DEFAULT_TACTICS)
+        for candidate in index.candidates(relpath):
+            if index.old_convention(candidate):
                 name = candidate.__name__
                 if name not in Tactic._warnings:
                     Tactic._warnings[name] = True
                     log.warn(
                         'Deprecated method signature for trigger in %s', name)
-                args = [entity.relpath(layer.directory)]
+                args = [relpath]
             else:
                 # new calling convention
                 args = [entity, target, layer, next_config]
@@ -93,6 +100,19 @@ class Tactic(object):
         target = self.target.directory / self.relpath
         return target
 
+    @property
+    def output(self):
+        """The path of the output file relative to the target layer"""
+        return self.target_file.relpath(self.target.directory)
+
+    @property
+    def outputs(self):
+        """
+        The paths of the files written by this tactic relative to the target
+        layer; a directory stands for everything in it.
+        """
+        return [self.output] if self.output else []
+
     @property
     def layer_name(self):
         return self.layer.name
@@ -131,9 +151,70 @@ class Tactic(object):
         if target.exists() and target.isfile():
             sig[self.relpath] = (self.layer.url,
                                  self.kind,
-                                 utils.sign(self.target_file))
+                                 self.signature(self.target_file))
         return sig
 
+    def written(self, target, digest):
+        """
+        Record the SHA256 of a file this tactic has just written, so that
+        signing it doesn't need to read it back.
+        """
+        st = os.stat(target)
+        self.__dict__.setdefault('_written', {})[path(target)] = (
+            digest, st.st_size, st.st_mtime, st.st_ino)
+
+    def signature(self, target):
+        """
+        Return the SHA256 of a file in the target, using the one recorded
+        when this tactic wrote it, as long as the file hasn't changed since.
+        """
+        written = self.__dict__.get('_written', {}).get(path(target))
+        if written:
+            st = os.stat(target)
+            if written[1:] == (st.st_size, st.st_mtime, st.st_ino):
+                return written[0]
+        return utils.sign(target)
+
+    def signatures(self, targets):
+        """
+        Return the :meth:`signature` of each of targets, hashing any that
+        weren't signed as they were written in parallel.
+        """
+        targets = list(targets)
+        sigs = {}
+        unknown = []
+        for target in targets:
+            written = self.__dict__.get('_written', {}).get(path(target))
+            if written and target.isfile():
+                sigs[target] = self.signature(target)
+            else:
+                unknown.append(target)
+        sigs.update(zip(unknown, utils.sign_files(unknown)))
+        return [sigs[target] for target in targets]
+
+    def fingerprint(self):
+        """
+        Return a digest of all of the inputs to this tactic's output file,
+        or None if the tactic must be run on every build.
+
+        If the fingerprint matches the one recorded for the output in the
+        previous build's manifest, and the output hasn't been modified since,
+        the builder will skip calling and signing the tactic.
+        """
+        return None
+
+    def _fingerprint(self, *inputs):
+        cls = type(self)
+        data = ['{}.{}'.format(cls.__module__, cls.__name__)]
+        if cls.__module__ != __name__:
+            # the code of tactics provided by layers is an input as well
+            source = getsourcefile(cls)
+            if source:
+                data.append(self.INPUTS.sign(source))
+        data.extend(inputs)
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, default=str)).hexdigest()
+
     def lint(self):
         return True
 
@@ -177,6 +258,13 @@ class IgnoreTactic(Tactic):
         """
         pass
 
+    def sign(self):
+        """
+        Nothing is written, so any file left by a previous build is not
+        part of this one.
+        """
+        return {}
+
 
 class ExcludeTactic(Tactic):
     """
@@ -213,6 +301,13 @@ class ExcludeTactic(Tactic):
         """
         pass
 
+    def sign(self):
+        """
+        Nothing is written, so any file left by a previous build is not
+        part of this one.
+        """
+        return {}
+
 
 class CopyTactic(Tactic):
     def __call__(self):
@@ -227,20 +322,41 @@ class CopyTactic(Tactic):
                 or not self.entity.samefile(target):
             data = self.read()
             if data:
+                utils.unlink_output(target)
                 target.write_bytes(data)
                 self.entity.copymode(target)
+                self.written(target, hashlib.sha256(data).hexdigest())
+            elif getattr(self, '_entity_sig', None):
+                # already signed when fingerprinted
+                utils.copy_file(self.entity, target, self.LINK_MODE)
+                self.written(target, self._entity_sig)
             else:
-                self.entity.copy2(target)
+                hasher = hashlib.sha256()
+                utils.copy_file(self.entity, target, self.LINK_MODE, hasher)
+                self.written(target, hasher.hexdigest())
 
     def __str__(self):
         return "Copy {}".format(self.entity)
 
+    def fingerprint(self):
+        if self.entity.isdir():
+            return None
+        self._entity_sig = self.INPUTS.sign(self.entity)
+        return self._fingerprint(self.layer.url,
+                                 self.layer.directory,
+                                 self.relpath,
+                                 self.entity.stat().st_mode,
+                                 self.LINK_MODE,
+                                 self._entity_sig)
+
     @classmethod
     def trigger(cls, entity, target, layer, next_config):
         return True
 
 
 class InterfaceCopy(Tactic):
+    output = None  # copies a whole tree
+
     def __init__(self, interface, relation_name, role, target, config):
         self.interface = interface
         self.relation_name = relation_name
@@ -252,6 +368,10 @@ class InterfaceCopy(Tactic):
     def target(self):
         return self._target / "hooks/relations" / self.interface.name
 
+    @property
+    def outputs(self):
+        return [self.target.relpath(self._target.directory)]
+
     def __call__(self):
         # copy the entire tree into the
         # hooks/relations/<interface>
@@ -263,11 +383,14 @@ class InterfaceCopy(Tactic):
         for entity, _ in utils.walk(self.interface.directory,
                                     lambda x: True,
                                     matcher=ignorer,
+                                    prune=ignorer.prunes,
                                     kind="files"):
             target = entity.relpath(self.interface.directory)
             target = (self.target / target).normpath()
             target.parent.makedirs_p()
-            entity.copy2(target)
+            hasher = hashlib.sha256()
+            utils.copy_file(entity, target, self.LINK_MODE, hasher)
+            self.written(target, hasher.hexdigest())
         init = self.target / "__init__.py"
         if not init.exists():
             # ensure we can import from here directly
@@ -280,8 +403,8 @@ class InterfaceCopy(Tactic):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
         sigs = {}
-        for entry, sig in utils.walk(self.target,
-                                     utils.sign, kind="files"):
+        files = list(self.target.walkfiles())
+        for entry, sig in zip(files, self.signatures(files)):
             relpath = entry.relpath(self._target.directory)
             sigs[relpath] = (self.interface.url, "static", sig)
         return sigs
@@ -309,6 +432,7 @@ class InterfaceCopy(Tactic):
 
 class DynamicHookBind(Tactic):
     HOOKS = []
+    output = None  # writes one file per hook
 
     def __init__(self, name, owner, target, config, template_file):
         self.name = name
@@ -318,22 +442,31 @@ class DynamicHookBind(Tactic):
         self.targets = [self._target / "hooks" / hook.format(name)
                         for hook in self.HOOKS]
 
+    @property
+    def outputs(self):
+        return [target.relpath(self._target.directory)
+                for target in self.targets]
+
     def __call__(self):
-        template = self._template_file.text()
+        # render the hook once, and write the same bytes for every hook
+        data = self._template_file.text().format(self.name).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
         for target in self.targets:
             target.parent.makedirs_p()
-            target.write_text(template.format(self.name))
+            utils.unlink_output(target)
+            target.write_bytes(data)
             target.chmod(0o755)
+            self.written(target, digest)
 
     def sign(self):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
         sigs = {}
-        for target in self.targets:
+        for target, sig in zip(self.targets, self.signatures(self.targets)):
             rel = target.relpath(self._target.directory)
             sigs[rel] = (self.owner,
                          "dynamic",
-                         utils.sign(target))
+                         sig)
         return sigs
 
     def __str__(self):
@@ -373,6 +506,8 @@ class SerializedTactic(ExactMatch, Tactic):
         super(SerializedTactic, self).__init__(*args, **kwargs)
         self.data = {}
         self._read = False
+        # every file merged into this one, from the lowest layer up
+        self.sources = [self.entity]
 
     def load(self, fn):
         raise NotImplementedError('Must be implemented in subclass: load')
@@ -394,8 +529,18 @@ class SerializedTactic(ExactMatch, Tactic):
             self.data = utils.deepmerge(existing.data, self.data)
         elif existing.data:
             self.data = dict(existing.data)
+        self.sources = getattr(existing, 'sources', []) + self.sources
         return self
 
+    def fingerprint(self):
+        section = None
+        if self.section and self.config:
+            section = self.config.get(self.section)
+        return self._fingerprint(self.layer.url,
+                                 section,
+                                 [(s, self.INPUTS.sign(s))
+                                  for s in self.sources])
+
     def apply_edits(self):
         # Apply any editing rules from config
         config = self.config
@@ -438,11 +583,14 @@ class YAMLTactic(SerializedTactic):
 
     def dump(self, data):
         """Write the data to the target yaml file."""
+        utils.unlink_output(self.target_file)
         with open(self.target_file, 'w') as fd:
-            yaml.dump(data, fd,
+            writer = utils.HashingWriter(fd)
+            yaml.dump(data, writer,
                       Dumper=yaml.RoundTripDumper,
                       default_flow_style=False,
                       default_style='"')
+        self.written(self.target_file, writer.hexdigest())
 
 
 class JSONTactic(SerializedTactic):
@@ -453,7 +601,11 @@ class JSONTactic(SerializedTactic):
         return json.load(fn)
 
     def dump(self, data):
-        json.dump(data, self.target_file.open('w'), indent=2)
+        utils.unlink_output(self.target_file)
+        with open(self.target_file, 'w') as fd:
+            writer = utils.HashingWriter(fd)
+            json.dump(data, writer, indent=2)
+        self.written(self.target_file, writer.hexdigest())
 
 
 class LayerYAML(YAMLTactic):
@@ -578,7 +730,7 @@ class LayerYAML(YAMLTactic):
         if target.exists() and target.isfile():
             sig["layer.yaml"] = (self.layer.url,
                                  self.kind,
-                                 utils.sign(self.target_file))
+                                 self.signature(self.target_file))
         return sig
 
 
@@ -685,6 +837,19 @@ class ResourcesYAML(YAMLTactic):
 
 
 class InstallerTactic(Tactic):
+    EXTENSIONS = [".pypi"]
+    # persistent cache of installed packages, if any
+    CACHE_DIR = None
+    _pip_version = None
+
+    def __init__(self, *args, **kwargs):
+        super(InstallerTactic, self).__init__(*args, **kwargs)
+        self._tracked = []
+        # the prefix the spec is installed in, and whether it is ours
+        self._prefix = None
+        self._owned = False
+        self._result = None
+
     def __str__(self):
         return "Installing software to {}".format(self.relpath)
 
@@ -692,28 +857,85 @@ class InstallerTactic(Tactic):
     def trigger(cls, entity, target, layer, next_config):
         relpath = entity.relpath(layer.directory)
         ext = relpath.splitext()[1]
-        return ext in [".pypi", ]
+        return ext in cls.EXTENSIONS
+
+    @classmethod
+    def pip_version(cls):
+        """The version and location of pip3, and the python it runs under"""
+        if cls._pip_version is None:
+            cls._pip_version = utils.Process(("pip3", "--version"))().output
+        return cls._pip_version
+
+    def _cache_entry(self, spec):
+        """
+        Return where the install of spec is cached, if it can be.
+
+        Only specs which pin every requirement to an exact version are
+        cached, so that a cached install never hides a newer release.
+        """
+        if not self.CACHE_DIR:
+            return None
+        if not all(WheelhouseTactic.PINNED_RE.match(line.strip())
+                   for line in spec.splitlines() if line.strip()):
+            return None
+        return self.CACHE_DIR / hashlib.sha256(json.dumps(
+            [spec, self.pip_version()])).hexdigest()
+
+    def prepare(self):
+        """
+        Install the spec into a prefix, or find it in the cache, without
+        changing the target; __call__ then puts the results in place.
+
+        Installs of different tactics are independent, so the builder
+        prepares them all at once before running the plan.
+        """
+        spec = self.entity.text().strip()
+        entry = self._cache_entry(spec)
+        if entry is not None and entry.isdir():
+            log.debug("Using cached install of {}".format(spec))
+            self._prefix, self._owned = entry, False
+            return
+        temp_dir = path(tempfile.mkdtemp())
+        # We do this dance so we don't have
+        # to guess package and .egg file names
+        # we move everything in the tempdir to the target
+        # and track it for later use in sign()
+        localenv = os.environ.copy()
+        localenv['PYTHONUSERBASE'] = temp_dir
+        # failures are reported by __call__, as this may run in a thread
+        self._result = utils.Process(("pip3",
+                                      "install",
+                                      "--user",
+                                      "--ignore-installed",
+                                      spec), env=localenv)
+        self._result = self._result.exit_on_error(False)()
+        self._prefix, self._owned = temp_dir, True
+        if entry is not None and self._result:
+            # copy next to the entry then rename, so it's never partial
+            entry.parent.makedirs_p()
+            tmp = path(tempfile.mkdtemp(dir=entry.parent, prefix='.'))
+            tmp.rmdir()
+            utils.copy_tree(temp_dir, tmp)
+            try:
+                tmp.rename(entry)
+            except OSError:
+                # another build cached it first
+                tmp.rmtree_p()
 
     def __call__(self):
         # install package reference in trigger file
         # in place directory of target
         # XXX: Should this map multiline to "-r", self.entity
-        spec = self.entity.text().strip()
         target = self.target_file.dirname()
         log.debug("pip installing {} as {}".format(
-            spec, target))
-        with utils.tempdir(chdir=False) as temp_dir:
-            # We do this dance so we don't have
-            # to guess package and .egg file names
-            # we move everything in the tempdir to the target
-            # and track it for later use in sign()
-            localenv = os.environ.copy()
-            localenv['PYTHONUSERBASE'] = temp_dir
-            utils.Process(("pip3",
-                           "install",
-                           "--user",
-                           "--ignore-installed",
-                           spec), env=localenv).exit_on_error()()
+            self.entity.text().strip(), target))
+        if self._prefix is None:
+            self.prepare()
+        prefix, owned = self._prefix, self._owned
+        self._prefix = None
+        try:
+            if self._result is not None:
+                self._result.exit_on_error()
             self._tracked = []
             # We now manage two classes of explicit mappings
             # When python packages are installed into a prefix
@@ -722,10 +944,10 @@ class InstallerTactic(Tactic):
             # <target>/*
             src_paths = ["bin/*", "lib/python*/site-packages/*"]
             for p in src_paths:
-                for d in temp_dir.glob(p):
+                for d in prefix.glob(p):
                     if not d.exists():
                         continue
-                    bp = d.relpath(temp_dir)
+                    bp = d.relpath(prefix)
                     if bp.startswith("bin/"):
                         dst = self.target / bp
                     elif bp.startswith("lib"):
@@ -739,30 +961,71 @@ class InstallerTactic(Tactic):
                             dst.remove()
                     if not dst.parent.exists():
                         dst.parent.makedirs_p()
-                    log.debug("Installer moving {} to {}".format(d, dst))
-                    d.move(dst)
+                    if owned:
+                        log.debug("Installer moving {} to {}".format(d, dst))
+                        d.move(dst)
+                    elif d.isdir() and not d.islink():
+                        log.debug("Installer copying {} to {}".format(d, dst))
+                        utils.copy_tree(d, dst, self.LINK_MODE)
+                    else:
+                        log.debug("Installer copying {} to {}".format(d, dst))
+                        utils.copy_file(d, dst, self.LINK_MODE)
                     self._tracked.append(dst)
+        finally:
+            self._result = None
+            if owned:
+                prefix.rmtree_p()
 
     def sign(self):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
-        sigs = {}
+        files = []
         for d in self._tracked:
             if d.isdir():
-                for entry, sig in utils.walk(d,
-                                             utils.sign, kind="files"):
-                    relpath = entry.relpath(self.target.directory)
-                    sigs[relpath] = (self.layer.url, "dynamic", sig)
+                files.extend(d.walkfiles())
             elif d.isfile():
-                relpath = d.relpath(self.target.directory)
-                sigs[relpath] = (
-                    self.layer.url, "dynamic", utils.sign(d))
+                files.append(d)
+        sigs = {}
+        for entry, sig in zip(files, self.signatures(files)):
+            relpath = entry.relpath(self.target.directory)
+            sigs[relpath] = (self.layer.url, "dynamic", sig)
         return sigs
 
 
 class WheelhouseTactic(ExactMatch, Tactic):
     kind = "dynamic"
     FILENAME = 'wheelhouse.txt'
+    # name and version of an sdist or wheel from its filename
+    DIST_RE = re.compile(r'^(?P<name>.+?)-(?P<version>\d[^-]*?)'
+                         r'(\.tar\.gz|\.tar\.bz2|\.tgz|\.zip|-.+\.whl)$')
+
+    # persistent cache of downloads and build venvs, if any
+    CACHE_DIR = None
+    # extra places for pip to find distributions in, and the index to use
+    FIND_LINKS = []
+    INDEX_URL = None
+    # how many requirements to download at once, and at most from one host
+    JOBS = 1
+    HOST_JOBS = 6
+    # the python to build with; binary wheels are built for it if asked to
+    PYTHON = 'python3'
+    BINARY_WHEELS = False
+    TAG_SCRIPT = ("import platform, sys; "
+                  "print('cp%d%d-%s' % (sys.version_info[:2] + "
+                  "(platform.machine(),)))")
+    # a requirement pinned to an exact version, maybe with its hashes
+    PINNED_RE = re.compile(r'^(?P<name>[A-Za-z0-9._-]+)(\[[^]]*\])?'
+                           r'\s*==\s*(?P<version>[^,;\s]+)'
+                           r'(\s+--hash=\S+)*$')
+    # project name of a requirement, or of a VCS or URL one with #egg=
+    REQUIREMENT_RE = re.compile(r'^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)'
+                                r'\s*(\[|[<>=!~;@]|$)')
+    EGG_RE = re.compile(r'#egg=(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)')
+    # the strings, operators, names and parentheses of an environment marker
+    MARKER_TOKEN_RE = re.compile(r'"[^"]*"|\'[^\']*\'|[<>=!~]+|[\w.]+|[()]')
+    # a requirements file, constraints file, or project given by its path
+    PATH_RE = re.compile(r'^(?P<option>(-[rce]|--requirement|--constraint|'
+                         r'--editable)(\s*=\s*|\s*))?(?P<path>\S+)')
 
     def __init__(self, *args, **kwargs):
         super(WheelhouseTactic, self).__init__(*args, **kwargs)
@@ -770,6 +1033,10 @@ class WheelhouseTactic(ExactMatch, Tactic):
         self.previous = []
         self._venv = None
         self.purge_wheels = False
+        # {project: layer url} of the layer that pinned each requirement
+        self.origins = {}
+        # {package: version} pins to download with, e.g. from build.lock
+        self.constraints = {}
 
     def __str__(self):
         directory = self.target.directory / 'wheelhouse'
@@ -780,71 +1047,433 @@ class WheelhouseTactic(ExactMatch, Tactic):
         return self
 
     def _add(self, wheelhouse, *reqs):
+        key = self._cache_key(*reqs)
+        dists = self._cached_dists(key)
+        if dists is not None:
+            log.debug('Using cached wheelhouse downloads for %s', reqs[-1])
+            for dist, digest in dists:
+                dest = self._dest(wheelhouse, dist.basename())
+                utils.copy_file(dist, dest)
+                self.written(dest, digest)
+                self.tracked.append(dest)
+            return
+        downloaded = []
         with utils.tempdir(chdir=False) as temp_dir:
             # put in a temp dir first to ensure we track all of the files
-            self._pip('download', '--no-binary', ':all:', '-d', temp_dir,
-                      *reqs)
-            for wheel in temp_dir.files():
-                dest = wheelhouse / wheel.basename()
-                if self.purge_wheels:
-                    unversioned_wheel = wheel.basename().split('-')[0]
-                    for old_wheel in wheelhouse.glob(unversioned_wheel + '-*'):
-                        old_wheel.remove()
-                else:
-                    dest.remove_p()
-                wheel.move(wheelhouse)
+            for wheel in self._download(temp_dir, *reqs):
+                dest = self._dest(wheelhouse, wheel.basename())
+                hasher = hashlib.sha256()
+                utils.move_file(wheel, dest, hasher)
+                self.written(dest, hasher.hexdigest())
                 self.tracked.append(dest)
+                downloaded.append((dest, hasher.hexdigest()))
+        self._cache_dists(key, downloaded)
+
+    def _download(self, temp_dir, *reqs):
+        """
+        Download reqs with pip into temp_dir, and return the files fetched.
+
+        With more than one job, a requirements file which pins every
+        requirement with its hashes, as ``pip-compile --generate-hashes``
+        writes, is downloaded by a pip per requirement, up to JOBS at a time
+        but no more than HOST_JOBS from the index they all come from.  Such
+        a file already is the resolution of all of its dependencies, so each
+        pip fetches just its own line.  Anything else is resolved and
+        downloaded by a single pip, so that shared dependencies are resolved
+        once.
+        """
+        lines = self._split(*reqs)
+        locked = lines and all(self.PINNED_RE.match(line) and
+                               '--hash=' in line for line in lines)
+        jobs = min(self.JOBS, self.HOST_JOBS)
+        if jobs <= 1 or not locked or len(lines) == 1:
+            args = ('download', '--no-binary', ':all:', '-d', temp_dir)
+            args += self._pip_options()
+            if self.constraints:
+                args += ('-c', self._write_constraints(temp_dir))
+            self._pip(*(args + reqs))
+            return [f for f in temp_dir.files()
+                    if f.basename() != 'constraints.txt']
+
+        args = ('download', '--no-binary', ':all:', '--no-deps')
+        args += self._pip_options()
+        if self.constraints:
+            args += ('-c', self._write_constraints(temp_dir))
+
+        def download(job):
+            i, line = job
+            dest = temp_dir / 'dist-{}'.format(i)
+            dest.mkdir()
+            req = temp_dir / 'req-{}.txt'.format(i)
+            req.write_text(line + '\n')
+            return self._run_in_venv(
+                'pip3', *(args + ('-d', dest, '-r', req)), exit=False)
+
+        self._ensure_venv()
+        log.debug('Downloading %d requirements with %d jobs',
+                  len(lines), jobs)
+        results = utils.parallel_map(download, enumerate(lines), jobs)
+        for result in results:
+            result.exit_on_error()
+        dists = []
+        for i in range(len(lines)):
+            dists.extend(sorted((temp_dir / 'dist-{}'.format(i)).files()))
+        return dists
+
+    def _split(self, *reqs):
+        """
+        Return the requirement lines of a requirements file that can be
+        downloaded independently, or None if there is more than a file
+        or it has options which apply to the whole file.
+        """
+        if len(reqs) != 2 or reqs[0] != '-r':
+            return None
+        lines = []
+        for line in path(reqs[1]).lines(retain=False):
+            line = re.sub(r'(^|\s)#.*$', '', line).strip()
+            if not line:
+                continue
+            if line.startswith('-') and not line.startswith('-e '):
+                return None
+            lines.append(line)
+        return lines
+
+    def _dest(self, wheelhouse, name):
+        dest = wheelhouse / name
+        if self.purge_wheels:
+            unversioned_wheel = name.split('-')[0]
+            for old_wheel in wheelhouse.glob(unversioned_wheel + '-*'):
+                old_wheel.remove()
+        else:
+            dest.remove_p()
+        return dest
+
+    def _pip_options(self):
+        options = ()
+        if self.CACHE_DIR:
+            options += ('--cache-dir', self.CACHE_DIR / 'pip')
+        if self.INDEX_URL:
+            options += ('--index-url', self.INDEX_URL)
+        for link in self.FIND_LINKS:
+            options += ('--find-links', link)
+        return options
+
+    def _cache_key(self, *reqs):
+        """
+        Key for the downloads of a requirements file, if it can be cached.
 
-    def _run_in_venv(self, *args):
+        Only files which pin every requirement to an exact version are
+        cached, so that a cached download never hides a newer release.
+        """
+        if not self.CACHE_DIR or len(reqs) != 2 or reqs[0] != '-r':
+            return None
+        lines = []
+        for line in path(reqs[1]).lines(retain=False):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if not self.PINNED_RE.match(line):
+                return None
+            lines.append(line)
+        return hashlib.sha256(json.dumps([
+            sorted(lines),
+            sorted(self.constraints.items()),
+            self.INDEX_URL,
+            self.FIND_LINKS,
+        ])).hexdigest()
+
+    def _cached_dists(self, key):
+        """Return [(dist, sha256)] cached for key, if all are present."""
+        if key is None:
+            return None
+        index = self.CACHE_DIR / 'requirements' / key + '.json'
+        if not index.exists():
+            return None
+        dists = []
+        for name, digest in json.loads(index.text()):
+            dist = self.CACHE_DIR / 'dists' / digest / name
+            if not dist.exists():
+                return None
+            dists.append((dist, digest))
+        return dists
+
+    def _cache_dists(self, key, downloaded):
+        if key is None:
+            return
+        for dist, digest in downloaded:
+            self._cache_file(self.CACHE_DIR / 'dists' / digest, dist)
+        index = self.CACHE_DIR / 'requirements' / key + '.json'
+        index.parent.makedirs_p()
+        fd, tmp = tempfile.mkstemp(dir=index.parent, prefix='.')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump([(dist.basename(), digest)
+                       for dist, digest in downloaded], fp)
+        path(tmp).rename(index)
+
+    def _cache_file(self, entry, filename):
+        """Store a copy of filename in the cache directory entry."""
+        if entry.exists():
+            return
+        entry.parent.makedirs_p()
+        # copy next to the entry then rename, so it's never partial
+        tmp = path(tempfile.mkdtemp(dir=entry.parent, prefix='.'))
+        utils.copy_file(filename, tmp / filename.basename())
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # another build cached it first
+            tmp.rmtree_p()
+
+    def _python_tag(self):
+        """
+        Return the tag of the interpreter and platform wheels are built for,
+        e.g. ``cp36-x86_64``.
+        """
+        return utils.Process(
+            (self.PYTHON, '-c', self.TAG_SCRIPT)
+        ).exit_on_error()().output.strip()
+
+    def _build_wheels(self):
+        """
+        Replace each sdist in the wheelhouse with a wheel built from it
+        for PYTHON, keeping the sdist of any that can't be built.
+
+        Built wheels are cached by the hash of their sdist and the tag of
+        the interpreter they were built for.
+        """
+        sdists = [(i, dist) for i, dist in enumerate(self.tracked)
+                  if not dist.endswith('.whl')]
+        if not sdists:
+            return
+        tag = self._python_tag()
+        entries = {}
+        if self.CACHE_DIR:
+            for _, sdist in sdists:
+                entries[sdist] = (self.CACHE_DIR / 'wheels' / tag /
+                                  self.signature(sdist))
+        if not all(entries.get(sdist) and entries[sdist].isdir()
+                   for _, sdist in sdists):
+            self._ensure_venv()
+
+        def build(job):
+            i, sdist = job
+            entry = entries.get(sdist)
+            with utils.tempdir(chdir=False) as temp_dir:
+                if entry is not None and entry.isdir():
+                    wheels = entry.files('*.whl')
+                else:
+                    args = ('wheel', '--no-deps', '-w', temp_dir)
+                    args += self._pip_options() + (sdist,)
+                    result = self._run_in_venv('pip3', *args, exit=False)
+                    wheels = temp_dir.files('*.whl')
+                    if not result or len(wheels) != 1:
+                        log.warn('Unable to build a wheel from %s, using '
+                                 'the sdist instead:\n%s',
+                                 sdist.basename(), result.output)
+                        return None
+                    if entry is not None:
+                        self._cache_file(entry, wheels[0])
+                wheel = sdist.parent / wheels[0].basename()
+                hasher = hashlib.sha256()
+                utils.copy_file(wheels[0], wheel, hasher=hasher)
+                self.written(wheel, hasher.hexdigest())
+            log.debug('Built %s from %s', wheel.basename(), sdist.basename())
+            sdist.remove()
+            self.tracked[i] = wheel
+
+        utils.parallel_map(build, sdists, self.JOBS)
+
+    def _write_constraints(self, directory, constraints=None):
+        if constraints is None:
+            constraints = self.constraints
+        filename = directory / 'constraints.txt'
+        filename.write_text(''.join(
+            '{}=={}\n'.format(name, version)
+            for name, version in sorted(constraints.items())))
+        return filename
+
+    def _run_in_venv(self, *args, **kwargs):
         assert self._venv is not None
         # have to use bash to activate the venv properly first
         return utils.Process(('bash', '-c', ' '.join(
             ('.', self._venv / 'bin' / 'activate', ';') + args
-        ))).exit_on_error()()
+        ))).exit_on_error(kwargs.get('exit', True))()
+
+    def _ensure_venv(self):
+        if self._venv is None:
+            if self.CACHE_DIR:
+                self._venv = self._cached_venv()
+            else:
+                self._create_venv(path(tempfile.mkdtemp()))
 
     def _pip(self, *args):
+        self._ensure_venv()
         return self._run_in_venv('pip3', *args)
 
+    def _create_venv(self, venv):
+        # create venv without pip and use easy_install to install newer
+        # version; use patched version if running in snap to include:
+        # https://github.com/pypa/pip/blob/master/news/4320.bugfix
+        self._venv = venv
+        utils.Process(
+            ('virtualenv', '--python', self.PYTHON, '--no-pip', venv)
+        ).exit_on_error()()
+        self._run_in_venv('easy_install',
+                          'pip' if 'SNAP' not in os.environ else
+                          os.path.join(os.environ['SNAP'],
+                                       'pip-10.0.0.dev0.zip'))
+
+    def _cached_venv(self):
+        """
+        Return the build venv for the current PYTHON from the cache,
+        creating it first if need be.
+        """
+        version = utils.Process((self.PYTHON, '--version'))().output
+        name = re.sub(r'[^\w.-]+', '-', version.strip()) or 'python3'
+        venv = self.CACHE_DIR / 'venvs' / name
+        venv.parent.makedirs_p()
+        with open(venv + '.lock', 'w') as lock:
+            # serialize creating the venv between concurrent builds
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not (venv / '.ready').exists():
+                venv.rmtree_p()
+                self._create_venv(venv)
+                (venv / '.ready').touch()
+        return venv
+
+    def requirements(self):
+        """
+        Merge the requirements of this and all lower layers' wheelhouse.txt
+        files, with higher layers taking precedence.
+
+        Return an OrderedDict of {key: (requirement line, tactic)}, keyed
+        by the normalized project name, and environment marker if any, where
+        it can be determined.  Relative paths in the lines are made absolute,
+        as they are relative to the wheelhouse.txt they are from.
+        """
+        reqs = OrderedDict()
+        for tactic in self.previous + [self]:
+            directory = path(tactic.entity).abspath().dirname()
+            for line in path(tactic.entity).lines(retain=False):
+                line = re.sub(r'(^|\s)#.*$', '', line).strip()
+                if not line:
+                    continue
+                line = self.absolute_paths(line, directory)
+                key = self.requirement_key(line)
+                if key in reqs and reqs[key][0] != line:
+                    log.info('%s: %s overrides %s from %s',
+                             tactic.origin, line, reqs[key][0],
+                             reqs[key][1].origin)
+                # an override keeps the position of the original
+                reqs[key] = (line, tactic)
+        return reqs
+
+    @classmethod
+    def absolute_paths(cls, line, directory):
+        """
+        Return the requirement line with a relative path in it, of a ``-r``
+        or ``-c`` file or a local project such as ``-e .``, made absolute
+        against directory.
+        """
+        match = cls.PATH_RE.match(line)
+        if not match:
+            return line
+        option, filename = match.group('option'), match.group('path')
+        if option and option.strip().lstrip('-')[0] in 'rc':
+            relative = '://' not in filename and not os.path.isabs(filename)
+        else:
+            relative = filename in ('.', '..') or \
+                filename.startswith(('./', '../'))
+        if not relative:
+            return line
+        return '{}{}{}'.format(option or '',
+                               (directory / filename).normpath(),
+                               line[match.end():])
+
+    @classmethod
+    def requirement_key(cls, line):
+        """
+        Return the key of a requirement line: its normalized project name,
+        with its environment marker if any, or else the line itself.
+        """
+        name = cls.requirement_name(line)
+        if not name:
+            return line
+        match = cls.REQUIREMENT_RE.match(line)
+        if match and ';' in line:
+            marker = line.split(';', 1)[1]
+            marker = re.sub(r'\s--hash=\S+', '', marker)
+            return '{}; {}'.format(name, ' '.join(
+                cls.MARKER_TOKEN_RE.findall(marker)))
+        return name
+
+    @classmethod
+    def requirement_name(cls, line):
+        """Return the normalized project name of a requirement line."""
+        match = cls.REQUIREMENT_RE.match(line) or cls.EGG_RE.search(line)
+        if match:
+            return re.sub(r'[-_.]+', '-', match.group('name')).lower()
+        return None
+
+    @property
+    def origin(self):
+        """The layer, or overrides file, that this wheelhouse.txt is from"""
+        if path(self.entity).startswith(self.layer.directory):
+            return self.layer.url
+        return str(self.entity)
+
     def __call__(self):
         create_venv = self._venv is None
-        self._venv = self._venv or path(tempfile.mkdtemp())
         wheelhouse = self.target.directory / 'wheelhouse'
         wheelhouse.mkdir_p()
-        if create_venv:
-            # create venv without pip and use easy_install to install newer
-            # version; use patched version if running in snap to include:
-            # https://github.com/pypa/pip/blob/master/news/4320.bugfix
-            utils.Process(
-                ('virtualenv', '--python', 'python3', '--no-pip', self._venv)
-            ).exit_on_error()()
-            self._run_in_venv('easy_install',
-                              'pip' if 'SNAP' not in os.environ else
-                              os.path.join(os.environ['SNAP'],
-                                           'pip-10.0.0.dev0.zip'))
-        # we are the top layer; process all lower layers first
-        for tactic in self.previous:
-            tactic()
-        # process this layer
-        self._add(wheelhouse, '-r', self.entity)
-        # clean up
-        if create_venv:
-            self._venv.rmtree_p()
-            self._venv = None
+        # we are the top layer; resolve all layers' requirements in one pass
+        self.origins = {}
+        lines = []
+        for key, (line, tactic) in self.requirements().items():
+            log.debug('wheelhouse: %s (from %s)', line, tactic.origin)
+            self.origins[self.requirement_name(line) or key] = \
+                tactic.layer.url
+            lines.append(line + '\n')
+        try:
+            with utils.tempdir(chdir=False) as temp_dir:
+                merged = temp_dir / 'wheelhouse.txt'
+                merged.write_text(''.join(lines))
+                self._add(wheelhouse, '-r', merged)
+            if self.BINARY_WHEELS:
+                self._build_wheels()
+        finally:
+            # clean up
+            if create_venv and self._venv is not None:
+                if not self.CACHE_DIR:
+                    self._venv.rmtree_p()
+                self._venv = None
+
+    def pins(self):
+        """return the {package: version} of everything in the wheelhouse
+        """
+        pins = {}
+        for d in self.tracked:
+            match = self.DIST_RE.match(d.basename())
+            if match:
+                pins[match.group('name')] = match.group('version')
+        return pins
 
     def sign(self):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
         sigs = {}
-        for tactic in self.previous:
-            sigs.update(tactic.sign())
-        for d in self.tracked:
+        for d, sig in zip(self.tracked, self.signatures(self.tracked)):
             relpath = d.relpath(self.target.directory)
+            match = self.DIST_RE.match(d.basename())
+            name = match and self.requirement_name(match.group('name'))
             sigs[relpath] = (
-                self.layer.url, "dynamic", utils.sign(d))
+                self.origins.get(name, self.layer.url), "dynamic", sig)
         return sigs
 
 
-class CopyrightTactic(Tactic):
+class CopyrightTactic(ExactMatch, Tactic):
+    FILENAME = "copyright"
+
     def __init__(self, *args, **kwargs):
         super(CopyrightTactic, self).__init__(*args, **kwargs)
         self.previous = []
@@ -865,11 +1494,6 @@ class CopyrightTactic(Tactic):
         target = self.target.directory / self.relpath_target
         return target
 
-    @classmethod
-    def trigger(cls, entity, target, layer, next_config):
-        relpath = entity.relpath(layer.directory)
-        return relpath == "copyright"
-
     def __call__(self):
         # Process the `copyright` file for all levels below us.
         for tactic in self.previous:
@@ -880,10 +1504,15 @@ class CopyrightTactic(Tactic):
                 or not self.entity.samefile(self.target_file):
             data = self.read()
             if data:
+                utils.unlink_output(self.target_file)
                 self.target_file.write_bytes(data)
                 self.entity.copymode(self.target_file)
+                digest = hashlib.sha256(data).hexdigest()
             else:
-                self.entity.copy2(self.target_file)
+                hasher = hashlib.sha256()
+                utils.copy_file(self.entity, self.target_file, hasher=hasher)
+                digest = hasher.hexdigest()
+            self.written(self.target_file, digest)
 
     def sign(self):
         """return sign in the form {relpath: (origin layer, SHA256)}
@@ -895,7 +1524,7 @@ class CopyrightTactic(Tactic):
         relpath = self.target_file.relpath(self.target.directory)
         sigs[relpath] = (self.layer.url,
                          self.kind,
-                         utils.sign(self.target_file))
+                         self.signature(self.target_file))
         return sigs
 
 
@@ -930,6 +1559,82 @@ def extend_with_default(validator_class):
     )
 
 
+def _trigger_func(tactic):
+    return getattr(tactic.trigger, '__func__', tactic.trigger)
+
+
+class TacticIndex(object):
+    """
+    Dispatch table for picking which of a list of tactics handles a file.
+
+    Tactics using the stock trigger of :class:`ExactMatch`,
+    :class:`LayerYAML` or :class:`InstallerTactic` are indexed by the
+    filenames or extensions they match, so that only those, plus the tactics
+    with any other trigger, are tried for a given file.  Candidates are
+    still returned in their original order, so the first match wins as
+    before.
+    """
+    _indexes = {}
+    _conventions = {}
+
+    def __init__(self, tactics):
+        self.tactics = tactics
+        self.generic = []
+        self.by_name = {}
+        self.by_ext = {}
+        for position, tactic in enumerate(tactics):
+            trigger = _trigger_func(tactic)
+            entry = (position, tactic)
+            if trigger is _trigger_func(ExactMatch):
+                self.by_name.setdefault(tactic.FILENAME, []).append(entry)
+            elif trigger is _trigger_func(LayerYAML):
+                for name in tactic.FILENAMES:
+                    self.by_name.setdefault(name, []).append(entry)
+            elif trigger is _trigger_func(InstallerTactic):
+                for ext in tactic.EXTENSIONS:
+                    self.by_ext.setdefault(ext, []).append(entry)
+            else:
+                self.generic.append(entry)
+        self._candidates = {}
+
+    @classmethod
+    def get(cls, tactics):
+        """Return the (cached) index for a list of tactics."""
+        key = tuple(tactics)
+        if key not in cls._indexes:
+            cls._indexes[key] = cls(tactics)
+        return cls._indexes[key]
+
+    @classmethod
+    def clear(cls):
+        """
+        Forget the cached indexes, so that the tactics of layers loaded by
+        earlier builds in this process are not kept alive.
+        """
+        cls._indexes.clear()
+        cls._conventions.clear()
+
+    @classmethod
+    def old_convention(cls, tactic):
+        """Does the tactic's trigger take only the relative path?"""
+        if tactic not in cls._conventions:
+            argspec = getargspec(tactic.trigger)
+            cls._conventions[tactic] = len(argspec.args) == 2
+        return cls._conventions[tactic]
+
+    def candidates(self, relpath):
+        """The tactics which could handle relpath, in order."""
+        name = relpath if relpath in self.by_name else None
+        ext = path(relpath).splitext()[1]
+        ext = ext if ext in self.by_ext else None
+        if (name, ext) not in self._candidates:
+            entries = (self.generic + self.by_name.get(name, []) +
+                       self.by_ext.get(ext, []))
+            self._candidates[(name, ext)] = [
+                tactic for _, tactic in sorted(entries)]
+        return self._candidates[(name, ext)]
+
+
 DEFAULT_TACTICS = [
     IgnoreTactic,
     ExcludeTactic,
@@ -945,3 +1650,24 @@ DEFAULT_TACTICS = [
     LayerYAML,
     CopyTactic
 ]
+
+# Built-in tactics which only write their own output, so can be run in
+# parallel with each other.  InstallerTactic is not one of them, as it
+# replaces whole directories in the target.
+CONCURRENT_TACTICS = [
+    IgnoreTactic,
+    ExcludeTactic,
+    ManifestTactic,
+    WheelhouseTactic,
+    CopyrightTactic,
+    DistYAML,
+    ResourcesYAML,
+    MetadataYAML,
+    ConfigYAML,
+    ActionsYAML,
+    LayerYAML,
+    CopyTactic,
+    InterfaceCopy,
+    InterfaceBind,
+    StorageBind,
+]
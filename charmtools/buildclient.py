@@ -0,0 +1,86 @@
+"""
+Entry point of ``charm build``, which hands the build to a running build
+server (see :mod:`charmtools.build.server`) if there is one, and otherwise
+builds the charm itself.
+
+This module is kept free of the build's own imports, so that a forwarded
+build doesn't pay for them.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+from contextlib import closing
+
+# options which only make sense in the charm build process itself
+LOCAL_OPTIONS = ('--server', '--no-server', '--watch', '--description',
+                 '-h', '--help')
+
+
+def default_socket():
+    """
+    The path of the build server's socket: in $XDG_RUNTIME_DIR if set,
+    otherwise in the charm-tools cache directory.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'charm-build.sock')
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'charm-tools', 'build.sock')
+
+
+def server_socket(args):
+    """The socket of the server to forward the build with args to."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--server-socket', default=default_socket())
+    return parser.parse_known_args(args)[0].server_socket
+
+
+def forward(socket_path, args):
+    """
+    Run ``charm build args`` on the build server listening on socket_path,
+    in the current directory and environment, copying its output to ours.
+
+    Return its exit code, or None if there is no server to run it.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(sock):
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            # a stale socket, left by a server that didn't shut down
+            return None
+        sock.sendall(json.dumps({
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }) + '\n')
+        for line in sock.makefile('r'):
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'].encode('utf-8'))
+                sys.stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+    sys.stderr.write('The build server at {} stopped before the build '
+                     'finished\n'.format(socket_path))
+    return 1
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if not any(arg.split('=', 1)[0] in LOCAL_OPTIONS for arg in args):
+        exit_code = forward(server_socket(args), args)
+        if exit_code is not None:
+            raise SystemExit(exit_code)
+    from charmtools.build import builder
+    builder.main(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,11 @@ import hashlib
 import email.utils
 
 import colander
-import yaml
 
 from stat import ST_MODE
 from stat import S_IXUSR
 
+from charmtools import utils
 from linter import Linter
 from launchpadlib.launchpad import Launchpad
 
@@ -161,8 +161,7 @@ class CharmLinter(Linter):
             self.info('File config.yaml not found.')
             return
         try:
-            with open(config_path) as config_file:
-                config = yaml.safe_load(config_file.read())
+            config = utils.load_yaml(config_path)
         except Exception as error:
             self.err('Cannot parse config.yaml: %s' % error)
             return
@@ -264,15 +263,14 @@ class Charm(object):
         yaml_path = os.path.join(charm_path, 'metadata.yaml')
         actions_yaml_file = os.path.join(charm_path, 'actions.yaml')
         try:
-            yamlfile = open(yaml_path, 'r')
+            with open(yaml_path, 'r') as yamlfile:
+                text = yamlfile.read()
             try:
-                charm = yaml.safe_load(yamlfile)
+                charm = utils.load_yaml(yaml_path, text)
             except Exception as e:
                 lint.crit('cannot parse ' + yaml_path + ":" + str(e))
                 return lint.lint, lint.exit_code
 
-            yamlfile.close()
-
             for key in charm.keys():
                 if key not in KNOWN_METADATA_KEYS:
                     lint.err("Unknown root metadata field (%s)" % key)
@@ -420,8 +418,9 @@ class Charm(object):
 
             if os.path.exists(actions_yaml_file):
                 with open(actions_yaml_file) as f:
+                    text = f.read()
                     try:
-                        actions = yaml.safe_load(f.read())
+                        actions = utils.load_yaml(actions_yaml_file, text)
                     except Exception as e:
                         lint.crit('cannot parse ' + actions_yaml_file + ":" + str(e))
                     validate_actions(actions, actions_path, lint)
@@ -447,11 +446,7 @@ class Charm(object):
         return lint.lint, lint.exit_code
 
     def metadata(self):
-        metadata = None
-        with open(os.path.join(self.charm_path, 'metadata.yaml')) as f:
-            metadata = yaml.safe_load(f.read())
-
-        return metadata
+        return utils.load_yaml(os.path.join(self.charm_path, 'metadata.yaml'))
 
     def promulgate(self):
         pass
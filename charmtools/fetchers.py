@@ -3,13 +3,14 @@ import logging
 import os
 import re
 import shlex
-import shutil
 import subprocess
 import tempfile
 
 import requests
 import yaml
 
+from charmtools import utils
+
 
 log = logging.getLogger(__name__)
 
@@ -95,6 +96,9 @@ def download_file(url, dir_):
 
 
 class Fetcher(object):
+    # remote url for fetchers that clone a git repo
+    git_url = None
+
     def __init__(self, url, **kw):
         self.revision = ''
         self.url = url
@@ -166,10 +170,13 @@ class LaunchpadGitFetcher(Fetcher):
     (?P<repo>[^@]*)(@(?P<revision>.*))?$
     """, re.VERBOSE)
 
+    @property
+    def git_url(self):
+        return 'https://git.launchpad.net/' + self.repo
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
-        url = 'https://git.launchpad.net/' + self.repo
-        git('clone {} {}'.format(url, dir_))
+        git('clone {} {}'.format(self.git_url, dir_))
         if self.revision:
             git('checkout {}'.format(self.revision), cwd=dir_)
         return rename(dir_)
@@ -181,10 +188,13 @@ class GithubFetcher(Fetcher):
     (?P<repo>[^@]*)(@(?P<revision>.*))?$
     """, re.VERBOSE)
 
+    @property
+    def git_url(self):
+        return 'https://github.com/' + self.repo
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
-        url = 'https://github.com/' + self.repo
-        git('clone {} {}'.format(url, dir_))
+        git('clone {} {}'.format(self.git_url, dir_))
         if self.revision:
             git('checkout {}'.format(self.revision), cwd=dir_)
         return rename(dir_)
@@ -200,9 +210,15 @@ class GitFetcher(Fetcher):
     ^(?P<repo>git.*|.*\.git)?$
     """, re.VERBOSE)
 
+    @property
+    def git_url(self):
+        return self.repo
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
-        git('clone {} {}'.format(self.repo, dir_))
+        git('clone {} {}'.format(self.git_url, dir_))
+        if self.revision:
+            git('checkout {}'.format(self.revision), cwd=dir_)
         return rename(dir_)
 
 
@@ -212,12 +228,16 @@ class BitbucketFetcher(Fetcher):
     (?P<repo>[^@]*)(@(?P<revision>.*))?$
     """, re.VERBOSE)
 
+    @property
+    def git_url(self):
+        url = 'https://bitbucket.org/' + self.repo
+        return url if url.endswith('.git') else None
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
-        url = 'https://bitbucket.org/' + self.repo
-        if url.endswith('.git'):
-            return self._fetch_git(url, dir_)
-        return self._fetch_hg(url, dir_)
+        if self.git_url:
+            return self._fetch_git(self.git_url, dir_)
+        return self._fetch_hg('https://bitbucket.org/' + self.repo, dir_)
 
     def _fetch_git(self, url, dir_):
         git('clone {} {}'.format(url, dir_))
@@ -234,6 +254,9 @@ class BitbucketFetcher(Fetcher):
 
 
 class LocalFetcher(Fetcher):
+    # how files are materialized; see charmtools.utils.copy_file
+    LINK_MODE = 'copy'
+
     @classmethod
     def can_fetch(cls, url):
         src = os.path.abspath(
@@ -244,7 +267,7 @@ class LocalFetcher(Fetcher):
 
     def fetch(self, dir_):
         dst = os.path.join(dir_, os.path.basename(self.path.rstrip(os.sep)))
-        shutil.copytree(self.path, dst, symlinks=True)
+        utils.copy_tree(self.path, dst, self.LINK_MODE)
         return dst
 
 
@@ -330,19 +353,20 @@ class FetchError(Exception):
 
 def check_output(cmd, **kw):
     args = shlex.split(cmd)
-    try:
-        p = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            **kw
-        )
-    except OSError as e:
-        msg = 'Unable to run "%s": %s' % (args[0], e.strerror)
-        if e.errno == errno.ENOENT:
-            msg += '\nPlease install "%s" and try again' % args[0]
-        raise FetchError(msg)
-    out, _ = p.communicate()
+    with utils.profiled(os.path.basename(args[0]), 'process', command=cmd):
+        try:
+            p = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                **kw
+            )
+        except OSError as e:
+            msg = 'Unable to run "%s": %s' % (args[0], e.strerror)
+            if e.errno == errno.ENOENT:
+                msg += '\nPlease install "%s" and try again' % args[0]
+            raise FetchError(msg)
+        out, _ = p.communicate()
     if p.returncode != 0:
         raise FetchError(out)
     log.debug('%s: %s', cmd, out)
@@ -1,22 +1,33 @@
 import argparse
 import copy
 import collections
+import errno
+import fcntl
 import hashlib
 import importlib
 import json
 import logging
 import os
 import re
+import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import traceback
 import pwd
-from contextlib import contextmanager
+import Queue
+import zipfile
+from contextlib import closing, contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from .diff_match_patch import diff_match_patch
 import blessings
 import pathspec
+import yaml
 from path import Path as path
 
 log = logging.getLogger('utils')
@@ -194,8 +205,10 @@ class Process(object):
         if 'env' not in kwargs:
             kwargs['env'] = os.environ
 
-        p = subprocess.Popen(all_args, **kwargs)
-        stdout, stderr = p.communicate()
+        with profiled(os.path.basename(all_args[0].split(' ')[0]),
+                      'process', command=' '.join(all_args)):
+            p = subprocess.Popen(all_args, **kwargs)
+            stdout, stderr = p.communicate()
         self.log.debug(stdout)
         stdout = stdout.strip()
         if stderr is not None:
@@ -329,11 +342,123 @@ def load_class(full_class_string, workingdir=None):
         sys.path.pop(0)
 
 
-def walk(pathobj, fn, matcher=None, kind=None, **kwargs):
+# the charmtools.build.profiler.Profiler of a build run with --profile
+PROFILER = None
+
+
+@contextmanager
+def profiled(name, cat, **args):
+    """
+    Record the with block in the profile of the build, if it is profiled.
+    """
+    if PROFILER is None:
+        yield
+    else:
+        with PROFILER.span(name, cat, **args):
+            yield
+
+
+def parallel_map(fn, items, jobs=None):
+    """
+    Call fn on each of items using a pool of at most jobs threads and return
+    the results in the same order as items. If jobs is not given it defaults
+    to the number of CPUs. With a single job (or a single item) the calls
+    are made serially in the current thread.
+
+    The first exception raised by fn is re-raised once the pool is drained.
+    """
+    items = list(items)
+    if jobs is None:
+        jobs = cpu_count()
+    if jobs <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parallel_graph(fn, items, requires, jobs=None):
+    """
+    Call fn on each of items using a pool of at most jobs threads, only
+    calling it for an item once it has returned for every item in
+    requires[item]. Results are returned in the same order as items. If
+    jobs is not given it defaults to the number of CPUs. With a single job
+    the calls are made serially in the current thread, in the order of
+    items wherever the requirements allow.
+
+    Once fn raises no further items are started, and the first exception
+    is re-raised when the running items have finished.
+    """
+    items = list(items)
+    if jobs is None:
+        jobs = cpu_count()
+    index = dict((id(item), i) for i, item in enumerate(items))
+    waiting = [set(index[id(r)] for r in requires.get(item, ()))
+               for item in items]
+    dependents = collections.defaultdict(list)
+    for i, reqs in enumerate(waiting):
+        for r in reqs:
+            dependents[r].append(i)
+    ready = [i for i, reqs in enumerate(waiting) if not reqs]
+    results = [None] * len(items)
+    finished = Queue.Queue()
+
+    def run(i):
+        try:
+            finished.put((i, fn(items[i]), None))
+        except Exception:
+            finished.put((i, None, sys.exc_info()))
+
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    running = 0
+    done = 0
+    error = None
+    try:
+        while ready or running:
+            while ready and error is None:
+                i = ready.pop(0)
+                running += 1
+                if pool:
+                    pool.apply_async(run, (i,))
+                else:
+                    run(i)
+            if not running:
+                break
+            # a timeout keeps the wait interruptible
+            i, result, exc_info = finished.get(True, 60 * 60 * 24)
+            running -= 1
+            if exc_info:
+                error = error or exc_info
+                continue
+            results[i] = result
+            done += 1
+            for d in dependents[i]:
+                waiting[d].discard(i)
+                if not waiting[d]:
+                    ready.append(d)
+            ready.sort()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if error:
+        log.debug(''.join(traceback.format_exception(*error)))
+        raise error[1]
+    if done != len(items):
+        raise ValueError('Requirements of items form a cycle')
+    return results
+
+
+def walk(pathobj, fn, matcher=None, kind=None, prune=None, **kwargs):
     """walk pathobj calling fn on each matched entry yielding each
     result. If kind is 'file' or 'dir' only that type ofd entry will
     be walked. matcher is an optional function returning bool indicating
-    if the entry should be processed.
+    if the entry should be processed. prune is an optional function
+    returning bool indicating that a directory's contents should be skipped
+    entirely; the directory itself is still walked.
     """
     p = path(pathobj)
     walker = p.walk
@@ -341,6 +466,8 @@ def walk(pathobj, fn, matcher=None, kind=None, **kwargs):
         walker = p.walkfiles
     elif kind == "dir":
         walker = p.walkdir
+    if prune is not None:
+        walker = _pruned_walker(p, prune, kind)
 
     for entry in walker():
         relpath = entry.relpath(pathobj)
@@ -349,29 +476,415 @@ def walk(pathobj, fn, matcher=None, kind=None, **kwargs):
         yield (entry, fn(entry, **kwargs))
 
 
+def _pruned_walker(root, prune, kind):
+    # depth first, each directory before its contents, like Path.walk
+    def walker(directory=root):
+        for child in directory.listdir():
+            isdir = child.isdir()
+            if kind is None or (kind == "files") != isdir:
+                yield child
+            if isdir and not prune(child.relpath(root)):
+                for entry in walker(child):
+                    yield entry
+    return walker
+
+
+class IgnoreMatcher(object):
+    """
+    Compiled gitignore style patterns; calling it with a relative path
+    returns True if the path is *not* ignored.
+    """
+    def __init__(self, ignores):
+        self.spec = pathspec.PathSpec.from_lines(pathspec.GitIgnorePattern,
+                                                 ignores)
+        # patterns which, once they match a directory, match everything in it
+        self._dir_patterns = []
+        self._negated = False
+        for pattern in self.spec.patterns:
+            if pattern.include is False:
+                self._negated = True
+            elif pattern.include:
+                regex = pattern.regex.pattern
+                for suffix in ('(?:/.*)?$', '/.*$'):
+                    if regex.endswith(suffix):
+                        self._dir_patterns.append(
+                            re.compile(regex[:-len(suffix)] + '$'))
+                        break
+
+    def __call__(self, entity):
+        return entity not in self.spec.match_files((entity,))
+
+    def prunes(self, directory):
+        """Is everything inside directory ignored?"""
+        if self._negated:
+            # a later pattern could bring back something inside it
+            return False
+        return any(p.match(directory) for p in self._dir_patterns)
+
+
+_ignore_matchers = {}
+
+
 def ignore_matcher(ignores=[]):
-    spec = pathspec.PathSpec.from_lines(pathspec.GitIgnorePattern, ignores)
+    key = tuple(ignores)
+    if key not in _ignore_matchers:
+        _ignore_matchers[key] = IgnoreMatcher(ignores)
+    return _ignore_matchers[key]
+
+
+SIGN_CHUNK_SIZE = 1024 * 1024
+
 
-    def matcher(entity):
-        return entity not in spec.match_files((entity,))
-    return matcher
+def _hash_file(pathobj, hasher):
+    with open(pathobj, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(SIGN_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
 
 
 def sign(pathobj):
     p = path(pathobj)
     if not p.isfile():
         return None
-    return hashlib.sha256(p.bytes()).hexdigest()
+    return _hash_file(p, hashlib.sha256()).hexdigest()
+
+
+_sign_pool = None
+_sign_pool_lock = threading.Lock()
+
+
+def sign_files(paths):
+    """
+    Return the :func:`sign` of each of paths, in the same order.
+
+    Files are hashed in parallel on a thread pool shared by all callers,
+    with one thread per CPU; reading and hashing large buffers both
+    release the GIL.
+    """
+    global _sign_pool
+    paths = list(paths)
+    if len(paths) <= 1 or cpu_count() <= 1:
+        return [sign(p) for p in paths]
+    pid = os.getpid()
+    with _sign_pool_lock:
+        if _sign_pool is None or _sign_pool[0] != pid:
+            # a forked child can't use its parent's threads
+            _sign_pool = (pid, ThreadPool(cpu_count()))
+        pool = _sign_pool[1]
+    return pool.map(sign, paths)
+
+
+class HashingWriter(object):
+    """
+    Wrap a file object opened for writing, keeping a SHA256 of everything
+    written through it, so that the file needn't be read back to sign it.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.fp.write(data)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'auto')
+FICLONE = 0x40049409  # from linux/fs.h
+# errors meaning a link or clone isn't possible here, rather than a failure
+_LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+                errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.ETXTBSY)
+
+
+def _reflink(src, dst):
+    """Clone src to dst, sharing its blocks; raises OSError if unable."""
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except IOError as e:
+            if e.errno not in _LINK_ERRORS:
+                raise
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is None:
+            raise OSError(errno.EOPNOTSUPP, 'Unable to clone', src)
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            copied = copy_file_range(s.fileno(), d.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
 
+def unlink_output(filename):
+    """
+    Remove the output file filename, if any, before it is written, so
+    that the write can't change another file it is (hard or sym)linked to.
+    """
+    filename = path(filename)
+    if filename.isdir() and not filename.islink():
+        raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), filename)
+    if filename.islink() or filename.exists():
+        filename.remove()
+
+
+def copy_file(src, dst, mode='copy', hasher=None):
+    """
+    Materialize the file src at dst, preserving its mode and times.
+
+    With a ``mode`` of ``hardlink``, dst is linked to src if src is
+    read-only, since writing to a hardlinked output would also change its
+    source, and with ``reflink`` it shares src's blocks (or is copied in
+    the kernel with copy_file_range) where the filesystem supports it.
+    ``auto`` does both: it hardlinks read-only files and reflinks the rest.
+    Whenever a link isn't possible, e.g. across devices, the file is
+    copied instead.  dst can't be a directory.
+
+    If a ``hasher`` (e.g. from :func:`hashlib.sha256`) is given, it is
+    updated with the contents of the file as it is copied.
+    """
+    src, dst = path(src), path(dst)
+    unlink_output(dst)
+    if mode in ('hardlink', 'auto') and not src.stat().st_mode & 0o222:
+        try:
+            os.link(src.realpath(), dst)
+            if hasher is not None:
+                _hash_file(dst, hasher)
+            return dst
+        except OSError as e:
+            if e.errno not in _LINK_ERRORS:
+                raise
+    if mode in ('reflink', 'auto'):
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            if hasher is not None:
+                _hash_file(dst, hasher)
+            return dst
+        except (IOError, OSError) as e:
+            if e.errno not in _LINK_ERRORS:
+                raise
+            dst.remove_p()
+    if hasher is None:
+        shutil.copy2(src, dst)
+        return dst
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        for chunk in iter(lambda: s.read(SIGN_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            d.write(chunk)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def move_file(src, dst, hasher=None):
+    """
+    Move the file src to dst, copying it with :func:`copy_file` if it's on
+    another device, and updating ``hasher`` with its contents if given.
+    Either way dst never exists with only part of the file.
+    """
+    src, dst = path(src), path(dst)
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix='.' + dst.name)
+        os.close(fd)
+        try:
+            copy_file(src, tmp, hasher=hasher)
+            os.rename(tmp, dst)
+        except Exception:
+            path(tmp).remove_p()
+            raise
+        src.remove()
+    else:
+        if hasher is not None:
+            _hash_file(dst, hasher)
+    return dst
+
+
+def copy_tree(src, dst, mode='copy'):
+    """
+    Like :func:`shutil.copytree` with ``symlinks=True``, but materializing
+    each file with :func:`copy_file`.
+    """
+    src, dst = path(src), path(dst)
+    dst.makedirs()
+    for entry in src.listdir():
+        target = dst / entry.name
+        if entry.islink():
+            os.symlink(entry.readlink(), target)
+        elif entry.isdir():
+            copy_tree(entry, target, mode)
+        else:
+            copy_file(entry, target, mode)
+    shutil.copystat(src, dst)
+    return dst
+
+
+# libyaml's loader, where PyYAML was built with it, constructs the same
+# objects as the pure Python SafeLoader, several times faster
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# {file: (sha256 of its contents, what they parsed to)}
+_parsed_yaml = {}
+
+
+def load_yaml(filename, text=None):
+    """
+    Safely parse the YAML file filename, whose contents can be passed as
+    text if they have already been read.  Errors are PyYAML's.
 
-def delta_signatures(manifest_filename):
+    What each file parses to is remembered for the life of the process, and
+    a copy of it returned for as long as the file has the same contents.
+
+    Files which are written back out, and so must keep their comments and
+    key order, are parsed with ruamel.yaml's RoundTripLoader instead; as
+    copying those documents loses their comments, they aren't remembered.
+    """
+    filename = path(filename).abspath()
+    if text is None:
+        text = filename.bytes()
+    digest = hashlib.sha256(text).digest()
+    cached = _parsed_yaml.get(filename)
+    if cached is None or cached[0] != digest:
+        cached = _parsed_yaml[filename] = (
+            digest, yaml.load(text, Loader=YAMLLoader))
+    # callers are free to change what they get
+    return copy.deepcopy(cached[1])
+
+
+# the earliest time a zip entry can have
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def write_zip(filename, root, relpaths, data=None):
+    """
+    Write the files relpaths of the directory root to a zip archive which
+    is the same, byte for byte, for the same files: entries are in sorted
+    order with a fixed timestamp, and keep their file modes.  Symlinks are
+    stored as links.  data maps relpaths to the contents to store instead
+    of those of the file.
+
+    The archive is written next to filename and renamed over it once done.
+    """
+    filename, root, data = path(filename), path(root), data or {}
+    fd, tmp = tempfile.mkstemp(dir=filename.abspath().parent,
+                               prefix='.{}.'.format(filename.name))
+    try:
+        with os.fdopen(fd, 'wb') as fp, closing(zipfile.ZipFile(
+                fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)) as archive:
+            for relpath in sorted(set(relpaths) | set(data)):
+                src = root / relpath
+                st = os.lstat(src) if os.path.lexists(src) else None
+                if relpath in data:
+                    mode = st.st_mode if st else stat.S_IFREG | 0o644
+                    contents = data[relpath]
+                elif st is None:
+                    continue
+                elif stat.S_ISLNK(st.st_mode):
+                    mode, contents = st.st_mode, os.readlink(src)
+                else:
+                    mode, contents = st.st_mode, src.bytes()
+                info = zipfile.ZipInfo(relpath, ZIP_DATE_TIME)
+                info.create_system = 3  # unix, for the modes to be used
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = (mode & 0xFFFF) << 16
+                archive.writestr(info, contents)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except BaseException:
+        path(tmp).remove_p()
+        raise
+    return filename
+
+
+def file_stat(pathobj):
+    """
+    Return the [size, mtime_ns, inode, mode] of a file, as recorded in build
+    manifests to tell whether it may have changed without hashing it.
+    """
+    st = os.stat(pathobj)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10 ** 9)
+    return [st.st_size, mtime_ns, st.st_ino, st.st_mode]
+
+
+class SignatureCache(object):
+    """
+    The :func:`sign` of files, reusing those recorded by a previous build
+    for files whose stat info hasn't changed since, as
+    :func:`delta_signatures` does for the files it outputs.
+
+    ``recorded`` maps absolute paths to their [size, mtime_ns, inode,
+    mode, SHA256], as collected in ``used`` by :meth:`sign`, and
+    ``written`` is the mtime_ns of the manifest they were recorded in;
+    files modified in that same instant are hashed again.
+    """
+    def __init__(self, recorded=None, written=None):
+        self.recorded = recorded or {}
+        self.written = written
+        self.used = {}
+
+    def sign(self, filename):
+        filename = os.path.abspath(filename)
+        try:
+            st = file_stat(filename)
+        except OSError:
+            return None
+        recorded = self.recorded.get(filename)
+        if recorded and recorded[:4] == st and st[1] < self.written:
+            sig = recorded[4]
+        else:
+            sig = sign(filename)
+        if sig is not None:
+            self.used[filename] = st + [sig]
+        return sig
+
+
+def delta_signatures(manifest_filename, paranoid=False, known=None):
+    """
+    Compare the files next to a build manifest with the signatures in it,
+    returning the sets of added, changed and deleted files.
+
+    Only files whose stat info differs from that recorded in the manifest
+    are hashed, unless ``paranoid`` is set.  Files modified in the same
+    instant as the manifest was written are hashed as well, since their
+    stat info can't be trusted to show a later change.  ``known`` can give
+    signatures, by relative path, that have just been computed for files.
+    """
     md = path(manifest_filename)
     repo = md.normpath().dirname()
 
     expected = json.load(md.open())
+    stats = {} if paranoid else expected.get('stats', {})
+    known = known or {}
+    written = file_stat(md)[1]
     current = {}
-    for rel, sig in walk(repo, sign):
-        rel = rel.relpath(repo)
+    unknown = []
+    for entry in repo.walk():
+        rel = entry.relpath(repo)
+        if not entry.isfile():
+            current[rel] = None
+        elif rel in known:
+            current[rel] = known[rel]
+        elif expected["signatures"].get(rel, [None])[0] == "build":
+            # not compared below, so there's no need to hash it
+            current[rel] = None
+        else:
+            st = file_stat(entry)
+            if stats.get(rel) == st and st[1] < written:
+                current[rel] = expected["signatures"][rel][2]
+            else:
+                unknown.append(rel)
+    for rel, sig in zip(unknown, sign_files(repo / rel for rel in unknown)):
         current[rel] = sig
     add, change, delete = set(), set(), set()
 
@@ -55,7 +55,7 @@ setup(
     entry_points={
         'console_scripts': [
             'charm-add = charmtools.generate:main',
-            'charm-build = charmtools.build.builder:main',
+            'charm-build = charmtools.buildclient:main',
             'charm-create = charmtools.create:main',
             'charm-help = charmtools.cli:usage',
             'charm-layers = charmtools.build.builder:inspect',
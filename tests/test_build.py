@@ -1,17 +1,30 @@
 #!usr/bin/env python2
 import os
 import json
+import tempfile
 import unittest
 import logging
 import pkg_resources
+import subprocess
+import threading
+import time
+import zipfile
+from StringIO import StringIO
 
 
 from charmtools import build
+from charmtools import buildclient
+from charmtools.build.cache import LayerCache
 from charmtools.build.errors import BuildError
+from charmtools.build.index import LayerIndex
+from charmtools.build.profiler import Profiler
+from charmtools.build import server
+from charmtools import fetchers
 from charmtools import utils
 from path import Path as path
 from ruamel import yaml
 import mock
+import requests
 import responses
 
 
@@ -28,6 +41,20 @@ class TestBuild(unittest.TestCase):
         path("out").rmtree_p()
         self.p_post.stop()
 
+    def builder(self, **options):
+        """A Builder of trusty/tester into out, with any options changed."""
+        bu = build.Builder()
+        bu.log_level = "WARNING"
+        bu.output_dir = "out"
+        bu.series = "trusty"
+        bu.name = "foo"
+        bu.charm = "trusty/tester"
+        bu.hide_metrics = True
+        bu.report = False
+        for name, value in options.items():
+            setattr(bu, name, value)
+        return bu
+
     def test_invalid_layer(self):
         """Test that invalid metadata.yaml files get a BuildError exception."""
         builder = build.Builder()
@@ -46,14 +73,7 @@ class TestBuild(unittest.TestCase):
                 "Ensure the YAML is valid".format(metadata.abspath()), str(e))
 
     def test_tester_layer(self):
-        bu = build.Builder()
-        bu.log_level = "WARNING"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/tester"
-        bu.hide_metrics = True
-        bu.report = False
+        bu = self.builder()
         remove_layer_file = self.dirname / 'trusty/tester/to_remove'
         remove_layer_file.touch()
         self.addCleanup(remove_layer_file.remove_p)
@@ -173,14 +193,7 @@ class TestBuild(unittest.TestCase):
         # take a generated example where a base layer has changed
         # regenerate in place
         # make some assertions
-        bu = build.Builder()
-        bu.log_level = "WARNING"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/b"
-        bu.hide_metrics = True
-        bu.report = False
+        bu = self.builder(charm="trusty/b")
         bu()
         base = path('out/trusty/foo')
         self.assertTrue(base.exists())
@@ -191,15 +204,8 @@ class TestBuild(unittest.TestCase):
 
         # now regenerate from the target
         with utils.cd("out/trusty/foo"):
-            bu = build.Builder()
-            bu.log_level = "WARNING"
-            bu.output_dir = path(os.getcwd())
-            bu.series = "trusty"
             # The generate target and source are now the same
-            bu.name = "foo"
-            bu.charm = "."
-            bu.hide_metrics = True
-            bu.report = False
+            bu = self.builder(output_dir=path(os.getcwd()), charm=".")
             bu()
             base = bu.output_dir
             self.assertTrue(base.exists())
@@ -233,6 +239,508 @@ class TestBuild(unittest.TestCase):
             init = base / "hooks/relations/mysql/__init__.py"
             self.assertTrue(init.exists())
 
+    def test_prune_ignored(self):
+        layers = path(tempfile.mkdtemp())
+        self.addCleanup(layers.rmtree_p)
+        for name in ('a', 'b'):
+            (self.dirname / 'trusty' / name).copytree(layers / 'trusty' / name)
+        (layers / 'trusty/b/.git/objects').makedirs()
+        (layers / 'trusty/b/.git/objects/00').write_text('')
+        os.environ["LAYER_PATH"] = layers
+        bu = self.builder(charm=layers / "trusty/b")
+        with mock.patch.object(path, 'listdir', autospec=True,
+                               side_effect=path.listdir) as listdir:
+            bu()
+        listed = [c[0][0] for c in listdir.call_args_list]
+        self.assertNotIn(layers / 'trusty/b/.git', listed)
+        outputs = [t.relpath for t in bu.plan
+                   if isinstance(t, build.tactics.Tactic) and
+                   hasattr(t, 'entity')]
+        self.assertIn('.git', outputs)
+        self.assertNotIn('.git/objects', outputs)
+        self.assertFalse(path('out/trusty/foo/.git').exists())
+
+    def test_ignored_not_signed(self):
+        # a file left in the output where an ignored one would go isn't
+        # part of the build, so it isn't in the manifest
+        bu = self.builder()
+        bu()
+        base = path('out/trusty/foo')
+        (base / 'tests').makedirs_p()
+        (base / 'tests/00-setup').write_text('left over\n')
+        bu.force = True
+        bu()
+        manifest = json.loads((base / '.build.manifest').text())
+        self.assertNotIn('tests/00-setup', manifest['signatures'])
+
+    def test_ignore_matcher(self):
+        matcher = utils.ignore_matcher(['.git', 'docs/', 'build', '/tmp/*'])
+        self.assertIs(matcher, utils.ignore_matcher(['.git', 'docs/',
+                                                     'build', '/tmp/*']))
+        self.assertFalse(matcher('.git'))
+        self.assertTrue(matcher('hooks/install'))
+        self.assertTrue(matcher.prunes('.git'))
+        self.assertTrue(matcher.prunes('lib/.git'))
+        self.assertTrue(matcher.prunes('docs'))
+        self.assertFalse(matcher.prunes('tmp'))
+        self.assertFalse(matcher.prunes('hooks'))
+        self.assertFalse(utils.ignore_matcher(['.git', '!.git/keep']).prunes(
+            '.git'))
+
+    def test_incremental_rebuild(self):
+        layers = path(tempfile.mkdtemp())
+        self.addCleanup(layers.rmtree_p)
+        for name in ('a', 'b'):
+            (self.dirname / 'trusty' / name).copytree(layers / 'trusty' / name)
+        os.environ["LAYER_PATH"] = layers
+        bu = self.builder(charm=layers / "trusty/b")
+        bu()
+        base = path('out/trusty/foo')
+        manifest = json.loads((base / ".build.manifest").text())
+        self.assertIn("a", manifest["fingerprints"])
+        self.assertIn("README.md", manifest["fingerprints"])
+        self.assertIn(layers / "trusty/a/a", manifest["inputs"])
+
+        def rebuild():
+            copy = build.tactics.CopyTactic.__call__
+            with mock.patch.object(build.tactics.CopyTactic, '__call__',
+                                   autospec=True, side_effect=copy) as call:
+                bu()
+            return set(c[0][0].relpath for c in call.call_args_list)
+
+        # nothing changed, so no files are copied, nor inputs hashed, again
+        with mock.patch.object(utils, 'sign', side_effect=utils.sign) as sign:
+            called = rebuild()
+        self.assertNotIn("a", called)
+        self.assertNotIn("README.md", called)
+        self.assertFalse([c for c in sign.call_args_list
+                          if c[0][0].startswith(layers)])
+        rebuilt = json.loads((base / ".build.manifest").text())
+        self.assertEqual(rebuilt["signatures"], manifest["signatures"])
+        self.assertEqual(rebuilt["fingerprints"], manifest["fingerprints"])
+        self.assertEqual(rebuilt["inputs"], manifest["inputs"])
+
+        # files are copied again in another link mode
+        with mock.patch.object(build.tactics.Tactic, 'LINK_MODE', 'reflink'):
+            called = rebuild()
+        self.assertIn("a", called)
+        called = rebuild()
+        self.assertIn("a", called)
+
+        # only the changed file is copied again
+        (layers / "trusty/a/a").write_text("changed\n")
+        called = rebuild()
+        self.assertIn("a", called)
+        self.assertNotIn("README.md", called)
+        self.assertEqual((base / "a").text(), "changed\n")
+
+        # a skipped file which a later tactic removes is not signed
+        bind = build.tactics.InterfaceBind.__call__
+
+        def remove(tactic):
+            bind(tactic)
+            (base / "README.md").remove()
+        with mock.patch.object(build.tactics.InterfaceBind, '__call__',
+                               autospec=True, side_effect=remove):
+            called = rebuild()
+        self.assertNotIn("README.md", called)
+        rebuilt = json.loads((base / ".build.manifest").text())
+        self.assertNotIn("README.md", rebuilt["signatures"])
+
+        # output modified by hand is replaced when forced
+        (base / "README.md").write_text("edited\n")
+        bu.force = True
+        called = rebuild()
+        self.assertIn("README.md", called)
+        self.assertEqual((base / "README.md").text(),
+                         (layers / "trusty/b/README.md").text())
+
+    def test_parallel_build(self):
+        manifests = []
+        for jobs, output_dir in ((1, "out"), (4, "out/parallel")):
+            bu = self.builder(output_dir=output_dir, jobs=jobs)
+            bu()
+            manifest = json.loads((bu.manifest).text())
+            # stat info is specific to each output directory
+            self.assertEqual(set(manifest.pop("stats")),
+                             set(s for s in manifest["signatures"]
+                                 if s != ".build.manifest"))
+            manifests.append(manifest)
+        self.assertEqual(manifests[0], manifests[1])
+        self.assertTrue(path("out/parallel/trusty/foo/"
+                             "hooks/data-storage-attached").exists())
+
+        requires = bu.plan_dependencies(bu.plan)
+        template = [t for t in bu.plan
+                    if t.output == bu.HOOK_TEMPLATE_FILE][0]
+        for i, tactic in enumerate(bu.plan):
+            if isinstance(tactic, build.tactics.StorageBind):
+                self.assertIn(template, requires[tactic])
+            elif type(tactic).__name__ == "READMETactic":
+                # tactics from layers wait for everything before them
+                self.assertIn(bu.plan[i - 1], requires[tactic])
+
+    def test_plan_dependencies_outputs(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        target = build.builder.Layer("foo", tmp)
+        target.directory = tmp / "out"
+        layer = build.builder.Layer("layer:bar", tmp)
+        layer.directory = tmp / "bar"
+        interface = mock.Mock()
+        interface.name = "mysql"
+        config = build.builder.BuildConfig()
+
+        def copy(relpath):
+            return build.tactics.CopyTactic(layer.directory / relpath,
+                                            target, layer, config)
+        hook = copy("hooks/db-relation-joined")
+        impl = copy("hooks/relations/mysql/requires.py")
+        other = copy("hooks/install")
+        iface = build.tactics.InterfaceCopy(interface, "db", "requires",
+                                            target, config)
+        bind = build.tactics.InterfaceBind("db", "interface:mysql", target,
+                                           config, tmp / "hook.template")
+        late = copy("hooks/relations/mysql/provides.py")
+        requires = build.Builder().plan_dependencies(
+            [hook, impl, other, iface, bind, late])
+        self.assertEqual(requires[iface], set([impl]))
+        self.assertEqual(requires[bind], set([hook]))
+        self.assertEqual(requires[late], set([iface]))
+        self.assertEqual(requires[other], set())
+
+    def test_lint_before_installers(self):
+        # pip isn't run for a plan which fails to lint
+        tactic = mock.Mock(spec=build.tactics.Tactic, output='foo')
+        tactic.sign.return_value = {}
+        tactic.fingerprint.return_value = None
+        bu = self.builder(jobs=2, force=False)
+        for run in (bu.exec_phases, bu.exec_graph):
+            tactic.lint.return_value = False
+            with mock.patch.object(bu, 'prepare_installers') as prepare:
+                with self.assertRaises(build.builder.BuildError):
+                    run([tactic], {})
+                self.assertFalse(prepare.called)
+                tactic.lint.return_value = True
+                run([tactic], {})
+                prepare.assert_called_once_with([tactic])
+
+    def test_dynamic_outputs_unlinked(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        target = build.builder.Layer("foo", tmp)
+        target.directory = tmp / "out"
+        (tmp / "out/hooks").makedirs_p()
+        (tmp / "hook.template").write_text("hook {}\n")
+        source = tmp / "source"
+        source.write_text("source\n")
+        # outputs hardlinked to a layer's files by an earlier build
+        bind = build.tactics.InterfaceBind("db", "interface:mysql", target,
+                                           None, tmp / "hook.template")
+        for hook in bind.targets:
+            os.link(source, hook)
+        os.link(source, tmp / "out/metadata.yaml")
+        bind()
+        tactic = build.tactics.MetadataYAML(
+            self.dirname / "trusty/b/metadata.yaml", target,
+            mock.Mock(url="foo", directory=self.dirname / "trusty/b"),
+            build.builder.BuildConfig())
+        tactic.read()
+        tactic()
+        self.assertEqual(source.text(), "source\n")
+        self.assertEqual(bind.targets[0].text(), "hook db\n")
+        self.assertIn("\"name\": \"b\"", (tmp / "out/metadata.yaml").text())
+
+    @mock.patch.object(utils, 'PROFILER', new_callable=Profiler)
+    def test_profile(self, profiler):
+        bu = self.builder()
+        bu()
+        trace = profiler.trace()
+        spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(
+            [e['name'] for e in spans if e['cat'] == 'phase'],
+            ['fetch', 'plan', 'lint', 'read', 'prepare', 'call', 'sign',
+             'build', 'write'])
+        self.assertIn('trusty/mysql',
+                      [e['name'] for e in spans if e['cat'] == 'fetch'])
+        tactics = [e for e in spans if e['cat'] == 'tactic']
+        self.assertEqual(len(tactics), len(bu.PHASES) * len(bu.plan))
+        for event in tactics:
+            self.assertGreaterEqual(event['dur'], 0)
+            self.assertIn('cpu', event['args'])
+            self.assertIn(event['args']['phase'], bu.PHASES)
+        summary = profiler.summary()
+        self.assertIn('trusty/mysql',
+                      [row[1] for row in summary if row[0] == 'layer'])
+        self.assertEqual([row[3] for row in summary],
+                         sorted((row[3] for row in summary), reverse=True))
+        profiler.write('out/profile.json')
+        self.assertEqual(
+            json.loads(path('out/profile.json').text()), trace)
+
+    def test_archive(self):
+        archives = []
+        for output_dir in ("out", "out/again"):
+            archive = path("out") / "{}.charm".format(len(archives))
+            bu = self.builder(output_dir=output_dir, archive=archive)
+            bu()
+            archives.append(bu.archive)
+        # the same, even though built at different times in other dirs
+        self.assertEqual(archives[0].bytes(), archives[1].bytes())
+        archive = zipfile.ZipFile(archives[0])
+        names = archive.namelist()
+        self.assertEqual(names, sorted(names))
+        manifest = json.loads(archive.read(".build.manifest"))
+        self.assertEqual(set(manifest), {"layers", "signatures"})
+        self.assertEqual(set(names), set(manifest["signatures"]))
+        hook = "hooks/config-changed"
+        self.assertEqual(archive.getinfo(hook).external_attr >> 16,
+                         (bu.target_dir / hook).stat().st_mode)
+        self.assertEqual(archive.read("README.md"),
+                         (bu.target_dir / "README.md").bytes())
+
+    def test_fetch_deps_parallel(self):
+        # fetching in parallel must keep the bottom up layer ordering
+        orders = []
+        for jobs in (1, 4):
+            bu = build.Builder()
+            bu.log_level = "WARNING"
+            bu.output_dir = "out"
+            bu.series = "trusty"
+            bu.name = "foo"
+            bu.charm = "trusty/b"
+            bu.hide_metrics = True
+            bu.jobs = jobs
+            bu.find_or_create_repo()
+            layers = bu.fetch()
+            orders.append(([l.url for l in layers["layers"]],
+                           [i.url for i in layers["interfaces"]]))
+        self.assertEqual(orders[0], orders[1])
+        self.assertEqual(orders[1], (["trusty/a", "trusty/b"],
+                                     ["interface:mysql"]))
+
+    def test_watch(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        for name in ("a", "b"):
+            (self.dirname / "trusty" / name).copytree(tmp / "trusty" / name)
+        os.environ["LAYER_PATH"] = tmp
+        bu = self.builder(charm=tmp / "trusty/b")
+        bu()
+        base = path("out/trusty/foo")
+        self.assertEqual(bu.watched_dirs(),
+                         [tmp / "trusty/b", tmp / "trusty/a",
+                          self.dirname / "interfaces/mysql"])
+
+        # a changed file only reruns the tactic for it
+        (tmp / "trusty/a/a").write_text("changed")
+        changed = set([tmp / "trusty/a/a"])
+        bu.formulate_plan({"layers": bu._layers,
+                           "interfaces": bu._interfaces})
+        self.assertEqual([t.output for t in bu.affected_tactics(changed)],
+                         ["a"])
+        bu.rebuild(changed)
+        self.assertEqual((base / "a").text(), "changed")
+        manifest = json.loads((base / ".build.manifest").text())
+        self.assertEqual(manifest["signatures"]["a"][2],
+                         utils.sign(base / "a"))
+        self.assertIn("README.md", manifest["signatures"])
+
+        # metadata.yaml also rebinds the hooks of its relations
+        affected = bu.affected_tactics(set([tmp / "trusty/b/metadata.yaml"]))
+        self.assertIn("metadata.yaml", [t.output for t in affected])
+        self.assertTrue(any(isinstance(t, build.tactics.InterfaceBind)
+                            for t in affected))
+        self.assertIsNone(bu.affected_tactics(
+            set([tmp / "trusty/b/layer.yaml"])))
+
+        # a changed layer.yaml is read again when rebuilding
+        (tmp / "trusty/b/layer.yaml").write_text(
+            'includes: ["trusty/a", "interface:mysql"]\nignore: ["a"]\n')
+        bu.rebuild(set([tmp / "trusty/b/layer.yaml"]))
+        self.assertFalse((base / "a").exists())
+        manifest = json.loads((base / ".build.manifest").text())
+        self.assertNotIn("a", manifest["signatures"])
+
+        # the watch loop rebuilds new files until interrupted
+        def sleep(interval):
+            if not (tmp / "trusty/b/new").exists():
+                (tmp / "trusty/b/new").write_text("new")
+            else:
+                raise KeyboardInterrupt()
+        with mock.patch("time.sleep", side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, bu.watch_layers)
+        self.assertEqual((base / "new").text(), "new")
+
+    def test_batch_build(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        (tmp / 'd').mkdir()
+        (tmp / 'd/layer.yaml').write_text(
+            'includes: ["trusty/a", "interface:mysql"]\n')
+        (tmp / 'd/metadata.yaml').write_text(
+            'name: d\nsummary: d\ndescription: d\n'
+            'requires:\n  db:\n    interface: mysql\n')
+        (tmp / 'charms.txt').write_text('# comment\nd\n\nmissing\n')
+        path("out").mkdir()
+        options = mock.Mock(
+            log_level="WARNING", output_dir="out", series="trusty",
+            name=None, hide_metrics=True, report=False, force=False,
+            locked=False, paranoid=False, wheelhouse_overrides=None, jobs=4)
+        charms = [path("trusty/b")] + build.builder.read_batch(
+            tmp / 'charms.txt')
+        self.assertEqual(charms[1:], [tmp / 'd', tmp / 'missing'])
+        fetch = build.builder.Fetched.fetch
+        with mock.patch.object(build.builder.Fetched, 'fetch',
+                               autospec=True, side_effect=fetch) as fetched, \
+                mock.patch.object(build.builder, 'report_proof'), \
+                mock.patch.object(build.tactics.WheelhouseTactic, 'JOBS'), \
+                mock.patch.object(build.builder.log, 'error') as error:
+            self.assertEqual(build.builder.build_batch(options, charms), 1)
+        # the layers and interfaces both charms include are fetched once
+        urls = [c[0][0].url for c in fetched.call_args_list]
+        self.assertEqual(urls.count("trusty/a"), 1)
+        self.assertEqual(urls.count("interface:mysql"), 1)
+        for name in ("b", "d"):
+            self.assertTrue(
+                (path("out/trusty") / name / ".build.manifest").exists())
+        for name in ("b", "d"):
+            self.assertTrue((path("out/trusty") / name / "a").isfile())
+            self.assertTrue(
+                (path("out/trusty") / name / "hooks/relations/mysql").isdir())
+        self.assertEqual(error.call_args[0][:2],
+                         ('  FAILED %s: %s', tmp / 'missing'))
+
+    def test_batch_jobs(self):
+        options = mock.Mock(
+            log_level="WARNING", output_dir="out", series="trusty",
+            name=None, hide_metrics=True, report=False, force=False,
+            locked=False, paranoid=False, wheelhouse_overrides=None, jobs=5)
+        jobs = []
+
+        def build_one(i):
+            jobs.append((build.builder._batch[i].jobs,
+                         build.tactics.WheelhouseTactic.JOBS))
+            return None, 0
+        pool = mock.Mock()
+        pool.return_value.map.side_effect = lambda f, it: [f(i) for i in it]
+        with mock.patch.object(build.builder.multiprocessing, 'Pool', pool), \
+                mock.patch.object(build.builder, '_batch_build',
+                                  side_effect=build_one), \
+                mock.patch.object(build.builder.Builder, 'check_paths'), \
+                mock.patch.object(build.builder.Builder, 'prefetch'), \
+                mock.patch.object(build.tactics.WheelhouseTactic, 'JOBS'):
+            build.builder.build_batch(options,
+                                      [path("trusty/a"), path("trusty/b")])
+        # the two charms built at once share the jobs between them
+        self.assertEqual(pool.call_args[0][0], 2)
+        self.assertEqual(jobs, [(2, 2), (2, 2)])
+
+    def test_build_lock(self):
+        bu = self.builder(charm="trusty/b")
+        bu()
+        base = path('out/trusty/foo')
+        lock = json.loads((base / "build.lock").text())
+        # local layers and interfaces can't be pinned
+        self.assertEqual(lock, {'layers': {}, 'interfaces': {},
+                                'python_packages': {}})
+        manifest = json.loads((base / ".build.manifest").text())
+        self.assertIn("build.lock", manifest["signatures"])
+
+        # a locked build takes the lock from the previous build
+        bu = self.builder(charm="trusty/b", locked=True)
+        bu()
+        self.assertEqual(bu.lock, lock)
+
+    def test_sign_while_writing(self):
+        bu = self.builder(charm="trusty/b")
+        with mock.patch.object(utils, 'sign', side_effect=utils.sign) as sign:
+            bu()
+        signed = [c[0][0] for c in sign.call_args_list]
+        base = path('out/trusty/foo')
+        # only the empty __init__.py made for the interface is read back
+        self.assertEqual([f for f in signed if f.startswith(base)],
+                         [base / "hooks/relations/mysql/__init__.py"])
+        manifest = json.loads((base / ".build.manifest").text())
+        for relpath, (_, _, sig) in manifest["signatures"].items():
+            if (base / relpath).isfile() and relpath != ".build.manifest":
+                self.assertEqual(sig, utils.sign(base / relpath), relpath)
+
+    def test_stat_delta(self):
+        bu = self.builder(charm="trusty/b")
+        bu()
+        manifest = bu.manifest
+        # make sure no file looks like it was written with the manifest
+        later = manifest.mtime + 2
+        os.utime(manifest, (later, later))
+
+        with mock.patch.object(utils, 'sign', side_effect=utils.sign) as sign:
+            self.assertEqual(utils.delta_signatures(manifest),
+                             (set(), set(), set()))
+            self.assertFalse(sign.called)
+
+        readme = path('out/trusty/foo/README.md')
+        readme.write_text(readme.text() + 'edited')
+        with mock.patch.object(utils, 'sign', side_effect=utils.sign) as sign:
+            self.assertEqual(utils.delta_signatures(manifest),
+                             (set(), {'README.md'}, set()))
+            self.assertEqual(sign.call_count, 1)
+            utils.delta_signatures(manifest, paranoid=True)
+            self.assertGreater(sign.call_count, 2)
+
+    def test_tactic_index(self):
+        tactics = build.tactics
+
+        class Custom(tactics.Tactic):
+            @classmethod
+            def trigger(cls, relpath):
+                return False
+
+        index = tactics.TacticIndex.get([Custom] + tactics.DEFAULT_TACTICS)
+        generic = [Custom, tactics.IgnoreTactic, tactics.ExcludeTactic]
+        self.assertEqual(index.candidates(path("metadata.yaml")),
+                         generic + [tactics.MetadataYAML,
+                                    tactics.CopyTactic])
+        self.assertEqual(index.candidates(path("composer.yaml")),
+                         generic + [tactics.LayerYAML, tactics.CopyTactic])
+        self.assertEqual(index.candidates(path("lib/foo.pypi")),
+                         generic + [tactics.InstallerTactic,
+                                    tactics.CopyTactic])
+        self.assertEqual(index.candidates(path("hooks/start")),
+                         generic + [tactics.CopyTactic])
+        self.assertTrue(index.old_convention(Custom))
+        self.assertFalse(index.old_convention(tactics.CopyTactic))
+        self.assertIs(tactics.TacticIndex.get([Custom] +
+                                              tactics.DEFAULT_TACTICS), index)
+
+    @mock.patch("charmtools.build.builder.metrics_info")
+    def test_metrics(self, metrics_info):
+        metrics_info.return_value = {'cid': 'client', 'av': '1.0'}
+        bu = build.Builder()
+        bu.log_level = "WARNING"
+        bu.output_dir = "out"
+        bu.series = "trusty"
+        bu.name = "foo"
+        bu.charm = "trusty/b"
+        with mock.patch('requests.post') as post:
+            bu.find_or_create_repo()
+            bu.fetch()
+            # nothing is sent while the build is running
+            self.assertFalse(post.called)
+            bu.flush_metrics()
+            bu.wait_for_metrics()
+        # all of the events go out in a single batch
+        post.assert_called_once_with(bu.METRICS_BATCH_URL,
+                                     timeout=bu.METRICS_TIMEOUT,
+                                     data=mock.ANY)
+        hits = post.call_args[1]['data'].splitlines()
+        # the charm itself, its base layer and its interface
+        self.assertEqual(len(hits), 3)
+        self.assertIn('ec=charm', hits[0])
+        self.assertTrue(any('ec=layer&el=a&' in hit for hit in hits))
+        self.assertTrue(all('cid=client' in hit for hit in hits))
+        self.assertEqual(bu.metrics, [])
+
     @responses.activate
     def test_remote_interface(self):
         # XXX: this test does pull the git repo in the response
@@ -247,14 +755,7 @@ class TestBuild(unittest.TestCase):
                       "summary": "Postgres interface"
                       }''',
                       content_type="application/json")
-        bu = build.Builder()
-        bu.log_level = "WARNING"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/c-reactive"
-        bu.hide_metrics = True
-        bu.report = False
+        bu = self.builder(charm="trusty/c-reactive")
         bu()
         base = path('out/trusty/foo')
         self.assertTrue(base.exists())
@@ -283,14 +784,7 @@ class TestBuild(unittest.TestCase):
                       "summary": "Base layer for all charms"
                       }''',
                       content_type="application/json")
-        bu = build.Builder()
-        bu.log_level = "WARNING"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/use-layers"
-        bu.hide_metrics = True
-        bu.report = False
+        bu = self.builder(charm="trusty/use-layers")
         # remove the sign phase
         bu.PHASES = bu.PHASES[:-2]
 
@@ -308,14 +802,7 @@ class TestBuild(unittest.TestCase):
 
     @mock.patch("charmtools.utils.Process")
     def test_pypi_installer(self, mcall):
-        bu = build.Builder()
-        bu.log_level = "WARN"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/chlayer"
-        bu.hide_metrics = True
-        bu.report = False
+        bu = self.builder(log_level="WARN", charm="trusty/chlayer")
 
         # remove the sign phase
         bu.PHASES = bu.PHASES[:-2]
@@ -324,36 +811,295 @@ class TestBuild(unittest.TestCase):
                                   "--user", "--ignore-installed",
                                   mock.ANY), env=mock.ANY)
 
+    def test_pypi_installer_cache(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        (tmp / 'layer/lib').makedirs()
+        (tmp / 'layer/lib/six.pypi').write_text('six==1.11.0\n')
+        (tmp / 'layer/lib/foo.pypi').write_text('foo==1.0\n')
+        (tmp / 'layer/lib/bar.pypi').write_text('bar\n')
+        layer = mock.Mock(directory=tmp / 'layer', url='layer:test')
+        installs = []
+
+        def Process(args, env=None):
+            if args[:2] == ('pip3', 'install'):
+                installs.append(args[-1])
+                site = path(env['PYTHONUSERBASE']) / \
+                    'lib/python3.6/site-packages'
+                site.makedirs_p()
+                name = args[-1].split('=')[0]
+                (site / name).mkdir()
+                (site / name / '__init__.py').write_text(args[-1])
+            process = mock.Mock(
+                return_value=utils.ProcessResult(args, 0, 'pip 9', ''))
+            process.exit_on_error.return_value = process
+            return process
+
+        bu = build.Builder()
+        bu.jobs = 2
+        for _ in range(2):
+            target = build.Fetched.__new__(build.Fetched)
+            target.directory = tmp / 'charm'
+            target.directory.rmtree_p()
+            plan = [build.tactics.InstallerTactic(
+                tmp / 'layer/lib' / name, target, layer, mock.Mock())
+                for name in ('six.pypi', 'foo.pypi', 'bar.pypi')]
+            with mock.patch.object(build.tactics.InstallerTactic,
+                                   'CACHE_DIR', tmp / 'cache'), \
+                    mock.patch.object(build.tactics.InstallerTactic,
+                                      '_pip_version', None), \
+                    mock.patch('charmtools.utils.Process', Process):
+                bu.prepare_installers(plan)
+                for tactic in plan:
+                    tactic()
+            for name in ('six', 'foo', 'bar'):
+                self.assertTrue(
+                    (tmp / 'charm/lib' / name / '__init__.py').isfile())
+            sigs = plan[0].sign()
+            self.assertEqual(sigs.keys(), ['lib/six/__init__.py'])
+            self.assertEqual(sigs['lib/six/__init__.py'][2],
+                             utils.sign(tmp / 'charm/lib/six/__init__.py'))
+        # pinned specs are installed once, others every build
+        self.assertEqual(sorted(installs), ['bar', 'bar',
+                                            'foo==1.0', 'six==1.11.0'])
+
     @mock.patch("path.Path.rmtree_p")
     @mock.patch("tempfile.mkdtemp")
     @mock.patch("charmtools.utils.Process")
     def test_wheelhouse(self, Process, mkdtemp, rmtree_p):
         mkdtemp.return_value = '/tmp'
-        bu = build.Builder()
-        bu.log_level = "WARN"
-        bu.output_dir = "out"
-        bu.series = "trusty"
-        bu.name = "foo"
-        bu.charm = "trusty/whlayer"
-        bu.hide_metrics = True
-        bu.report = False
-        bu.wheelhouse_overrides = self.dirname / 'wh-over.txt'
+        bu = self.builder(log_level="WARN", charm="trusty/whlayer",
+                          wheelhouse_overrides=self.dirname / 'wh-over.txt')
 
         # remove the sign phase
         bu.PHASES = bu.PHASES[:-2]
+        merged = path('/tmp/wheelhouse.txt')
+        self.addCleanup(merged.remove_p)
         with mock.patch("path.Path.mkdir_p"):
             with mock.patch("path.Path.files"):
                 bu()
-                Process.assert_any_call((
-                    'bash', '-c', '. /tmp/bin/activate ;'
-                    ' pip3 download --no-binary :all: '
-                    '-d /tmp -r ' +
-                    self.dirname / 'trusty/whlayer/wheelhouse.txt'))
-                Process.assert_any_call((
+                # all layers and the overrides are downloaded in one pass
+                downloads = [c for c in Process.call_args_list
+                             if 'pip3 download' in c[0][0][-1]]
+                self.assertEqual(downloads, [mock.call((
                     'bash', '-c', '. /tmp/bin/activate ;'
                     ' pip3 download --no-binary :all: '
-                    '-d /tmp -r ' +
-                    self.dirname / 'wh-over.txt'))
+                    '-d /tmp -r /tmp/wheelhouse.txt'))])
+        # the overrides replace the layer's pin, in the same position
+        self.assertEqual(merged.text(), 'foo==1.5\nbar==1.0\n')
+
+    def test_wheelhouse_parallel(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        (tmp / 'wheelhouse.txt').write_text(
+            'six==1.11.0 --hash=sha256:abc\n'
+            'foo[bar]==1.0 --hash=sha256:def\n'
+            'bar==2.0 --hash=sha256:123\n')
+        target = mock.Mock(directory=tmp / 'charm')
+        target.directory.makedirs_p()
+        layer = mock.Mock(directory=tmp, url='layer:wh')
+        tactic = build.tactics.WheelhouseTactic(
+            tmp / 'wheelhouse.txt', target, layer, mock.Mock())
+        tactic.constraints = {'bar': '2.0'}
+        calls = []
+        running = []
+
+        def pip(*args, **kwargs):
+            running.append(args)
+            constraints = path(args[args.index('-c') + 1])
+            calls.append((args, constraints.text(), len(running)))
+            dest = path(args[args.index('-d') + 1])
+            req = path(args[args.index('-r') + 1]).text()[:3]
+            (dest / req + '-1.0.tar.gz').write_text(req)
+            self.assertFalse(kwargs['exit'])
+            time.sleep(0.05)
+            running.remove(args)
+            return mock.Mock()
+
+        with mock.patch.object(build.tactics.WheelhouseTactic, 'JOBS', 4), \
+                mock.patch.object(build.tactics.WheelhouseTactic,
+                                  'HOST_JOBS', 2), \
+                mock.patch.object(tactic, '_ensure_venv'), \
+                mock.patch.object(tactic, '_run_in_venv', side_effect=pip):
+            tactic()
+        self.assertEqual(len(calls), 3)
+        for args, constraints, concurrent in calls:
+            # the hashed pins are the whole resolution, so each pip only
+            # needs its own line
+            self.assertIn('--no-deps', args)
+            self.assertEqual(constraints, 'bar==2.0\n')
+            self.assertLessEqual(concurrent, 2)
+        self.assertEqual(sorted(f.name for f in tactic.tracked),
+                         ['bar-1.0.tar.gz', 'foo-1.0.tar.gz',
+                          'six-1.0.tar.gz'])
+
+    def test_wheelhouse_not_locked(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        layer = mock.Mock(directory=tmp, url='layer:wh')
+        (tmp / 'dl').mkdir()
+        # partly hashed, or pinned without the dependencies' pins
+        for text in ('six==1.11.0 --hash=sha256:abc\nfoo==1.0\n',
+                     'six==1.11.0\nfoo==1.0\n'):
+            (tmp / 'wheelhouse.txt').write_text(text)
+            tactic = build.tactics.WheelhouseTactic(
+                tmp / 'wheelhouse.txt', mock.Mock(), layer, mock.Mock())
+            with mock.patch.object(build.tactics.WheelhouseTactic,
+                                   'JOBS', 2), \
+                    mock.patch.object(tactic, '_pip') as pip, \
+                    mock.patch.object(tactic, '_run_in_venv') as run:
+                tactic._download(tmp / 'dl', '-r', tmp / 'wheelhouse.txt')
+            # one pip resolves every line, and their dependencies, at once
+            self.assertFalse(run.called)
+            self.assertEqual(pip.call_count, 1)
+            self.assertNotIn('--no-deps', pip.call_args[0])
+
+    def test_binary_wheels(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        (tmp / 'wheelhouse.txt').write_text('six==1.0\nnetifaces==0.1\n')
+        target = mock.Mock(directory=tmp / 'charm')
+        layer = mock.Mock(directory=tmp, url='layer:wh')
+        built = []
+
+        def download(temp_dir, *reqs):
+            for name in ('six-1.0.tar.gz', 'netifaces-0.1.tar.gz'):
+                (temp_dir / name).write_text(name)
+            return temp_dir.files()
+
+        def pip(*args, **kwargs):
+            sdist = path(args[-1])
+            built.append(sdist.name)
+            if sdist.name.startswith('six'):
+                dest = path(args[args.index('-w') + 1])
+                (dest / 'six-1.0-py3-none-any.whl').write_text('wheel')
+                return utils.ProcessResult(args, 0, '', '')
+            return utils.ProcessResult(args, 1, '', 'no compiler')
+
+        for _ in range(2):
+            target.directory.rmtree_p()
+            target.directory.makedirs_p()
+            tactic = build.tactics.WheelhouseTactic(
+                tmp / 'wheelhouse.txt', target, layer, mock.Mock())
+            with mock.patch.multiple(build.tactics.WheelhouseTactic,
+                                     BINARY_WHEELS=True,
+                                     CACHE_DIR=tmp / 'cache'), \
+                    mock.patch.object(tactic, '_python_tag',
+                                      return_value='cp36-x86_64'), \
+                    mock.patch.object(tactic, '_ensure_venv'), \
+                    mock.patch.object(tactic, '_download',
+                                      side_effect=download), \
+                    mock.patch.object(tactic, '_run_in_venv',
+                                      side_effect=pip):
+                tactic()
+            # the wheel is used where it could be built, else the sdist
+            self.assertEqual(
+                sorted(f.name for f in tactic.tracked),
+                ['netifaces-0.1.tar.gz', 'six-1.0-py3-none-any.whl'])
+            self.assertEqual(
+                sorted(f.name for f in (tmp / 'charm/wheelhouse').files()),
+                ['netifaces-0.1.tar.gz', 'six-1.0-py3-none-any.whl'])
+            self.assertEqual(tactic.pins(), {'six': '1.0', 'netifaces': '0.1'})
+        # the second build used the cached wheel
+        self.assertEqual(sorted(built), ['netifaces-0.1.tar.gz',
+                                         'netifaces-0.1.tar.gz',
+                                         'six-1.0.tar.gz'])
+
+    def test_wheelhouse_requirements(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        tactics = []
+        for name, text in (('base', 'Foo_Bar>=1.0 # comment\n'
+                                    'six\n'
+                                    '-e git+https://x/y.git#egg=y\n'),
+                           ('top', 'foo.bar==2.0\n'
+                                   'git+https://x/z.git#egg=Y\n')):
+            (tmp / name).mkdir()
+            (tmp / name / 'wheelhouse.txt').write_text(text)
+            layer = mock.Mock(directory=tmp / name, url='layer:' + name)
+            tactic = build.tactics.WheelhouseTactic(
+                tmp / name / 'wheelhouse.txt', mock.Mock(), layer, mock.Mock())
+            if tactics:
+                tactic.combine(tactics[-1])
+            tactics.append(tactic)
+        reqs = tactics[-1].requirements()
+        self.assertEqual(
+            [(k, line, t.origin) for k, (line, t) in reqs.items()],
+            [('foo-bar', 'foo.bar==2.0', 'layer:top'),
+             ('six', 'six', 'layer:base'),
+             ('y', 'git+https://x/z.git#egg=Y', 'layer:top')])
+
+    def test_wheelhouse_requirements_paths(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        tactics = []
+        for name, text in (('base', '-r extra.txt\n'
+                                    '-e .\n'
+                                    './pkg\n'
+                                    'enum34; python_version < "3.4"\n'
+                                    '-e git+https://x/y.git#egg=y\n'),
+                           ('top', '--constraint=/abs/c.txt\n'
+                                   'enum34==1.1;python_version<"3.4"\n'
+                                   'enum34; python_version >= "3.4"\n')):
+            (tmp / name).mkdir()
+            (tmp / name / 'wheelhouse.txt').write_text(text)
+            layer = mock.Mock(directory=tmp / name, url='layer:' + name)
+            tactic = build.tactics.WheelhouseTactic(
+                tmp / name / 'wheelhouse.txt', mock.Mock(), layer, mock.Mock())
+            if tactics:
+                tactic.combine(tactics[-1])
+            tactics.append(tactic)
+        reqs = tactics[-1].requirements()
+        self.assertEqual(
+            [(k, line) for k, (line, t) in reqs.items()],
+            [('-r {}/base/extra.txt'.format(tmp),
+              '-r {}/base/extra.txt'.format(tmp)),
+             ('-e {}/base'.format(tmp), '-e {}/base'.format(tmp)),
+             ('{}/base/pkg'.format(tmp), '{}/base/pkg'.format(tmp)),
+             ('enum34; python_version < "3.4"',
+              'enum34==1.1;python_version<"3.4"'),
+             ('y', '-e git+https://x/y.git#egg=y'),
+             ('--constraint=/abs/c.txt', '--constraint=/abs/c.txt'),
+             ('enum34; python_version >= "3.4"',
+              'enum34; python_version >= "3.4"')])
+
+    def test_wheelhouse_cache(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        pinned = tmp / 'wheelhouse.txt'
+        pinned.write_text('six==1.11.0  # comment\n')
+        unpinned = tmp / 'unpinned.txt'
+        unpinned.write_text('six>=1.0\n')
+        target = mock.Mock(directory=tmp / 'charm')
+        layer = mock.Mock(directory=tmp, url='layer:wh')
+
+        def pip(*args):
+            dest = path(args[args.index('-d') + 1])
+            (dest / 'six-1.11.0.tar.gz').write_text('six')
+
+        def build_wheelhouse(entity):
+            target.directory.makedirs_p()
+            tactic = build.tactics.WheelhouseTactic(
+                entity, target, layer, mock.Mock())
+            tactic._venv = tmp / 'venv'
+            with mock.patch.object(tactic, '_pip', side_effect=pip) as _pip:
+                tactic()
+            self.assertEqual(tactic.tracked,
+                             [tmp / 'charm/wheelhouse/six-1.11.0.tar.gz'])
+            # signed as written, whether downloaded or copied from cache
+            self.assertEqual(tactic._written[tactic.tracked[0]][0],
+                             utils.sign(tactic.tracked[0]))
+            return _pip
+
+        with mock.patch.object(build.tactics.WheelhouseTactic,
+                               'CACHE_DIR', tmp / 'cache'):
+            _pip = build_wheelhouse(pinned)
+            self.assertIn('--cache-dir', _pip.call_args[0])
+            self.assertTrue(_pip.called)
+            (tmp / 'charm').rmtree()
+            self.assertFalse(build_wheelhouse(pinned).called)
+            # unpinned requirements are always resolved by pip
+            self.assertTrue(build_wheelhouse(unpinned).called)
 
     @mock.patch.object(build.tactics, 'log')
     @mock.patch.object(build.tactics.YAMLTactic, 'read',
@@ -424,6 +1170,270 @@ class TestBuild(unittest.TestCase):
         })
 
 
+class TestLayerCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree_p)
+        self.repo = self.tmp / 'layer-foo.git'
+        self.repo.makedirs_p()
+        with utils.cd(self.repo):
+            for cmd in ('git init -q',
+                        'git config user.email test@example.com',
+                        'git config user.name test'):
+                fetchers.check_output(cmd)
+            path('layer.yaml').write_text('includes: []\n')
+            fetchers.check_output('git add layer.yaml')
+            fetchers.check_output('git commit -q -m init')
+        self.cache = LayerCache(self.tmp / 'cache')
+
+    def fetch(self, name='foo', revision=''):
+        fetcher = build.fetchers.LayerFetcher('layer:' + name,
+                                              repo='file://' + self.repo,
+                                              revision=revision)
+        deps = self.tmp / 'deps'
+        deps.makedirs_p()
+        return self.cache.fetch(fetcher, deps)
+
+    def test_fetch_once(self):
+        target = self.fetch()
+        self.assertEqual(target, self.tmp / 'deps' / 'foo')
+        self.assertTrue((target / 'layer.yaml').exists())
+        self.assertEqual(len(self.cache._entries()), 1)
+        with mock.patch.object(fetchers.GitFetcher, 'fetch') as fetch:
+            target = self.fetch()
+            self.assertFalse(fetch.called)
+        self.assertTrue((target / 'layer.yaml').exists())
+
+    def test_never_hardlinks(self):
+        self.cache.link_mode = 'hardlink'
+        self.fetch()
+        entry, = self.cache.directory.dirs()
+        (entry / 'layer.yaml').chmod(0o444)
+        target = self.fetch()
+        self.assertFalse((target / 'layer.yaml').samefile(
+            entry / 'layer.yaml'))
+
+    def test_new_revision(self):
+        self.fetch()
+        with utils.cd(self.repo):
+            path('README.md').write_text('readme\n')
+            fetchers.check_output('git add README.md')
+            fetchers.check_output('git commit -q -m readme')
+        # the remote isn't asked again until the resolved commit expires
+        target = self.fetch()
+        self.assertFalse((target / 'README.md').exists())
+        self.cache.ttl = 0
+        target = self.fetch()
+        self.assertTrue((target / 'README.md').exists())
+        self.assertEqual(len(self.cache._entries()), 2)
+
+    def test_warm_cache_offline(self):
+        self.fetch()
+        with utils.cd(self.repo):
+            commit = fetchers.check_output('git rev-parse HEAD').strip()
+        with mock.patch('charmtools.build.cache.check_output') as co:
+            self.fetch()
+            self.fetch(revision=commit[:8])
+            self.assertFalse(co.called)
+
+    def test_direct_url(self):
+        # layers included by the url of their repo aren't cached
+        url = 'file://' + self.repo
+        fetcher = build.fetchers.get_fetcher(url + '/.git')
+        self.assertIsNone(self.cache.fetch(fetcher, self.tmp / 'deps'))
+        with mock.patch.object(build.builder.Fetched, 'CACHE', self.cache):
+            layer = build.builder.Layer(url + '/.git',
+                                        self.tmp / 'deps').fetch()
+        self.assertTrue((layer.directory / 'layer.yaml').exists())
+        self.assertEqual(self.cache._entries(), [])
+
+    def test_offline(self):
+        self.fetch()
+        with mock.patch.object(self.cache, 'resolve') as resolve:
+            resolve.side_effect = fetchers.FetchError('offline')
+            target = self.fetch()
+        self.assertTrue((target / 'layer.yaml').exists())
+
+    def test_locked(self):
+        with utils.cd(self.repo):
+            commit = fetchers.check_output('git rev-parse HEAD').strip()
+            path('README.md').write_text('readme\n')
+            fetchers.check_output('git add README.md')
+            fetchers.check_output('git commit -q -m readme')
+        lock = {'repo': 'file://' + self.repo, 'commit': commit}
+        with mock.patch.object(build.builder.Fetched, 'CACHE', self.cache):
+            with mock.patch.object(build.fetchers.InterfaceFetcher,
+                                   'index') as index:
+                layer = build.builder.Layer('layer:foo', self.tmp / 'deps',
+                                            lock=lock).fetch()
+                self.assertFalse(index.called)
+        self.assertEqual(layer.revision, commit)
+        self.assertEqual(layer.repo, 'file://' + self.repo)
+        self.assertTrue((layer.directory / 'layer.yaml').exists())
+        self.assertFalse((layer.directory / 'README.md').exists())
+
+    def test_annotated_tag(self):
+        with utils.cd(self.repo):
+            fetchers.check_output('git tag -a v1 -m v1')
+            commit = fetchers.check_output('git rev-parse HEAD').strip()
+        self.assertEqual(self.cache.resolve('file://' + self.repo, 'v1'),
+                         commit)
+        self.fetch(revision='v1')
+        with mock.patch.object(fetchers.GitFetcher, 'fetch') as fetch:
+            self.fetch(revision='v1')
+            self.fetch(revision=commit[:8])
+            self.assertFalse(fetch.called)
+        self.assertEqual([e['revision'] for e in self.cache._entries()],
+                         [commit])
+
+    def test_corrupt_sidecar(self):
+        self.fetch()
+        key = self.cache._entries()[0]['key']
+        self.cache._sidecar(key).write_text('{"key": ')
+        self.assertEqual(self.cache._entries(), [])
+        target = self.fetch()
+        self.assertTrue((target / 'layer.yaml').exists())
+        self.assertEqual([e['key'] for e in self.cache._entries()], [key])
+        # sidecars are replaced whole, never written in place
+        self.assertEqual(self.cache.directory.files('.sidecar-*'), [])
+
+    def test_prune(self):
+        self.fetch()
+        key = self.cache._entries()[0]['key']
+        self.cache.prune()
+        self.assertTrue(self.cache.entry(key).exists())
+        self.cache.max_size = 0
+        self.cache.prune()
+        self.assertFalse(self.cache.entry(key).exists())
+        self.assertEqual(self.cache._entries(), [])
+
+
+class TestLayerIndex(unittest.TestCase):
+    DOMAIN = "https://index.example.com/"
+
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree_p)
+
+    def index(self, **kwargs):
+        return LayerIndex(self.DOMAIN, cache_dir=self.tmp, **kwargs)
+
+    @responses.activate
+    def test_cached(self):
+        responses.add(responses.GET, self.DOMAIN + "layers/basic.json",
+                      body='{"repo": "https://example.com/basic"}',
+                      content_type="application/json",
+                      adding_headers={"ETag": '"abc"'})
+        responses.add(responses.GET, self.DOMAIN + "layers/missing.json",
+                      status=404)
+        for index in (self.index(), self.index()):
+            self.assertEqual(index.get("layers", "basic"),
+                             {"repo": "https://example.com/basic"})
+            self.assertIsNone(index.get("layers", "missing"))
+            self.assertIsNone(index.get("layers", "missing"))
+        # only the first client had to ask, including for the missing layer
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_revalidate(self):
+        responses.add(responses.GET, self.DOMAIN + "layers/basic.json",
+                      body='{"repo": "https://example.com/basic"}',
+                      content_type="application/json",
+                      adding_headers={"ETag": '"abc"'})
+        self.index(ttl=0).get("layers", "basic")
+        responses.reset()
+        responses.add(responses.GET, self.DOMAIN + "layers/basic.json",
+                      status=304)
+        self.assertEqual(self.index(ttl=0).get("layers", "basic"),
+                         {"repo": "https://example.com/basic"})
+        self.assertEqual(responses.calls[0].request.headers["If-None-Match"],
+                         '"abc"')
+
+    @responses.activate
+    def test_offline(self):
+        responses.add(responses.GET, self.DOMAIN + "layers/basic.json",
+                      body='{"repo": "https://example.com/basic"}',
+                      content_type="application/json")
+        self.index(ttl=0).get("layers", "basic")
+        with mock.patch.object(build.index.session(), 'get') as get:
+            get.side_effect = requests.exceptions.ConnectionError()
+            self.assertEqual(self.index(ttl=0).get("layers", "basic"),
+                             {"repo": "https://example.com/basic"})
+            self.assertTrue(get.called)
+
+    @responses.activate
+    def test_expire(self):
+        responses.add(responses.GET, self.DOMAIN + "layers/basic.json",
+                      body='{"repo": "https://example.com/basic"}',
+                      content_type="application/json")
+        index = LayerIndex(self.DOMAIN, ttl=60)
+        with mock.patch('time.time') as now:
+            now.return_value = 1000
+            index.get("layers", "basic")
+            now.return_value = 1059
+            index.get("layers", "basic")
+            self.assertEqual(len(responses.calls), 1)
+            now.return_value = 1060
+            index.get("layers", "basic")
+            self.assertEqual(len(responses.calls), 2)
+
+
+class TestBuildServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree_p)
+        self.server = server.BuildServer(self.tmp / 'build.sock')
+        self.addCleanup(self.server.server_close)
+
+    def forward(self, args):
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        try:
+            return buildclient.forward(self.tmp / 'build.sock', args)
+        finally:
+            thread.join()
+
+    @mock.patch.object(buildclient, 'sys')
+    @mock.patch('charmtools.build.builder.main')
+    def test_forward(self, main, client_sys):
+        from charmtools.build import builder, tactics
+
+        def build(args):
+            self.assertIs(builder.Builder.SHARED_DEPS,
+                          self.server.shared_deps)
+            self.assertEqual(utils._parsed_yaml, {})
+            self.assertEqual(utils._ignore_matchers, {})
+            utils.ignore_matcher(['.git'])
+            print('built {}'.format(args[0]))
+            # as pip and git would
+            subprocess.check_call('echo from a subprocess >&2', shell=True)
+            tactics.TacticIndex.get([tactics.CopyTactic])
+            if args[0] == 'bad':
+                raise SystemExit(2)
+        main.side_effect = build
+        client_sys.stdout = StringIO()
+        self.assertEqual(self.forward(['trusty/foo']), 0)
+        self.assertEqual(self.forward(['bad']), 2)
+        self.assertEqual(client_sys.stdout.getvalue(),
+                         'built trusty/foo\nfrom a subprocess\n'
+                         'built bad\nfrom a subprocess\n')
+        self.assertIsNone(builder.Builder.SHARED_DEPS)
+        self.assertEqual(tactics.TacticIndex._indexes, {})
+
+    def test_no_server(self):
+        self.assertIsNone(buildclient.forward(self.tmp / 'none.sock', []))
+
+    def test_prune_deps(self):
+        fetched = mock.Mock(fetched=True, directory=self.tmp)
+        local = mock.Mock(fetched=False, directory=self.tmp)
+        self.server.shared_deps.update({'a': fetched, 'b': local})
+        self.server.prune_deps()
+        self.assertEqual(self.server.shared_deps, {'a': fetched})
+        self.server._deps_since -= LayerIndex.TTL
+        self.server.prune_deps()
+        self.assertEqual(self.server.shared_deps, {})
+
+
 class TestFetchers(unittest.TestCase):
     @mock.patch.object(build.fetchers, 'get_fetcher')
     def test_get_repo_fetcher_target(self, get_fetcher):
@@ -433,6 +1443,48 @@ class TestFetchers(unittest.TestCase):
         result = fetcher._get_repo_fetcher_and_target('repo', '/dir_')
         self.assertEqual(result, (f, '/dir_/foo'))
 
+    def test_same_directory_serialized(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        active = []
+
+        def fetch(dir_):
+            active.append(dir_)
+            self.assertEqual(len(active), 1)
+            time.sleep(0.05)
+            (dir_ / 'foo').makedirs_p()
+            active.remove(dir_)
+            return dir_ / 'foo'
+        fetcher = mock.Mock(spec=['fetch', 'get_revision', 'target', 'url'],
+                            url='layer:foo')
+        fetcher.fetch.side_effect = fetch
+        fetcher.get_revision.return_value = ''
+        # the lock is on the directory fetched into, whatever the name
+        fetcher.target.return_value = tmp / 'layer/foo'
+        layers = [build.builder.Layer(url, tmp) for url in
+                  ('layer:foo', 'layer:layer-foo')]
+        with mock.patch.object(build.builder.Layer, 'get_fetcher',
+                               return_value=fetcher):
+            utils.parallel_map(lambda layer: layer.fetch(), layers, 2)
+        self.assertEqual(fetcher.fetch.call_count, 2)
+        self.assertEqual([l.directory for l in layers],
+                         [tmp / 'layer/foo'] * 2)
+
+    def test_charmstore_not_pinned(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree_p)
+        fetcher = fetchers.CharmstoreDownloader('cs:trusty/mysql')
+        fetcher.fetch = mock.Mock(return_value=tmp / 'mysql')
+        fetcher.get_revision = mock.Mock(return_value=42)
+        (tmp / 'mysql').makedirs_p()
+        with mock.patch.object(build.builder.Layer, 'get_fetcher',
+                               return_value=fetcher):
+            layer = build.builder.Layer('cs:trusty/mysql', tmp).fetch()
+        self.assertEqual(layer.directory, tmp / 'mysql')
+        self.assertIsNone(layer.repo)
+        self.assertIsNone(layer.revision)
+        self.assertFalse(fetcher.get_revision.called)
+
 
 if __name__ == '__main__':
     logging.basicConfig()
@@ -1,4 +1,8 @@
+import errno
+import hashlib
 import os
+import threading
+import time
 import mock
 from unittest import TestCase
 from charmtools import utils
@@ -54,3 +58,210 @@ class TestUtils(TestCase):
         # some uids don't have pw_names
         with mock.patch('os.getuid', lambda: 12):
             self.assertIs(utils.get_home(), None)
+
+    def test_copy_file(self):
+        with utils.tempdir(chdir=False) as tmp:
+            src = tmp / 'src'
+            src.write_text('data')
+            src.chmod(0o644)
+            for mode in utils.LINK_MODES:
+                dst = utils.copy_file(src, tmp / 'dst', mode)
+                self.assertEqual(dst.text(), 'data')
+                self.assertEqual(dst.stat().st_mode, src.stat().st_mode)
+                # only read-only files are hardlinked
+                self.assertFalse(dst.samefile(src))
+            src.chmod(0o444)
+            for mode in ('hardlink', 'auto'):
+                dst = utils.copy_file(src, tmp / 'dst', mode)
+                self.assertTrue(dst.samefile(src))
+            # replacing a hardlinked output must not change the source
+            utils.copy_file(tmp / 'dst', tmp / 'dst2')
+            (tmp / 'dst2').chmod(0o644)
+            (tmp / 'dst2').write_text('changed')
+            utils.copy_file(tmp / 'dst2', dst)
+            self.assertEqual(src.text(), 'data')
+
+    def test_copy_file_to_directory(self):
+        with utils.tempdir(chdir=False) as tmp:
+            (tmp / 'src').write_text('data')
+            (tmp / 'dst').mkdir()
+            with self.assertRaises(IOError) as cm:
+                utils.copy_file(tmp / 'src', tmp / 'dst')
+            self.assertEqual(cm.exception.errno, errno.EISDIR)
+            self.assertTrue((tmp / 'dst').isdir())
+
+    def test_copy_file_cross_device(self):
+        with utils.tempdir(chdir=False) as tmp:
+            src = tmp / 'src'
+            src.write_text('data')
+            src.chmod(0o444)
+            with mock.patch('os.link') as link:
+                link.side_effect = OSError(errno.EXDEV, 'Cross-device')
+                dst = utils.copy_file(src, tmp / 'dst', 'hardlink')
+            self.assertTrue(link.called)
+            self.assertFalse(dst.samefile(src))
+            self.assertEqual(dst.text(), 'data')
+
+    def test_signature_cache(self):
+        with utils.tempdir(chdir=False) as tmp:
+            (tmp / 'file').write_text('data')
+            (tmp / 'manifest').write_text('{}')
+            written = utils.file_stat(tmp / 'manifest')[1] + 1
+            cache = utils.SignatureCache()
+            sig = cache.sign(tmp / 'file')
+            self.assertEqual(sig, utils.sign(tmp / 'file'))
+            self.assertIsNone(cache.sign(tmp / 'missing'))
+            self.assertEqual(list(cache.used), [tmp / 'file'])
+
+            cache = utils.SignatureCache(cache.used, written)
+            with mock.patch.object(utils, 'sign') as sign:
+                self.assertEqual(cache.sign(tmp / 'file'), sig)
+                self.assertFalse(sign.called)
+            # modified in the same instant as recorded
+            cache.written = utils.file_stat(tmp / 'file')[1]
+            with mock.patch.object(utils, 'sign') as sign:
+                cache.sign(tmp / 'file')
+                self.assertTrue(sign.called)
+            (tmp / 'file').write_text('changed')
+            cache.written = None
+            self.assertEqual(cache.sign(tmp / 'file'),
+                             utils.sign(tmp / 'file'))
+
+    def test_copy_tree(self):
+        with utils.tempdir(chdir=False) as tmp:
+            (tmp / 'src/sub').makedirs()
+            (tmp / 'src/sub/file').write_text('data')
+            os.symlink('sub/file', tmp / 'src/link')
+            dst = utils.copy_tree(tmp / 'src', tmp / 'dst', 'auto')
+            self.assertEqual((dst / 'sub/file').text(), 'data')
+            self.assertEqual((dst / 'link').readlink(), 'sub/file')
+
+    def test_sign(self):
+        with utils.tempdir(chdir=False) as tmp:
+            data = b'x' * (utils.SIGN_CHUNK_SIZE + 1)
+            (tmp / 'file').write_bytes(data)
+            self.assertEqual(utils.sign(tmp / 'file'),
+                             hashlib.sha256(data).hexdigest())
+            self.assertIsNone(utils.sign(tmp))
+
+            with open(tmp / 'written', 'w') as fp:
+                writer = utils.HashingWriter(fp)
+                writer.write('some ')
+                writer.write(u'data')
+            self.assertEqual(writer.hexdigest(), utils.sign(tmp / 'written'))
+
+            hasher = hashlib.sha256()
+            rename = os.rename
+
+            def cross_device(src, dst):
+                # the file is on another device, its copy isn't
+                if src == tmp / 'file':
+                    raise OSError(errno.EXDEV, 'Cross-device')
+                rename(src, dst)
+            with mock.patch('os.rename', side_effect=cross_device):
+                utils.move_file(tmp / 'file', tmp / 'moved', hasher)
+            self.assertFalse((tmp / 'file').exists())
+            self.assertEqual(hasher.hexdigest(), utils.sign(tmp / 'moved'))
+            self.assertEqual(sorted(f.name for f in tmp.files()),
+                             ['moved', 'written'])
+
+    def test_sign_files(self):
+        with utils.tempdir(chdir=False) as tmp:
+            files = []
+            for i in range(20):
+                files.append(tmp / str(i))
+                files[-1].write_text(str(i) * i)
+            files.append(tmp / 'missing')
+            with mock.patch.object(utils, 'cpu_count', return_value=4):
+                self.assertEqual(utils.sign_files(files),
+                                 [utils.sign(f) for f in files])
+
+    def test_sign_files_one_pool(self):
+        from multiprocessing.pool import ThreadPool
+        pools = []
+
+        def pool(processes):
+            # let other callers in while this one makes its pool
+            time.sleep(0.05)
+            pools.append(ThreadPool(processes))
+            return pools[-1]
+        with utils.tempdir(chdir=False) as tmp:
+            files = [tmp / 'a', tmp / 'b']
+            for f in files:
+                f.write_text('data')
+            with mock.patch.object(utils, 'cpu_count', return_value=2), \
+                    mock.patch.object(utils, '_sign_pool', None), \
+                    mock.patch.object(utils, 'ThreadPool', side_effect=pool):
+                threads = [threading.Thread(target=utils.sign_files,
+                                            args=(files,))
+                           for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        self.assertEqual(len(pools), 1)
+        pools[0].close()
+
+    def test_profiled_process(self):
+        from charmtools.build.profiler import Profiler
+        with mock.patch.object(utils, 'PROFILER', Profiler()) as profiler:
+            utils.Process(('/bin/echo',))('hello')
+            with utils.profiled('nothing', 'phase'):
+                pass
+        self.assertEqual([(e['name'], e['cat']) for e in profiler.events],
+                         [('echo', 'process'), ('nothing', 'phase')])
+        self.assertEqual(profiler.events[0]['args']['command'],
+                         '/bin/echo hello')
+        # nothing is recorded when the build isn't profiled
+        with utils.profiled('nothing', 'phase'):
+            pass
+        self.assertEqual(len(profiler.events), 2)
+
+    def test_write_zip(self):
+        import stat
+        import zipfile
+        with utils.tempdir(chdir=False) as tmp:
+            (tmp / 'src/hooks').makedirs()
+            (tmp / 'src/hooks/install').write_text('#!/bin/sh\n')
+            (tmp / 'src/hooks/install').chmod(0o755)
+            (tmp / 'src/README').write_text('readme\n')
+            os.symlink('README', tmp / 'src/link')
+            (tmp / 'src/unlisted').write_text('unlisted\n')
+            files = ['link', 'hooks/install', 'README', 'missing']
+            utils.write_zip(tmp / 'a.zip', tmp / 'src', files,
+                            {'extra': 'data'})
+            (tmp / 'src/README').utime((0, 0))
+            utils.write_zip(tmp / 'b.zip', tmp / 'src', reversed(files),
+                            {'extra': 'data'})
+            self.assertEqual((tmp / 'a.zip').bytes(), (tmp / 'b.zip').bytes())
+            archive = zipfile.ZipFile(tmp / 'a.zip')
+            infos = archive.infolist()
+            self.assertEqual([i.filename for i in infos],
+                             ['README', 'extra', 'hooks/install', 'link'])
+            self.assertEqual(set(i.date_time for i in infos),
+                             {utils.ZIP_DATE_TIME})
+            modes = {i.filename: i.external_attr >> 16 for i in infos}
+            self.assertEqual(stat.S_IMODE(modes['hooks/install']), 0o755)
+            self.assertTrue(stat.S_ISLNK(modes['link']))
+            self.assertEqual(archive.read('link'), 'README')
+            self.assertEqual(archive.read('extra'), 'data')
+            self.assertEqual(sorted(tmp.files()), [tmp / 'a.zip',
+                                                   tmp / 'b.zip'])
+
+    def test_load_yaml(self):
+        with utils.tempdir(chdir=False) as tmp:
+            filename = tmp / 'layer.yaml'
+            filename.write_text('includes: [layer:basic]\n')
+            with mock.patch.object(utils.yaml, 'load',
+                                   wraps=utils.yaml.load) as load:
+                data = utils.load_yaml(filename)
+                self.assertEqual(data, {'includes': ['layer:basic']})
+                data['includes'].append('changed by the caller')
+                self.assertEqual(utils.load_yaml(filename),
+                                 {'includes': ['layer:basic']})
+                self.assertEqual(load.call_count, 1)
+                self.assertIs(load.call_args[1]['Loader'], utils.YAMLLoader)
+                filename.write_text('includes: [layer:other]\n')
+                self.assertEqual(utils.load_yaml(filename),
+                                 {'includes': ['layer:other']})
+                self.assertEqual(load.call_count, 2)